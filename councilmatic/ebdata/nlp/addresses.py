@@ -16,6 +16,7 @@
 #   along with ebdata.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import bisect
 import re
 
 # Regex notes:
@@ -302,13 +303,104 @@ ADDRESSES_RE = r"""(?x)
 
 ADDRESSES_RE_COMPILED = re.compile(ADDRESSES_RE)
 
-def parse_addresses(text):
+# Trying ADDRESSES_RE at every position of a long document is slow, so
+# parse_addresses only tries it where an address could possibly start.  Every
+# match of ADDRESSES_RE is one of:
+#
+#   * a block or address, which starts with a number or "first";
+#   * a segment or an intersection, which has a connecting word ("between",
+#     "from", "and", "at", "near", ...) right after its first street name.
+#
+# and a street name (plus an intersection prefix like "corner of") is at most
+# 14 whitespace-separated tokens long; MAX_STREET_TOKENS leaves a little room
+# to spare.  So the candidates are
+# the word starts at numbers and "first", and the word starts in the few
+# tokens before each connecting word that is followed by something that could
+# start a street name.  ADDRESSES_RE is then matched (not searched) at each
+# candidate in turn, so the results are the same as ADDRESSES_RE.findall's.
+
+MAX_STREET_TOKENS = 16
+
+BLOCK_START_RE = re.compile(r'\b(?=\d|[Ff][Ii][Rr][Ss][Tt][-\ ])')
+
+CONNECTOR_RE = re.compile(r"""(?x)
+    (?<=[A-Za-z0-9.,])
+    \ +
+    (?:
+        between | from |
+        [Aa][Nn][Dd] |
+        [Aa][Tt] |
+        [Nn][Ee][Aa][Rr] |
+        & |
+        [Aa][Rr][Oo][Uu][Nn][Dd] |
+        [Tt][Oo][Ww][Aa][Rr][Dd][Ss]? |
+        [Oo][Ff][Ff] |
+        (?:[Jj][Uu][Ss][Tt]\ )?(?:[Nn][Oo][Rr][Tt][Hh]|[Ss][Oo][Uu][Tt][Hh]|[Ee][Aa][Ss][Tt]|[Ww][Ee][Ss][Tt])\ [Oo][Ff] |
+        (?:[Jj][Uu][Ss][Tt]\ )?[Pp][Aa][Ss][Tt]
+    )
+    # Something that could start the next street name.
+    (?=
+        \ +
+        (?:
+            [0-9A-Z] |
+            [nsew]\.?\ |
+            (?:n[Oo][Rr][Tt][Hh]|s[Oo][Uu][Tt][Hh])(?:[Ee][Aa][Ss][Tt]|[Ww][Ee][Ss][Tt])?\ |
+            e[Aa][Ss][Tt]\ |
+            w[Ee][Ss][Tt]\ |
+            s[Tt]\.?\ |
+            d[Rr]\.?\ 
+        )
+    )
+""")
+
+# The first letter of a street name, a direction, or an intersection prefix.
+STREET_START_RE = re.compile(r'\b(?=[0-9A-Zacdeinorstvw])')
+
+TOKEN_RE = re.compile(r'\S+')
+
+def _address_candidates(text):
+    """
+    Returns the sorted positions in the given string where an ADDRESSES_RE
+    match could start.
+    """
+    candidates = set(m.start() for m in BLOCK_START_RE.finditer(text))
+
+    connectors = [m.span() for m in CONNECTOR_RE.finditer(text)]
+    if connectors:
+        token_starts = [m.start() for m in TOKEN_RE.finditer(text)]
+        for connector_start, connector_end in connectors:
+            last_token = bisect.bisect_right(token_starts, connector_start) - 1
+            start = token_starts[max(last_token - MAX_STREET_TOKENS + 1, 0)]
+            # The connector's own words (e.g., the "JUST" in "JUST EAST OF")
+            # may be the end of a street name too.
+            candidates.update(m.start() for m in
+                              STREET_START_RE.finditer(text, start, connector_end))
+
+    return sorted(candidates)
+
+def parse_addresses(text, prefilter=True):
     """
     Returns a list of all addresses found in the given string, as tuples in the
     format (address, city).
+
+    ADDRESSES_RE is only tried where an address could start, unless
+    ``prefilter`` is False.
     """
-    # This assumes the last parenthetical grouping in ADDRESSES_RE is the city.
-    return [(''.join(bits[:-1]), bits[-1]) for bits in ADDRESSES_RE_COMPILED.findall(text)]
+    if not prefilter:
+        # This assumes the last parenthetical grouping in ADDRESSES_RE is the city.
+        return [(''.join(bits[:-1]), bits[-1]) for bits in ADDRESSES_RE_COMPILED.findall(text)]
+
+    addresses = []
+    end = 0
+    for start in _address_candidates(text):
+        if start < end:
+            continue
+        m = ADDRESSES_RE_COMPILED.match(text, start)
+        if m:
+            bits = m.groups('')
+            addresses.append((''.join(bits[:-1]), bits[-1]))
+            end = m.end()
+    return addresses
 
 def tag_addresses(text, pre='<addr>', post='</addr>'):
     """
@@ -22,6 +22,7 @@ from ebdata.nlp.places import phrase_tagger
 from ebdata.nlp.places import loose_phrase_grabber
 from ebdata.nlp.places import paranoid_phrase_grabber
 
+import random
 import unittest
 
 class AddressParsing(unittest.TestCase):
@@ -766,6 +767,66 @@ class CityAddressParsing(AddressParsing):
         self.assertParses('2826 S. WENTWORTH', [('2826 S. WENTWORTH', '')])
 
 
+class PrefilteredAddressParsing(AddressParsing):
+    """parse_addresses only tries the regex where an address could start;
+    that should never change what it finds.
+    """
+
+    text = ('An Ordinance amending Title 14 of The Philadelphia Code, '
+            'entitled "Zoning and Planning," by rezoning the area bounded '
+            'by Broad Street, Market Street, 15th Street and Arch Street. '
+            'The vacant lot at 1500 block of N. 16th Avenue, in Philadelphia '
+            'is near Main St.      and Market, and the corner of '
+            'Dr. Martin Luther King Jr. Blvd. and 22nd St. Meanwhile, the '
+            'Council of the City of Philadelphia and the Mayor met at City '
+            'Hall on 22 May 2009 to discuss Walnut between 5th and 6th, '
+            'and Spruce from Broad to 12th.\n')
+
+    def test_matches_unfiltered_parsing(self):
+        text = self.text * 50
+        addresses = parse_addresses(text)
+        self.assertEqual(len(addresses), 50 * len(parse_addresses(self.text)))
+        self.assertEqual(addresses, parse_addresses(text, prefilter=False))
+
+    def test_long_street_name_before_connector(self):
+        # As many tokens as a street name can have before a connector.
+        text = ('N. Dr. Martin Avenue X Smith Jones Brown Green White '
+                'Ave.,\nNW  and Broad')
+        self.assertEqual(parse_addresses(text), parse_addresses(text, prefilter=False))
+
+    def test_street_name_inside_connector(self):
+        # "JUST" could be part of the connector, but here it's the street.
+        text = 'Meet me, JUST EAST OF WEST LAKE STREET'
+        self.assertEqual(parse_addresses(text), [('JUST EAST OF WEST LAKE', '')])
+        self.assertEqual(parse_addresses(text), parse_addresses(text, prefilter=False))
+
+    def get_corpus(self):
+        # Every text that the other address tests parse.
+        texts = []
+        for cls in AddressParsing.__subclasses__():
+            if cls is PrefilteredAddressParsing:
+                continue
+            for name in unittest.TestLoader().getTestCaseNames(cls):
+                test = cls(name)
+                test.assertParses = lambda text, expected: texts.append(text)
+                getattr(test, name)()
+        return texts
+
+    def test_matches_unfiltered_parsing_of_random_text(self):
+        texts = self.get_corpus()
+        words = ' '.join(texts).split() + ['JUST', 'EAST', 'OF', 'PAST', 'and', 'at']
+        separators = [' ', '  ', ', ', '. ', '\n', ' and ', ' at ', ' JUST EAST OF ']
+
+        rand = random.Random(23)
+        for _ in xrange(2000):
+            pieces = [rand.choice(texts) for _ in xrange(rand.randint(1, 4))]
+            pieces += [' '.join(rand.choice(words) for _ in xrange(rand.randint(1, 12)))]
+            rand.shuffle(pieces)
+            text = ''.join(piece + rand.choice(separators) for piece in pieces)
+            self.assertEqual(parse_addresses(text), parse_addresses(text, prefilter=False),
+                             'Different addresses found in %r' % (text,))
+
+
 class TestPhraseGrabber(unittest.TestCase):
 
     def test_loose_phrase_grabber(self):
@@ -1,5 +1,6 @@
 from django import forms
 from django.utils.translation import ugettext as _
+from phillyleg.aliases import CouncilMemberAliasResolver
 
 
 def merge_councilmember_form_factory(members_qs):
@@ -23,4 +24,7 @@ def merge_councilmember_form_factory(members_qs):
                 primary_member.legislation.add(*member.legislation.all())
 
             other_members.delete()
+
+            # Anything that has the old aliases loaded needs to reload them.
+            CouncilMemberAliasResolver.invalidate()
     return MergeCouncilMemberForm
\ No newline at end of file
@@ -0,0 +1,85 @@
+import uuid
+from django.core.cache import cache
+from phillyleg.models import CouncilMember, CouncilMemberAlias
+
+VERSION_CACHE_KEY = 'phillyleg:councilmember-aliases-version'
+VERSION_CACHE_TIMEOUT = 60 * 60 * 24 * 30
+
+
+class CouncilMemberAliasResolver (object):
+    """
+    Resolves the names that council members go by in legislation (as sponsors
+    and voters) to ``CouncilMember`` objects, from an index of all the
+    ``CouncilMemberAlias`` names that is loaded once and kept in memory.
+
+    Names that aren't known yet get a new council member right away, but
+    their aliases are held until ``flush`` is called, so that they can be
+    inserted together.  If the transaction that the new members were created
+    in is rolled back, call ``reset`` to forget about them.
+
+    Merging council members makes any loaded index stale; call
+    ``invalidate`` after changing aliases, and every resolver (in this
+    process, or -- through the cache -- in others) will reload its index the
+    next time it is checked.
+    """
+
+    generation = 0
+    """Bumped whenever the aliases are changed in this process."""
+
+    def __init__(self):
+        self.reset()
+
+    @classmethod
+    def invalidate(cls):
+        cls.generation += 1
+        cache.set(VERSION_CACHE_KEY, uuid.uuid4().hex, VERSION_CACHE_TIMEOUT)
+
+    def reset(self):
+        self.members = None
+        self.pending_aliases = []
+        self.loaded_generation = None
+        self.loaded_version = None
+
+    def is_stale(self):
+        return (self.members is None or
+                self.loaded_generation != self.generation or
+                self.loaded_version != cache.get(VERSION_CACHE_KEY))
+
+    def load(self):
+        self.loaded_generation = self.generation
+        self.loaded_version = cache.get(VERSION_CACHE_KEY)
+        self.members = dict(
+            (alias.name, alias.member)
+            for alias in CouncilMemberAlias.objects.select_related('member'))
+
+    def check(self):
+        """
+        Reload the index if the aliases have changed since it was loaded.
+        """
+        if self.is_stale():
+            self.flush()
+            self.load()
+
+    def resolve(self, name):
+        """
+        Get the council member that goes by the given name, creating one if
+        there isn't any.
+        """
+        if self.members is None:
+            self.load()
+
+        member = self.members.get(name)
+        if member is None:
+            member = CouncilMember.objects.create(real_name=name)
+            self.members[name] = member
+            self.pending_aliases.append(
+                CouncilMemberAlias(member=member, name=name))
+        return member
+
+    def flush(self):
+        """
+        Save the aliases of any council members created since the last flush.
+        """
+        if self.pending_aliases:
+            CouncilMemberAlias.objects.bulk_create(self.pending_aliases)
+            self.pending_aliases = []
@@ -0,0 +1,237 @@
+"""
+Geocoding of the addresses found in legislation, through a cache of what the
+geocoder has said about each address before -- including that it couldn't
+find it.
+
+Addresses are cached by a normalized form, so that trivial variants like
+"1500 Market St." and "1500 MARKET STREET" are only looked up once.  The
+lookups themselves are made by a pluggable backend, configured with the
+``GEOCODER`` and ``GEOCODER_OPTIONS`` legislation settings.  How long found
+and missing addresses are cached for is set, in days, by
+``GEOCODE_CACHE_DAYS`` (forever by default) and ``GEOCODE_MISS_CACHE_DAYS``.
+"""
+
+import collections
+import datetime
+import logging
+import re
+import threading
+from django.conf import settings
+from django.contrib.gis import geos
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+import utils
+from phillyleg.models import GeocodeCacheEntry
+from utils import TooManyGeocodeRequests
+from utils.stats import incr, timed
+
+log = logging.getLogger(__name__)
+
+GeocodeResult = collections.namedtuple('GeocodeResult', ['address', 'point'])
+
+# Each of these words in an address is replaced by its abbreviation.
+ABBREVIATIONS = {
+    'north': 'n', 'south': 's', 'east': 'e', 'west': 'w',
+    'northeast': 'ne', 'northwest': 'nw', 'southeast': 'se', 'southwest': 'sw',
+    'avenue': 'ave', 'boulevard': 'blvd', 'bvd': 'blvd', 'circle': 'cir',
+    'court': 'ct', 'drive': 'dr', 'lane': 'ln', 'parkway': 'pkwy',
+    'place': 'pl', 'plaza': 'plz', 'point': 'pt', 'road': 'rd',
+    'route': 'rte', 'square': 'sq', 'street': 'st', 'streets': 'sts',
+    'terrace': 'ter', 'terr': 'ter', 'trail': 'trl', 'way': 'wy',
+}
+
+
+def normalize_address(address):
+    """
+    Get the form of an address that its variants have in common: lowercase,
+    without periods, with single spaces, and with street types and directions
+    abbreviated.
+    """
+    address = address.lower().replace('.', '')
+    words = re.split(r'[\s,]+', address)
+    return ' '.join(ABBREVIATIONS.get(word, word) for word in words if word)
+
+
+class GeocodeError (Exception):
+    """
+    The geocoder couldn't answer right now.  Unlike an address that isn't
+    found, this isn't cached.
+    """
+    pass
+
+
+class GeocoderBackend (object):
+    """
+    Looks addresses up.  Subclasses implement ``geocode``, and may override
+    ``geocode_many`` if they can look up several addresses at once.
+    """
+
+    name = ''
+
+    def geocode(self, address):
+        """
+        Get a ``GeocodeResult`` for the address, or None if it can't be
+        found.  Raises ``GeocodeError`` if the geocoder can't answer right
+        now.
+        """
+        raise NotImplementedError
+
+    def geocode_many(self, addresses):
+        """
+        Generate an (address, result) pair for each of the given addresses
+        that the geocoder could answer for, as the answers come in.
+        """
+        for address in addresses:
+            try:
+                yield address, self.geocode(address)
+            except GeocodeError, e:
+                log.warning('Could not geocode "%s" right now: %s' % (address, e))
+
+
+class GoogleGeocoderBackend (GeocoderBackend):
+    """
+    Looks addresses up with Google's geocoding API, within the
+    ``ADDRESS_BOUNDS`` from the legislation settings.
+    """
+
+    name = 'google'
+
+    def __init__(self, bounds=None):
+        self.bounds = bounds or settings.LEGISLATION['ADDRESS_BOUNDS']
+
+    def geocode(self, address):
+        gc = utils.geocode(address, self.bounds)
+        if gc is None:
+            raise GeocodeError('No response')
+        if gc['status'] == 'OVER_QUERY_LIMIT':
+            raise TooManyGeocodeRequests(gc['status'])
+        if gc['status'] in ('ZERO_RESULTS', 'INVALID_REQUEST'):
+            return None
+        if gc['status'] != 'OK':
+            raise GeocodeError(gc['status'])
+
+        result = gc['results'][0]
+        location = result['geometry']['location']
+        return GeocodeResult(result['formatted_address'],
+                             geos.Point(float(location['lng']), float(location['lat'])))
+
+
+class StubGeocoderBackend (GeocoderBackend):
+    """
+    Answers from a dictionary of addresses to (formatted address, (lng, lat))
+    pairs, without going anywhere; any other address isn't found.  The
+    addresses it was asked about are kept in ``lookups``.
+    """
+
+    name = 'stub'
+
+    def __init__(self, results=None):
+        self.results = dict((normalize_address(address), result)
+                            for address, result in (results or {}).iteritems())
+        self.lookups = []
+
+    def geocode(self, address):
+        self.lookups.append(address)
+        result = self.results.get(normalize_address(address))
+        if result is None:
+            return None
+
+        formatted_address, (lng, lat) = result
+        return GeocodeResult(formatted_address, geos.Point(lng, lat))
+
+
+class CachedGeocoder (object):
+    """
+    Geocodes addresses in batches, looking each distinct (normalized) address
+    up with the backend only if the cache doesn't have an answer for it yet.
+    """
+
+    def __init__(self, backend, found_ttl=None, missing_ttl=datetime.timedelta(days=30)):
+        self.backend = backend
+        self.found_ttl = found_ttl
+        self.missing_ttl = missing_ttl
+
+    def geocode(self, address):
+        return self.geocode_many([address])[address]
+
+    def geocode_many(self, addresses):
+        """
+        Get a dictionary of the given addresses to their ``GeocodeResult``s,
+        or to None for those that couldn't be geocoded.
+        """
+        keys = dict((address, normalize_address(address)) for address in addresses)
+        results = {}
+        for key, entry in GeocodeCacheEntry.objects.lookup(set(keys.values())).iteritems():
+            results[key] = GeocodeResult(entry.address, entry.geom) if entry.found else None
+
+        # Look each address up by one of its variants.
+        lookups = {}
+        for address, key in keys.iteritems():
+            if key not in results and key not in lookups:
+                lookups[key] = address
+        incr('geocode_cache_hits', len(set(keys.values())) - len(lookups))
+
+        if lookups:
+            found = {}
+            try:
+                with timed('geocode'):
+                    for address, result in self.backend.geocode_many(lookups.values()):
+                        found[keys[address]] = result
+            finally:
+                # Keep whatever was found, even if the backend gave out
+                # (unless the caller's transaction is rolled back).
+                GeocodeCacheEntry.objects.store(found, self.backend.name,
+                                                self.found_ttl, self.missing_ttl)
+            results.update(found)
+
+        return dict((address, results.get(key)) for address, key in keys.iteritems())
+
+
+def load_geocoder_backend():
+    """
+    Create the geocoder backend configured by the ``GEOCODER`` and
+    ``GEOCODER_OPTIONS`` legislation settings.
+    """
+    backend_name = settings.LEGISLATION.get(
+        'GEOCODER', 'phillyleg.geocoding.GoogleGeocoderBackend')
+    module, attr = backend_name.rsplit('.', 1)
+
+    try:
+        Backend = getattr(import_module(module), attr)
+    except (ImportError, AttributeError), e:
+        raise ImproperlyConfigured('Error importing geocoder %s: "%s"' % (backend_name, e))
+
+    return Backend(**settings.LEGISLATION.get('GEOCODER_OPTIONS', {}))
+
+
+def days(value):
+    return datetime.timedelta(days=value) if value is not None else None
+
+
+_geocoder = None
+_geocoder_lock = threading.Lock()
+
+def get_geocoder():
+    """
+    Get the geocoder shared by everything in this process.
+    """
+    global _geocoder
+
+    with _geocoder_lock:
+        if _geocoder is None:
+            _geocoder = CachedGeocoder(
+                load_geocoder_backend(),
+                found_ttl=days(settings.LEGISLATION.get('GEOCODE_CACHE_DAYS')),
+                missing_ttl=days(settings.LEGISLATION.get('GEOCODE_MISS_CACHE_DAYS', 30)))
+        return _geocoder
+
+def use_geocoder(geocoder):
+    """
+    Make the given geocoder the one shared by everything in this process
+    (e.g., one with a stub backend, for tests).
+    """
+    global _geocoder
+
+    with _geocoder_lock:
+        _geocoder = geocoder
@@ -0,0 +1,76 @@
+from django.core.management.base import BaseCommand, CommandError
+import optparse
+import time
+
+from ebdata.nlp.addresses import parse_addresses
+from phillyleg.models import LegFile, LegMinutes
+
+
+class Command(BaseCommand):
+    help = ("Time address extraction, with and without the prefilter, over "
+            "the text of stored legislative files and minutes (or of the "
+            "given text files), and check that both find the same addresses.")
+    args = '[FILE ...]'
+    option_list = BaseCommand.option_list + (
+            optparse.make_option('--max-files',
+                action='store',
+                type='int',
+                dest='max_files',
+                default=100,
+                help='Number of stored files and of stored minutes to use'),
+            optparse.make_option('--repeat',
+                action='store',
+                type='int',
+                dest='repeat',
+                default=1,
+                help='Number of times to parse each text'),
+            )
+
+    def get_texts(self, paths, max_files):
+        if paths:
+            for path in paths:
+                with open(path) as text_file:
+                    yield path, text_file.read().decode('utf-8', 'replace')
+            return
+
+        for legfile in LegFile.objects.order_by('-key')[:max_files]:
+            yield 'file %s' % (legfile.key,), legfile.all_text()
+        for minutes in LegMinutes.objects.order_by('-pk')[:max_files]:
+            yield 'minutes %s' % (minutes.pk,), minutes.fulltext
+
+    def time_parse(self, text, repeat, prefilter):
+        start_time = time.time()
+        for _ in xrange(repeat):
+            addresses = parse_addresses(text, prefilter=prefilter)
+        return addresses, time.time() - start_time
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        texts = chars = found = 0
+        filtered_time = unfiltered_time = 0.0
+        mismatches = []
+
+        for name, text in self.get_texts(args, options['max_files']):
+            filtered, seconds = self.time_parse(text, repeat, True)
+            filtered_time += seconds
+            unfiltered, seconds = self.time_parse(text, repeat, False)
+            unfiltered_time += seconds
+
+            if filtered != unfiltered:
+                mismatches.append(name)
+            texts += 1
+            chars += len(text)
+            found += len(unfiltered)
+
+        if not texts:
+            raise CommandError('There is no text to parse.')
+
+        self.stdout.write(
+            'Texts: %s (%s characters, %s addresses)\n'
+            'Prefiltered: %.2fs\nUnfiltered: %.2fs\nSpeedup: %.1fx\n' % (
+                texts, chars, found, filtered_time, unfiltered_time,
+                unfiltered_time / (filtered_time or 1e-9)))
+
+        if mismatches:
+            raise CommandError('Different addresses found in: %s' %
+                               (', '.join(mismatches),))
@@ -0,0 +1,118 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+import json
+import logging
+import optparse
+import resource
+import time
+
+from phillyleg.management.commands import updatelegfiles
+from phillyleg.management.scraper_wrappers.http_session import RecordingSession
+from phillyleg.management.scraper_wrappers.http_session import ReplaySession
+from phillyleg.management.scraper_wrappers.http_session import use_session
+
+
+class Command(BaseCommand):
+    help = ("Run updatelegfiles against a fresh database, with HTTP responses "
+            "replayed from (or recorded into) a fixture directory, and report "
+            "how long it took.")
+    option_list = BaseCommand.option_list + (
+            optparse.make_option('--fixtures',
+                action='store',
+                dest='fixtures',
+                default=None,
+                help='Directory of recorded HTTP responses'),
+            optparse.make_option('--record',
+                action='store_true',
+                dest='record',
+                default=False,
+                help='Record responses from the live site into the fixture '
+                     'directory instead of replaying them'),
+            optparse.make_option('--max-files',
+                action='store',
+                type='int',
+                dest='max_files',
+                default=100,
+                help='Number of files to scrape'),
+            optparse.make_option('--workers',
+                action='store',
+                type='int',
+                dest='workers',
+                default=1,
+                help='Number of threads to use for fetching and parsing files'),
+            optparse.make_option('--batch-size',
+                action='store',
+                type='int',
+                dest='batch_size',
+                default=1,
+                help='Number of files to save in each database transaction'),
+            optparse.make_option('--geocode',
+                action='store_true',
+                dest='geocode',
+                default=False,
+                help='Geocode addresses (this goes to the live geocoder, so '
+                     'timings will vary)'),
+            optparse.make_option('--stats-file',
+                action='store',
+                dest='stats_file',
+                default=None,
+                help='Write the results as JSON to this file'),
+            )
+
+    def handle(self, *args, **options):
+        log = logging.getLogger()
+        log.setLevel(logging.WARNING)
+
+        if not options['fixtures']:
+            raise CommandError('A fixture directory (--fixtures) is required.')
+
+        if options['record']:
+            use_session(RecordingSession(options['fixtures']))
+        else:
+            use_session(ReplaySession(options['fixtures']))
+        settings.LEGISLATION['GEOCODE'] = options['geocode']
+
+        verbosity = int(options.get('verbosity', 1))
+        old_db_name = settings.DATABASES['default']['NAME']
+        connection.creation.create_test_db(verbosity, autoclobber=True)
+
+        try:
+            # Start from updatelegfiles' own defaults, as call_command would,
+            # so that new options don't have to be added here too.
+            command = updatelegfiles.Command()
+            update_options = dict((option.dest, option.default)
+                                  for option in command.option_list
+                                  if option.default is not optparse.NO_DEFAULT)
+            update_options.update(workers=options['workers'],
+                                  batch_size=options['batch_size'],
+                                  max_files=options['max_files'],
+                                  full_sweep=True)
+
+            start_time = time.time()
+            command.execute(**update_options)
+            wall_time = time.time() - start_time
+        finally:
+            connection.creation.destroy_test_db(old_db_name, verbosity)
+
+        summary = command.run_stats.summary()
+        results = {
+            'wall_time': wall_time,
+            'files': summary['records'],
+            'files_per_second': summary['records_per_second'],
+            'queries': summary['queries'],
+            # ru_maxrss is in kilobytes on Linux.
+            'peak_memory_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            'stages': summary['stages'],
+        }
+
+        self.stdout.write(
+            'Wall time: %.2fs\nFiles: %s (%.2f/sec)\nQueries: %s\n'
+            'Peak memory: %.1f MB\n' % (
+                results['wall_time'], results['files'],
+                results['files_per_second'] or 0, results['queries'],
+                results['peak_memory_mb']))
+
+        if options['stats_file']:
+            with open(options['stats_file'], 'w') as stats_file:
+                json.dump(results, stats_file, indent=2, sort_keys=True)
@@ -1,30 +1,255 @@
-import sys
+import datetime
+import json
+import optparse
+import time
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
-import smtplib, poplib
-import django
-from email.mime.text import MIMEText
-from phillyleg.models import Subscription, Keyword, LegFile
-import csv
+from django.db import connection, models, transaction
 
-class Command(BaseCommand):
-    help = "python manage.py csvimport CSVFILE"
-    def handle(self,  *args, **options):
-        csvpath = args[0]
-        reader = csv.reader(open(csvpath, 'r'))
+from ebdata.parsing.unicodecsv import UnicodeReader
+from phillyleg.aliases import CouncilMemberAliasResolver
+from phillyleg.management.scraper_wrappers.pipeline import chunked
+from phillyleg.models import LegFile, MetadataJob
+
+# The columns of the CSV files, in order.  JSONL records use the same names.
+FIELDS = ['status', 'title', 'url', 'sponsors', 'controlling_body', 'contact',
+          'version', 'key', 'final_date', 'intro_date', 'type']
+
+DATE_FORMATS = ['%Y-%m-%d', '%m/%d/%Y']
+
+
+def read_csv_rows(path):
+    """
+    Read legislative file records from a CSV file with a header row, and the
+    columns in the order of ``FIELDS``.
+    """
+    with open(path, 'rb') as csvfile:
+        reader = UnicodeReader(csvfile)
         reader.next()
         for row in reader:
-            d = {
-                'status': row[0],
-                'title': row[1],
-                'url': row[2],
-                'sponsors': row[3],
-                'controlling_body': row[4],
-                'contact': row[5],
-                'version': row[6],
-                'key': row[7],
-                'final_date': row[8],
-                'intro_date': row[9],
-                'type': row[10],
-            }
-        
-            LegFile.objects.get_or_create(**d)
+            yield dict(zip(FIELDS, row))
+
+
+def read_jsonl_rows(path):
+    """
+    Read legislative file records from a file with one JSON object per line.
+    """
+    with open(path, 'rb') as jsonfile:
+        for line in jsonfile:
+            if line.strip():
+                yield json.loads(line)
+
+
+def parse_date(value):
+    if not value:
+        return None
+    if isinstance(value, datetime.date):
+        return value
+
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    raise ValueError('Unrecognized date: %r' % (value,))
+
+
+def parse_sponsors(value):
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        value = value.split(',')
+    return [name.strip() for name in value if name.strip()]
+
+
+def bulk_update(model, rows):
+    """
+    Update rows of the model in one statement, from a list of VALUES.  Each
+    row is a dictionary of field names to values, including the primary key,
+    and every row must have the same fields.  Only works on PostgreSQL.
+    """
+    opts = model._meta
+    fields = [opts.get_field(name) for name in sorted(rows[0])]
+    qn = connection.ops.quote_name
+
+    # The values are cast, because otherwise PostgreSQL takes them all for
+    # text.  Strings are left alone, so that a cast doesn't truncate them.
+    row_sql = '(%s)' % ', '.join(
+        '%s' if isinstance(field, (models.CharField, models.TextField))
+        else '%%s::%s' % (field.db_type(connection),)
+        for field in fields)
+    params = [field.get_db_prep_save(row[field.name], connection)
+              for row in rows for field in fields]
+
+    sql = 'UPDATE %s SET %s FROM (VALUES %s) AS new (%s) WHERE %s.%s = new.%s' % (
+        qn(opts.db_table),
+        ', '.join('%s = new.%s' % (qn(field.column), qn(field.column))
+                  for field in fields if field is not opts.pk),
+        ', '.join([row_sql] * len(rows)),
+        ', '.join(qn(field.column) for field in fields),
+        qn(opts.db_table), qn(opts.pk.column), qn(opts.pk.column))
+    connection.cursor().execute(sql, params)
+
+
+class LegFileLoader (object):
+    """
+    Loads legislative file records in bulk.  Each batch of records is saved
+    in one transaction: files that aren't stored yet are inserted together,
+    stored files are updated together, and the sponsor links for the whole
+    batch are replaced with one bulk insert into the through table.
+
+    Metadata (words, mentions, locations, topics) is not derived as the files
+    are loaded; call ``update_metadata`` afterwards with the loaded keys.
+    """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.aliases = CouncilMemberAliasResolver()
+        self.created = 0
+        self.updated = 0
+
+    def load(self, rows):
+        """
+        Load the given records.  Returns the keys of the files loaded.
+        """
+        keys = []
+        for batch in chunked(rows, self.batch_size):
+            keys.extend(self.load_batch(batch))
+        return keys
+
+    def clean_row(self, row):
+        fields = dict((field, row[field]) for field in FIELDS
+                      if field in row and field != 'sponsors')
+        fields['key'] = int(fields['key'])
+        fields['final_date'] = parse_date(fields.get('final_date'))
+        fields['intro_date'] = parse_date(fields.get('intro_date'))
+        if fields['intro_date'] is None:
+            del fields['intro_date']
+        return fields, parse_sponsors(row.get('sponsors'))
+
+    def load_batch(self, rows):
+        # Later rows for the same key win.
+        records = {}
+        for row in rows:
+            fields, sponsors = self.clean_row(row)
+            records[fields['key']] = (fields, sponsors)
+        keys = sorted(records)
+
+        with transaction.commit_on_success():
+            try:
+                self.aliases.check()
+                self._save_files(keys, records)
+                self._save_sponsors(keys, records)
+                self.aliases.flush()
+            except:
+                self.aliases.reset()
+                raise
+
+        return keys
+
+    def _save_files(self, keys, records):
+        existing_keys = set(LegFile.objects.filter(key__in=keys)
+                            .values_list('key', flat=True))
+
+        new_files = [LegFile(**records[key][0])
+                     for key in keys if key not in existing_keys]
+        LegFile.objects.bulk_create(new_files)
+        self.created += len(new_files)
+
+        # Records can leave fields out, so the stored files are updated
+        # together with the others that have the same fields.
+        now = datetime.datetime.now()
+        updates = {}
+        for key in keys:
+            if key in existing_keys:
+                fields = dict(records[key][0], updated_datetime=now)
+                updates.setdefault(tuple(sorted(fields)), []).append(fields)
+                self.updated += 1
+
+        for rows in updates.values():
+            if connection.vendor == 'postgresql':
+                bulk_update(LegFile, rows)
+            else:
+                for fields in rows:
+                    fields = dict(fields)
+                    LegFile.objects.filter(key=fields.pop('key')).update(**fields)
+
+    def _save_sponsors(self, keys, records):
+        Sponsorship = LegFile.sponsors.through
+        Sponsorship.objects.filter(legfile__in=keys).delete()
+
+        sponsorships = []
+        for key in keys:
+            member_ids = set()
+            for name in records[key][1]:
+                member_id = self.aliases.resolve(name).pk
+                if member_id not in member_ids:
+                    member_ids.add(member_id)
+                    sponsorships.append(
+                        Sponsorship(legfile_id=key, councilmember_id=member_id))
+        Sponsorship.objects.bulk_create(sponsorships)
+
+    def update_metadata(self, keys):
+        """
+        Derive the metadata for the files with the given keys, a batch at a
+        time.  If the ``DEFER_METADATA`` legislation setting is on, the
+        metadata is only queued up to be updated by ``process_metadata``.
+        """
+        defer = settings.LEGISLATION.get('DEFER_METADATA', False)
+        for batch in chunked(keys, self.batch_size):
+            with transaction.commit_on_success():
+                if defer:
+                    MetadataJob.objects.enqueue_all(LegFile, batch)
+                else:
+                    for legfile in LegFile.objects.filter(key__in=batch):
+                        legfile.update_metadata()
+
+
+class Command(BaseCommand):
+    help = ("Load legislative files in bulk from a CSV or JSONL file.\n\n"
+            "python manage.py csvimport FILE")
+    args = 'FILE'
+    option_list = BaseCommand.option_list + (
+            optparse.make_option('--format',
+                action='store',
+                dest='format',
+                choices=['csv', 'jsonl'],
+                default=None,
+                help='Format of the file (csv or jsonl); by default, guessed '
+                     'from the file name'),
+            optparse.make_option('--batch-size',
+                action='store',
+                type='int',
+                dest='batch_size',
+                default=1000,
+                help='Number of files to save in each database transaction'),
+            optparse.make_option('--skip-metadata',
+                action='store_true',
+                dest='skip_metadata',
+                default=False,
+                help="Don't derive the files' metadata (words, mentions, "
+                     "locations and topics) after loading them"),
+            )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the path of one file to load.')
+        path = args[0]
+
+        file_format = options['format']
+        if file_format is None:
+            file_format = 'jsonl' if path.endswith(('.jsonl', '.json')) else 'csv'
+        rows = read_jsonl_rows(path) if file_format == 'jsonl' else read_csv_rows(path)
+
+        loader = LegFileLoader(options['batch_size'])
+        start_time = time.time()
+        keys = loader.load(rows)
+        self.stdout.write('Loaded %s files (%s new, %s updated) in %.1fs\n' % (
+            len(keys), loader.created, loader.updated, time.time() - start_time))
+
+        if not options['skip_metadata']:
+            start_time = time.time()
+            loader.update_metadata(keys)
+            self.stdout.write('%s metadata in %.1fs\n' % (
+                'Queued' if settings.LEGISLATION.get('DEFER_METADATA', False)
+                else 'Derived', time.time() - start_time))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+import optparse
+import time
+
+from phillyleg.snapshot import dump_snapshot
+
+
+class Command(BaseCommand):
+    help = ("Write all of the legislation data, including derived metadata "
+            "and geocoded locations, to a compressed snapshot file that "
+            "loadsnapshot can restore.")
+    args = 'FILE'
+    option_list = BaseCommand.option_list + (
+            optparse.make_option('--chunk-size',
+                action='store',
+                type='int',
+                dest='chunk_size',
+                default=1000,
+                help='Number of rows to write in each chunk'),
+            )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the path of the snapshot file to write.')
+
+        start_time = time.time()
+        counts = dump_snapshot(args[0], options['chunk_size'])
+        self.stdout.write('Wrote %s rows from %s tables in %.1fs\n' % (
+            sum(counts.values()), len(counts), time.time() - start_time))
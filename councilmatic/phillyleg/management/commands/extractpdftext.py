@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+import logging
+import optparse
+
+from phillyleg.management.scraper_wrappers import CouncilmaticDataStoreWrapper
+from phillyleg.management.scraper_wrappers.extraction import AttachmentTextExtractor
+from phillyleg.management.scraper_wrappers.extraction import get_text_store_root
+from phillyleg.models import LegFileAttachment, LegMinutes
+
+
+class Command(BaseCommand):
+    help = "Extract the text of any attachments and minutes that have none yet."
+    option_list = BaseCommand.option_list + (
+            optparse.make_option('--processes',
+                action='store',
+                type='int',
+                dest='processes',
+                default=2,
+                help='Number of processes to use for extracting text'),
+            )
+
+    def handle(self, *args, **options):
+        log = logging.getLogger()
+        log.setLevel(logging.INFO)
+
+        ds = CouncilmaticDataStoreWrapper()
+        extractor = AttachmentTextExtractor(get_text_store_root(),
+                                            options['processes'])
+
+        for Model in (LegFileAttachment, LegMinutes):
+            urls = Model.objects.filter(fulltext='').values_list('url', flat=True)
+            for url in urls.distinct():
+                extractor.queue(url)
+
+        for url, text in extractor.finish():
+            ds.save_pdf_text(url, text)
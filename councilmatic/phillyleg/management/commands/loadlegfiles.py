@@ -23,34 +23,34 @@ class Command(BaseCommand):
                 dest='force_download',
                 default=False,
                 help='Force downloading of data from ScraperWiki even if data is available locally'),
+            optparse.make_option('--batch-size',
+                action='store',
+                type='int',
+                dest='batch_size',
+                default=50,
+                help='Number of files to save in each database transaction'),
             )
 
     def handle(self, *args, **options):
         force_download = options['force_download']
+        batch_size = options['batch_size']
 
         try:
             self._get_updated_files()
-            self._get_new_files(force_download)
+            self._get_new_files(force_download, batch_size)
         except TooManyGeocodeRequests:
             sys.exit(0)
 
     def _get_updated_files(self):
         pass
 
-    def _get_new_files(self, force_download):
+    def _get_new_files(self, force_download, batch_size):
         # Create a datastore wrapper object
         ds = CouncilmaticDataStoreWrapper()
         source = ScraperWikiSourceWrapper()
 
-        # Get the latest filings
+        # Get the latest filings, streaming them straight out of the
+        # ScraperWiki tables and into the datastore in batches.
         curr_key = ds.get_latest_key()
-
-        while True:
-            curr_key, source_obj = source.check_for_new_content(curr_key, force_download)
-
-            if source_obj is None:
-                break
-
-            record, attachments, actions, minutes = \
-                source.scrape_legis_file(curr_key, source_obj)
-            ds.save_legis_file(record, attachments, actions, minutes)
+        scraped_files = source.iter_legis_files(curr_key, force_download)
+        ds.save_legis_files(scraped_files, batch_size)
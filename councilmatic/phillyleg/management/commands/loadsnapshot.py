@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+import optparse
+import time
+
+from phillyleg.snapshot import SnapshotError, load_snapshot
+
+
+class Command(BaseCommand):
+    help = ("Restore the legislation data from a snapshot file written by "
+            "dumpsnapshot.  The legislation tables must be empty, unless "
+            "--replace is given.")
+    args = 'FILE'
+    option_list = BaseCommand.option_list + (
+            optparse.make_option('--replace',
+                action='store_true',
+                dest='replace',
+                default=False,
+                help='Delete any legislation data already in the database'),
+            optparse.make_option('--ignore-schema',
+                action='store_true',
+                dest='ignore_schema',
+                default=False,
+                help='Load the snapshot even if it was dumped at a different '
+                     'migration than the database is at'),
+            )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the path of the snapshot file to load.')
+
+        start_time = time.time()
+        try:
+            counts = load_snapshot(args[0], replace=options['replace'],
+                                   check_schema=not options['ignore_schema'])
+        except SnapshotError, e:
+            raise CommandError(str(e))
+
+        self.stdout.write('Loaded %s rows into %s tables in %.1fs\n' % (
+            sum(counts.values()), len(counts), time.time() - start_time))
+        self.stdout.write('Run rebuild_index to make the restored files '
+                          'searchable.\n')
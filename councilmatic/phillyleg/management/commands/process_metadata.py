@@ -0,0 +1,122 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+import datetime
+import itertools
+import logging
+import multiprocessing
+import optparse
+import traceback
+
+from phillyleg.management.scraper_wrappers.sharding import default_owner
+from phillyleg.models import MetadataJob
+from utils import TooManyGeocodeRequests
+
+log = logging.getLogger(__name__)
+
+
+def process_jobs(batch_size=50, lease_seconds=600):
+    """
+    Claim and process batches of queued metadata jobs until there are none
+    left.  Returns the number of jobs processed.
+    """
+    owner = default_owner()
+    duration = datetime.timedelta(seconds=lease_seconds)
+    processed = 0
+
+    while True:
+        claimed_at = datetime.datetime.now()
+        jobs = MetadataJob.objects.claim(owner, batch_size, duration)
+        if not jobs:
+            return processed
+
+        # Do all of the kinds queued for each file or set of minutes at once.
+        target_of = lambda job: (job.legfile_id, job.legminutes_id)
+        jobs.sort(key=target_of)
+        for (legfile_id, legminutes_id), target_jobs in itertools.groupby(jobs, target_of):
+            target_jobs = list(target_jobs)
+            kinds = set(job.kind for job in target_jobs)
+
+            try:
+                with transaction.commit_on_success():
+                    target = target_jobs[0].target
+                    target.update_metadata(**dict(
+                        ('update_' + kind, kind in kinds)
+                        for kind in target.METADATA_KINDS))
+            except TooManyGeocodeRequests:
+                # Not the jobs' fault; leave them all for next time.
+                MetadataJob.objects.release(jobs, owner)
+                raise
+            except Exception:
+                if legfile_id is not None:
+                    log.exception('Failed to update metadata for legfile %s' % (legfile_id,))
+                else:
+                    log.exception('Failed to update metadata for minutes %s' % (legminutes_id,))
+                MetadataJob.objects.fail(target_jobs, owner, traceback.format_exc())
+            else:
+                MetadataJob.objects.finish(target_jobs, owner, claimed_at)
+                processed += len(target_jobs)
+
+
+def run_worker(batch_size, lease_seconds):
+    # Each worker process needs its own database connection.
+    connection.close()
+    try:
+        return process_jobs(batch_size, lease_seconds)
+    except TooManyGeocodeRequests:
+        return 0
+
+
+class Command(BaseCommand):
+    help = ("Derive the metadata (words, mentions, locations and topics) that "
+            "has been queued up for legislative files and minutes saved with "
+            "the DEFER_METADATA legislation setting on.")
+    option_list = BaseCommand.option_list + (
+            optparse.make_option('--workers',
+                action='store',
+                type='int',
+                dest='workers',
+                default=1,
+                help='Number of processes to work through the queue with'),
+            optparse.make_option('--batch-size',
+                action='store',
+                type='int',
+                dest='batch_size',
+                default=50,
+                help='Number of jobs for each worker to claim at a time'),
+            optparse.make_option('--lease-seconds',
+                action='store',
+                type='int',
+                dest='lease_seconds',
+                default=600,
+                help='How long a worker may hold a batch of jobs before '
+                     'another worker may take them over'),
+            )
+
+    def handle(self, *args, **options):
+        log = logging.getLogger()
+        log.setLevel(logging.INFO)
+
+        workers = options['workers']
+        batch_size = options['batch_size']
+        lease_seconds = options['lease_seconds']
+
+        if workers > 1:
+            # Don't share this process's connection with the workers.
+            connection.close()
+            pool = multiprocessing.Pool(workers)
+            try:
+                results = [pool.apply_async(run_worker, (batch_size, lease_seconds))
+                           for _ in xrange(workers)]
+                processed = sum(result.get() for result in results)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            try:
+                processed = process_jobs(batch_size, lease_seconds)
+            except TooManyGeocodeRequests:
+                processed = None
+                log.warning('Ran out of geocoding requests; stopping')
+
+        if processed is not None:
+            log.info('Processed %s metadata jobs' % (processed,))
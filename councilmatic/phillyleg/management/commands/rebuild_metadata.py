@@ -0,0 +1,203 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max, Min
+import json
+import logging
+import multiprocessing
+import optparse
+import os
+import time
+
+from phillyleg.models import LegFile, LegMinutes
+from utils import TooManyGeocodeRequests
+
+# The kinds of metadata that each model has.
+KINDS = {
+    'legfile': LegFile.METADATA_KINDS,
+    'legminutes': LegMinutes.METADATA_KINDS,
+}
+
+MODELS = {
+    'legfile': LegFile,
+    'legminutes': LegMinutes,
+}
+
+
+def plan_chunks(chunk_size):
+    """
+    Split the primary keys of each model into ranges of ``chunk_size``.
+    Returns a list of (model name, start, end) tuples, with ``end`` excluded.
+    """
+    chunks = []
+    for model_name in sorted(MODELS):
+        bounds = MODELS[model_name].objects.aggregate(low=Min('pk'), high=Max('pk'))
+        if bounds['low'] is None:
+            continue
+        for start in xrange(bounds['low'], bounds['high'] + 1, chunk_size):
+            chunks.append((model_name, start, start + chunk_size))
+    return chunks
+
+
+def rebuild_chunk(model_name, start, end, kinds):
+    """
+    Rebuild the given kinds of metadata for the objects with primary keys in
+    [start, end), in one transaction.  Returns the number of objects rebuilt.
+    """
+    kinds = [kind for kind in kinds if kind in KINDS[model_name]]
+    if not kinds:
+        return 0
+
+    objects = MODELS[model_name].objects.filter(pk__gte=start, pk__lt=end)
+    if model_name == 'legfile':
+        # The attachments' text is part of the files' text.
+        objects = objects.prefetch_related('attachments')
+
+    count = 0
+    with transaction.commit_on_success():
+        for obj in objects:
+            obj.update_metadata(**dict(('update_' + kind, kind in kinds)
+                                       for kind in KINDS[model_name]))
+            count += 1
+    return count
+
+
+def run_chunk(chunk_and_kinds):
+    (model_name, start, end), kinds = chunk_and_kinds
+    return (model_name, start, end), rebuild_chunk(model_name, start, end, kinds)
+
+
+def init_worker():
+    # Each worker process needs its own database connection.
+    connection.close()
+
+
+class RebuildProgress (object):
+    """
+    The chunks of a rebuild that are done, kept in a JSON file so that an
+    interrupted rebuild can pick up where it left off.  Progress only counts
+    for a rebuild of the same kinds of metadata, in the same size of chunks.
+    """
+
+    def __init__(self, path, kinds, chunk_size):
+        self.path = path
+        self.kinds = sorted(kinds)
+        self.chunk_size = chunk_size
+        self.done = set()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path) as progress_file:
+            state = json.load(progress_file)
+        if state.get('kinds') != self.kinds or state.get('chunk_size') != self.chunk_size:
+            return False
+
+        self.done = set(tuple(chunk) for chunk in state['done'])
+        return True
+
+    def save(self):
+        # Write the whole file aside and move it into place, so that an
+        # interruption never leaves it half written.
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as progress_file:
+            json.dump({'kinds': self.kinds, 'chunk_size': self.chunk_size,
+                       'done': sorted(self.done)}, progress_file)
+        os.rename(temp_path, self.path)
+
+    def mark_done(self, chunk):
+        self.done.add(tuple(chunk))
+        self.save()
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Command(BaseCommand):
+    help = ("Derive the metadata (words, mentions, locations and topics) of "
+            "all legislative files and minutes again, in chunks of primary "
+            "keys spread across a pool of processes.  Progress is kept in a "
+            "file, so an interrupted rebuild picks up where it left off.")
+    option_list = BaseCommand.option_list + (
+            optparse.make_option('--kinds',
+                action='store',
+                dest='kinds',
+                default='words,mentions,locations,topics',
+                help='Comma-separated kinds of metadata to rebuild'),
+            optparse.make_option('--workers',
+                action='store',
+                type='int',
+                dest='workers',
+                default=1,
+                help='Number of processes to rebuild with'),
+            optparse.make_option('--chunk-size',
+                action='store',
+                type='int',
+                dest='chunk_size',
+                default=200,
+                help='Number of primary keys in each chunk'),
+            optparse.make_option('--progress-file',
+                action='store',
+                dest='progress_file',
+                default='rebuild_metadata.progress.json',
+                help='File to keep track of finished chunks in'),
+            optparse.make_option('--restart',
+                action='store_true',
+                dest='restart',
+                default=False,
+                help='Ignore the progress of an earlier rebuild'),
+            )
+
+    def handle(self, *args, **options):
+        log = logging.getLogger()
+        log.setLevel(logging.INFO)
+
+        kinds = [kind.strip() for kind in options['kinds'].split(',') if kind.strip()]
+        unknown = set(kinds) - set(KINDS['legfile'])
+        if not kinds or unknown:
+            raise CommandError('Choose kinds from %s.' % (', '.join(KINDS['legfile']),))
+
+        progress = RebuildProgress(options['progress_file'], kinds,
+                                   options['chunk_size'])
+        if options['restart']:
+            progress.clear()
+        elif progress.load():
+            log.info('Resuming; %s chunks are already done' % (len(progress.done),))
+
+        chunks = [chunk for chunk in plan_chunks(options['chunk_size'])
+                  if chunk not in progress.done]
+
+        start_time = time.time()
+        rebuilt = 0
+        try:
+            for chunk, count in self.run_chunks(chunks, kinds, options['workers']):
+                progress.mark_done(chunk)
+                rebuilt += count
+                log.info('Rebuilt %s %s objects with keys %s to %s' %
+                         (count, chunk[0], chunk[1], chunk[2] - 1))
+        except TooManyGeocodeRequests:
+            log.warning('Ran out of geocoding requests; run again later to '
+                        'finish the rebuild')
+            return
+
+        # A finished rebuild has nothing to resume.
+        progress.clear()
+        self.stdout.write('Rebuilt metadata for %s objects in %.1fs\n' % (
+            rebuilt, time.time() - start_time))
+
+    def run_chunks(self, chunks, kinds, workers):
+        if workers <= 1:
+            for chunk in chunks:
+                yield run_chunk((chunk, kinds))
+            return
+
+        # Don't share this process's connection with the workers.
+        connection.close()
+        pool = multiprocessing.Pool(workers, init_worker)
+        try:
+            for result in pool.imap_unordered(run_chunk, [(chunk, kinds) for chunk in chunks]):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
@@ -6,55 +6,194 @@
 #will send out daily email for users - first will read all keywords
 #create text files, then email text files to all each user subscribed.
 
-from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
-from django.core.exceptions import ImproperlyConfigured
-from django.utils.importlib import import_module
 import django
+import itertools
 import logging
 import optparse
 import sys
 
 from phillyleg.management.scraper_wrappers import CouncilmaticDataStoreWrapper
 from phillyleg.management.scraper_wrappers import PhillyLegistarSiteWrapper
+from phillyleg.management.scraper_wrappers import load_scraper
+from phillyleg.management.scraper_wrappers.extraction import AttachmentTextExtractor
+from phillyleg.management.scraper_wrappers.extraction import get_text_store_root
+from phillyleg.management.scraper_wrappers.pipeline import ScrapePipeline
+from phillyleg.management.scraper_wrappers.pipeline import chunked
+from phillyleg.management.scraper_wrappers.pipeline import fetch_serially
+from phillyleg.management.scraper_wrappers.pipeline import scrape_serially
+from phillyleg.management.scraper_wrappers.scheduler import RefreshScheduler
+from phillyleg.management.scraper_wrappers.sharding import KeyRangeWorker
 from utils import TooManyGeocodeRequests
+from utils import stats
 
-def import_leg_files(start_key, source, ds, save_key=False):
+log = logging.getLogger(__name__)
+
+def concurrent_workers(source, workers):
+    """
+    Get the number of workers to scrape the source with: the number asked
+    for, if the source can be scraped concurrently, and otherwise one.
+    """
+    if workers > 1 and not getattr(source, 'allows_concurrent_scraping', False):
+        log.warning('%s cannot be scraped concurrently; using one worker.' %
+                    (type(source).__name__,))
+        workers = 1
+    return workers
+
+
+def import_leg_files(start_key, source, ds, save_key=False, workers=1,
+                     batch_size=1, extractor=None, max_files=None):
     """
     Imports the legislative filings starting at the given key, and going either
     until there it reaches the end of the available records, or the script times
     out.
+
+    If more than one worker is requested, files are fetched and parsed by a
+    pool of threads while they are saved here, in key order.  If a batch size
+    is given, that many files are saved in each database transaction.  If an
+    attachment text extractor is given, the text of each saved file's
+    documents is extracted in the background and filled in as it's ready.
+    If a maximum number of files is given, stop after that many.
+    """
+    workers = concurrent_workers(source, workers)
+    if workers > 1:
+        scraped_files = ScrapePipeline(source, workers).scrape(start_key)
+    else:
+        scraped_files = scrape_serially(source, start_key)
+
+    if max_files is not None:
+        scraped_files = itertools.islice(scraped_files, max_files)
+
+    return save_scraped_files(scraped_files, ds, save_key=save_key,
+                              batch_size=batch_size, extractor=extractor)
+
+
+def refresh_leg_files(keys, source, ds, workers=1, batch_size=1,
+                      extractor=None):
+    """
+    Re-scrapes and saves the legislative filings with the given keys, in
+    order, with as many workers and in batches of the given size, like
+    ``import_leg_files``.  Returns the number of files saved.
+    """
+    workers = concurrent_workers(source, workers)
+    if workers > 1:
+        scraped_files = ScrapePipeline(source, workers).fetch(keys)
+    else:
+        scraped_files = fetch_serially(source, keys)
+
+    return save_scraped_files(scraped_files, ds, batch_size=batch_size,
+                              extractor=extractor)
+
+
+def save_scraped_files(scraped_files, ds, save_key=False, batch_size=1,
+                       extractor=None):
     """
-    curr_key = start_key
-    while True:
-        curr_key, source_obj = source.check_for_new_content(curr_key)
+    Save each ``(key, scraped)`` pair from the given iterable, as it comes,
+    in batches of the given size.  Files that couldn't be found (i.e., with
+    nothing scraped) are skipped.  Returns the number of files saved.
+
+    If ``save_key`` is True, the continuation key is moved up as files are
+    saved, but never past a file that failed to save, so that the next run
+    tries it again.
+    """
+    def found(scraped_files):
+        for key, scraped in scraped_files:
+            stats.incr('files_scraped')
+            if scraped is None:
+                log.warning('Legfile with key %r could not be found' % (key,))
+                continue
+            yield key, scraped
+
+    # The stored files may have changed since the last run (e.g., by another
+    # process), so don't go by what was cached then.
+    ds.reset_caches()
+
+    saved = 0
+    if batch_size > 1:
+        for batch in chunked(found(scraped_files), batch_size):
+            failed_keys = ds.save_legis_batch([scraped for _, scraped in batch])
+            saved += len(batch) - len(failed_keys)
+
+            if save_key and failed_keys:
+                # Keep the key just before the first failure, and stop
+                # moving it for the rest of the run.
+                saved_keys = list(itertools.takewhile(
+                    lambda key: int(key) not in failed_keys,
+                    [key for key, _ in batch]))
+                if saved_keys:
+                    ds.save_continuation_key(saved_keys[-1])
+                log.warning('Holding the continuation key before %s, which '
+                            'failed to save' % (failed_keys[0],))
+                save_key = False
+            elif save_key:
+                ds.save_continuation_key(batch[-1][0])
+
+            if extractor is not None:
+                for _, (record, attachments, actions, minutes) in batch:
+                    extractor.queue_missing_text(attachments + minutes)
+                save_extracted_text(extractor, ds)
+
+    else:
+        for curr_key, (record, attachments, actions, minutes) in found(scraped_files):
+            ds.save_legis_file(record, attachments, actions, minutes)
+            saved += 1
+            if save_key:
+                ds.save_continuation_key(curr_key)
+
+            if extractor is not None:
+                extractor.queue_missing_text(attachments + minutes)
+                save_extracted_text(extractor, ds)
+
+    return saved
+
 
-        if source_obj is None:
-            break
+def prepare_new_file_search(source, ds, full_sweep=False):
+    """
+    Tell the source what's already known, so that it can skip it when looking
+    for new files.
+    """
+    # Sources that can search by date only look at what's new since the
+    # last completed run, unless a full sweep is asked for.
+    if full_sweep:
+        if hasattr(source, 'set_full_sweep'):
+            source.set_full_sweep()
+    elif hasattr(source, 'set_high_water_mark'):
+        source.set_high_water_mark(ds.get_high_water_mark())
 
-        record, attachments, actions, minutes = \
-            source.scrape_legis_file(curr_key, source_obj)
-        ds.save_legis_file(record, attachments, actions, minutes)
-        if save_key:
-            ds.save_continuation_key(curr_key)
+    # Sources that can tell from a listing which files have changed skip
+    # the ones that haven't.
+    if hasattr(source, 'init_summary_fingerprints'):
+        source.init_summary_fingerprints(ds.get_summary_fingerprints())
 
 
-def load_scraper():
-    scraper_name = settings.LEGISLATION['SCRAPER']
-    module, attr = scraper_name.rsplit('.', 1)
+def import_new_files(source, ds, workers=1, batch_size=1, extractor=None,
+                     max_files=None):
+    """
+    Imports the legislative filings that are newer than any in the datastore.
+    """
+    curr_key = ds.get_latest_key()
+    import_leg_files(curr_key, source, ds, workers=workers,
+                     batch_size=batch_size, extractor=extractor,
+                     max_files=max_files)
 
-    try:
-        mod = import_module(module)
-    except ImportError as e:
-        raise ImproperlyConfigured('Error importing legislation scraper %s: "%s"' % (scraper_name, e))
+    # Move the high-water mark up to the newest file seen, unless we
+    # stopped before getting through all of them.
+    newest_date = getattr(source, 'newest_date_seen', None)
+    if newest_date and max_files is None:
+        high_water_mark = ds.get_high_water_mark()
+        if high_water_mark is None or newest_date > high_water_mark:
+            ds.save_high_water_mark(newest_date)
 
-    try:
-        ScraperWrapper = getattr(mod, attr)
-    except AttributeError as e:
-        raise ImproperlyConfigured('Error importing legislation scraper %s: "%s"' % (scraper_name, e))
 
-    options = settings.LEGISLATION['SCRAPER_OPTIONS']
-    return ScraperWrapper(**options)
+def save_extracted_text(extractor, ds, wait=False):
+    """
+    Save the document text that the extractor has finished with.  If ``wait``
+    is True, wait for all of the queued documents to finish.
+    """
+    extracted = extractor.finish() if wait else extractor.completed()
+    for url, text in extracted:
+        with stats.timed('save_pdf_text'):
+            ds.save_pdf_text(url, text)
 
 
 class Command(BaseCommand):
@@ -64,7 +203,91 @@ class Command(BaseCommand):
                 action='store_true',
                 dest='update_files',
                 default=False,
-                help='Update existing files as well'),
+                help='Update existing files as well, starting with the ones '
+                     'most likely to have changed'),
+            optparse.make_option('--refresh-limit',
+                action='store',
+                type='int',
+                dest='refresh_limit',
+                default=500,
+                help='Maximum number of existing files to update'),
+            optparse.make_option('--time-budget',
+                action='store',
+                type='int',
+                dest='time_budget',
+                default=None,
+                help='Stop updating existing files after this many seconds'),
+            optparse.make_option('--request-budget',
+                action='store',
+                type='int',
+                dest='request_budget',
+                default=None,
+                help='Stop updating existing files after this many HTTP '
+                     'requests'),
+            optparse.make_option('--full-sweep',
+                action='store_true',
+                dest='full_sweep',
+                default=False,
+                help='Look through all of the legislation on the site for new '
+                     'files, instead of just what has been introduced since '
+                     'the last run'),
+            optparse.make_option('--plan-ranges',
+                action='store_true',
+                dest='plan_ranges',
+                default=False,
+                help='Split all of the stored keys into ranges for '
+                     '--range-worker processes to update, and exit'),
+            optparse.make_option('--range-size',
+                action='store',
+                type='int',
+                dest='range_size',
+                default=500,
+                help='Number of keys in each range planned by --plan-ranges'),
+            optparse.make_option('--range-worker',
+                action='store_true',
+                dest='range_worker',
+                default=False,
+                help='Claim and update planned key ranges until there are '
+                     'none left'),
+            optparse.make_option('--lease-seconds',
+                action='store',
+                type='int',
+                dest='lease_seconds',
+                default=1800,
+                help='How long a range worker may go without reporting '
+                     'progress before its range is given to another worker'),
+            optparse.make_option('--max-files',
+                action='store',
+                type='int',
+                dest='max_files',
+                default=None,
+                help='Stop after scraping this many new files'),
+            optparse.make_option('--stats-file',
+                action='store',
+                dest='stats_file',
+                default=None,
+                help='Write a JSON summary of the time spent in each stage '
+                     'of the run to this file'),
+            optparse.make_option('--workers',
+                action='store',
+                type='int',
+                dest='workers',
+                default=1,
+                help='Number of threads to use for fetching and parsing files'),
+            optparse.make_option('--batch-size',
+                action='store',
+                type='int',
+                dest='batch_size',
+                default=1,
+                help='Number of files to save in each database transaction'),
+            optparse.make_option('--extract-processes',
+                action='store',
+                type='int',
+                dest='extract_processes',
+                default=0,
+                help='Number of processes to use for extracting attachment '
+                     'text in the background (by default, text is extracted '
+                     'while scraping)'),
             )
 
 
@@ -82,27 +305,108 @@ class Command(BaseCommand):
         # process.  If we had to redownload all of them every time we scraped,
         # it would take a really long time to refresh all of the old stuff.  So
         # that PDFs that have already been downloaded won't be again, seed the
-        # source cache with that data.
-        #
-        # Hopefully this won't be too much of a burden on memory :).
-        source.init_pdf_cache(ds.pdf_mapping)
+        # source cache with that data.  The text is looked up in the database
+        # lazily, as the source comes across each URL.
+        pdf_mapping = ds.pdf_mapping
+        source.init_pdf_cache(pdf_mapping)
+
+        # Optionally, leave the attachment text to a pool of extraction
+        # processes instead of getting it while scraping.
+        self.extractor = None
+        if options['extract_processes']:
+            self.extractor = AttachmentTextExtractor(
+                get_text_store_root(), options['extract_processes'],
+                known_text=pdf_mapping)
+            source.defer_pdf_text = True
 
         update_files = options['update_files']
+        self.workers = options['workers']
+        self.batch_size = options['batch_size']
+        self.refresh_limit = options['refresh_limit']
+        self.time_budget = options['time_budget']
+        self.request_budget = options['request_budget']
+        self.max_files = options['max_files']
+
+        prepare_new_file_search(source, ds, options['full_sweep'])
+
+        # Keep track of where the time goes.
+        run_stats = self.run_stats = stats.StageStats()
+        stats.activate(run_stats)
 
         try:
-            self._get_new_files()
-            if update_files:
-                self._get_updated_files()
+            if options['plan_ranges']:
+                self._plan_key_ranges(options['range_size'])
+            elif options['range_worker']:
+                self._update_key_ranges(options['lease_seconds'])
+            else:
+                self._get_new_files()
+                if update_files:
+                    self._get_updated_files()
+
+            if self.extractor is not None:
+                save_extracted_text(self.extractor, ds, wait=True)
         except TooManyGeocodeRequests:
             sys.exit(0)
+        finally:
+            stats.deactivate()
+            run_stats.finish()
+
+            # Let the source shut down any threads of its own.
+            if hasattr(source, 'close'):
+                source.close()
+
+            for name, cache_stats in ds.cache_stats().items():
+                run_stats.set_cache_stats(name, cache_stats)
+            run_stats.set_cache_stats('pdf_text_cache', pdf_mapping.cache.stats())
+
+            self.stdout.write(run_stats.format_summary() + '\n')
+            if options['stats_file']:
+                run_stats.write_json(options['stats_file'])
+
+    def _plan_key_ranges(self, range_size):
+        ds = self.ds
+
+        end_key = ds.get_latest_key() + 1
+        planned = ds.plan_key_leases(ds.STARTING_KEY, end_key, range_size)
+        if planned:
+            log.info('Planned %s ranges of keys up to %s' % (planned, end_key))
+        else:
+            log.info('The ranges from the last plan are not finished yet')
+
+    def _update_key_ranges(self, lease_seconds):
+        if not hasattr(self.source, 'fetch_legis_file'):
+            raise CommandError('%s cannot fetch files by key, so it cannot be '
+                               'updated in ranges.' % (type(self.source).__name__,))
+
+        worker = KeyRangeWorker(self.source, self.ds,
+                                lease_seconds=lease_seconds,
+                                batch_size=self.batch_size,
+                                extractor=self.extractor)
+        completed = worker.run()
+        log.info('Finished %s ranges of keys' % (completed,))
 
     def _get_updated_files(self):
         ds = self.ds
         source = self.source
 
-        # Continue updating the entire datastore
+        # Sources that can fetch a file by its key get the files most likely
+        # to have changed refreshed first.
+        if hasattr(source, 'fetch_legis_file'):
+            scheduler = RefreshScheduler()
+            keys = scheduler.rank(ds.get_refresh_candidates(), self.refresh_limit)
+            refreshed = refresh_leg_files(
+                scheduler.within_budget(keys, time_budget=self.time_budget,
+                                        request_budget=self.request_budget),
+                source, ds, workers=self.workers, batch_size=self.batch_size,
+                extractor=self.extractor)
+            log.info('Refreshed %s of %s stale files' % (refreshed, len(keys)))
+            return
+
+        # Otherwise, continue updating the entire datastore
         cont_key = ds.get_continuation_key()
-        import_leg_files(cont_key, source, ds, save_key=True)
+        import_leg_files(cont_key, source, ds, save_key=True,
+                         workers=self.workers, batch_size=self.batch_size,
+                         extractor=self.extractor)
 
         # If we've made it here, then we have all the latest filings, and we have gone
         # through and updated the entire datastore.  Now, reset the continuation key to
@@ -115,6 +419,6 @@ class Command(BaseCommand):
         ds = self.ds
         source = self.source
 
-        # Get the latest filings
-        curr_key = ds.get_latest_key()
-        import_leg_files(curr_key, source, ds)
+        import_new_files(source, ds, workers=self.workers,
+                         batch_size=self.batch_size, extractor=self.extractor,
+                         max_files=self.max_files)
@@ -0,0 +1,166 @@
+import datetime
+import errno
+import logging
+import optparse
+import os
+import signal
+import sys
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from django.db.utils import DatabaseError
+
+from ebdata.utils.daemon import Daemon
+from phillyleg.management.commands.updatelegfiles import import_new_files
+from phillyleg.management.commands.updatelegfiles import prepare_new_file_search
+from phillyleg.management.scraper_wrappers import CouncilmaticDataStoreWrapper
+from phillyleg.management.scraper_wrappers import load_scraper
+from phillyleg.management.scraper_wrappers.scheduler import PollInterval
+from phillyleg.models import LegFile
+from utils import TooManyGeocodeRequests
+
+log = logging.getLogger(__name__)
+
+
+def update_search_index(legfiles):
+    """
+    Add the given legislative files to the search index, or update them there.
+    """
+    from haystack import connections
+    search = connections['default']
+    index = search.get_unified_index().get_index(LegFile)
+    search.get_backend().update(index, legfiles)
+
+
+class LegFileWatcher (Daemon):
+    """
+    Looks for new legislative files every so often, and indexes them for
+    search as soon as they're saved.  The source, the datastore, and the
+    database connection are kept for as long as the daemon runs, instead of
+    being set up again for each run.  Their caches are emptied before each
+    poll, since other processes (e.g., updatelegfiles from cron) may have
+    changed the stored files in the meantime.
+    """
+
+    def __init__(self, pidfile, poll_interval, **kwargs):
+        super(LegFileWatcher, self).__init__(pidfile, **kwargs)
+        self.poll_interval = poll_interval
+        self.ds = None
+        self.source = None
+        self.pdf_mapping = None
+
+    def run(self):
+        # Exit cleanly when stopped, so that the pid file is removed.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        self.ds = CouncilmaticDataStoreWrapper()
+        self.source = load_scraper()
+        self.pdf_mapping = self.ds.pdf_mapping
+        self.source.init_pdf_cache(self.pdf_mapping)
+
+        while True:
+            found = self.poll()
+            interval = self.poll_interval.next(found)
+            log.info('Found %s new or changed files; polling again in %s seconds' %
+                     (found, interval))
+            time.sleep(interval)
+
+    def poll(self):
+        """
+        Import any new files, and index the ones that were saved.  Returns
+        the number of files saved.
+        """
+        started = datetime.datetime.now()
+        self.ds.reset_caches()
+        self.pdf_mapping.clear()
+
+        try:
+            prepare_new_file_search(self.source, self.ds)
+            import_new_files(self.source, self.ds)
+        except TooManyGeocodeRequests:
+            log.warning('Ran out of geocoding requests; continuing next time')
+        except DatabaseError:
+            # The connection may have gone away; start over with a new one.
+            log.exception('Database error while importing new files')
+            connection.close()
+            return 0
+        except Exception:
+            log.exception('Error while importing new files')
+        finally:
+            reset_queries()
+
+        saved = LegFile.objects.filter(updated_datetime__gte=started)
+        found = saved.count()
+        if found:
+            update_search_index(saved)
+        return found
+
+    def stop(self):
+        # The daemon removes its own pid file as it exits, so it may already
+        # be gone by the time Daemon.stop goes to remove it.
+        try:
+            super(LegFileWatcher, self).stop()
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class Command(BaseCommand):
+    help = ("Run a daemon that imports new legislative files as they show up, "
+            "and indexes them for search right away.")
+    args = 'start|stop|restart'
+    option_list = BaseCommand.option_list + (
+            optparse.make_option('--pid-file',
+                action='store',
+                dest='pid_file',
+                default='/tmp/watchlegfiles.pid',
+                help='File to keep the daemon process id in'),
+            optparse.make_option('--log-file',
+                action='store',
+                dest='log_file',
+                default='/dev/null',
+                help='File to send the daemon\'s output to'),
+            optparse.make_option('--foreground',
+                action='store_true',
+                dest='foreground',
+                default=False,
+                help='Run in the foreground instead of detaching'),
+            optparse.make_option('--min-interval',
+                action='store',
+                type='int',
+                dest='min_interval',
+                default=60,
+                help='Seconds to wait between polls while new files are '
+                     'turning up'),
+            optparse.make_option('--max-interval',
+                action='store',
+                type='int',
+                dest='max_interval',
+                default=3600,
+                help='Longest number of seconds to wait between polls when '
+                     'nothing is turning up'),
+            )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in ('start', 'stop', 'restart'):
+            raise CommandError('Give one of start, stop or restart.')
+
+        logging.getLogger().setLevel(logging.INFO)
+
+        poll_interval = PollInterval(options['min_interval'],
+                                     options['max_interval'])
+        # The daemon changes to the root directory when it detaches.
+        log_file = os.path.abspath(options['log_file'])
+        watcher = LegFileWatcher(os.path.abspath(options['pid_file']),
+                                 poll_interval, stdout=log_file, stderr=log_file)
+
+        # Don't carry a database connection across the fork.
+        connection.close()
+
+        if args[0] == 'start':
+            watcher.start(debug=options['foreground'])
+        elif args[0] == 'stop':
+            watcher.stop()
+        else:
+            watcher.stop()
+            watcher.start(debug=options['foreground'])
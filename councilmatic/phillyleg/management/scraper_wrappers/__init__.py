@@ -1,6 +1,32 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
 from sources.insite_scraper import PhillyLegistarSiteWrapper
 from sources.scraperwiki_db import ScraperWikiSourceWrapper
 from sources.legistar_api import LegistarApiWrapper
 
 from stores.councilmatic_orm import CouncilmaticDataStoreWrapper
 from stores.scraperwiki_db import ScraperWikiDataStoreWrapper
+
+
+def load_scraper():
+    """
+    Create the legislation source configured by the ``SCRAPER`` and
+    ``SCRAPER_OPTIONS`` legislation settings.
+    """
+    scraper_name = settings.LEGISLATION['SCRAPER']
+    module, attr = scraper_name.rsplit('.', 1)
+
+    try:
+        mod = import_module(module)
+    except ImportError as e:
+        raise ImproperlyConfigured('Error importing legislation scraper %s: "%s"' % (scraper_name, e))
+
+    try:
+        ScraperWrapper = getattr(mod, attr)
+    except AttributeError as e:
+        raise ImproperlyConfigured('Error importing legislation scraper %s: "%s"' % (scraper_name, e))
+
+    options = settings.LEGISLATION['SCRAPER_OPTIONS']
+    return ScraperWrapper(**options)
@@ -0,0 +1,175 @@
+import codecs
+import hashlib
+import logging
+import os
+import tempfile
+import urllib2
+import utils
+from bs4 import BeautifulSoup
+from django.conf import settings
+from multiprocessing import Pool
+from phillyleg.management.scraper_wrappers.http_session import get_session
+
+log = logging.getLogger(__name__)
+
+
+def get_text_store_root():
+    """
+    Get the directory where extracted PDF text is stored, from the
+    ``PDF_TEXT_DIR`` legislation setting.
+    """
+    default_root = os.path.join(tempfile.gettempdir(), 'councilmatic-pdf-text')
+    return settings.LEGISLATION.get('PDF_TEXT_DIR', default_root)
+
+
+class PdfTextStore (object):
+    """
+    An on-disk store of the text extracted from PDFs, keyed by the SHA-256
+    digest of the PDF data.  Identical PDFs attached to many files only have
+    to be converted once.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def get_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest + '.txt')
+
+    def get(self, digest):
+        try:
+            with codecs.open(self.get_path(digest), encoding='utf-8') as text_file:
+                return text_file.read()
+        except IOError:
+            return None
+
+    def put(self, digest, text):
+        path = self.get_path(digest)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+
+        # Write to a temporary file first so that other processes never see a
+        # partially written text file.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as text_file:
+            text_file.write(text.encode('utf-8'))
+        os.rename(tmp_path, path)
+
+
+def pdf_data_to_text(pdf_data):
+    """
+    Convert the given PDF data to text.  Data that isn't a PDF (e.g., Word
+    documents or images) has no text.
+    """
+    if not pdf_data.startswith('%PDF'):
+        return u''
+
+    soup = BeautifulSoup(utils.pdftoxml(pdf_data))
+    root_node = soup.find('pdf2xml')
+    return root_node.text if root_node else u''
+
+
+def extract_url_text(url, store_root, tries=5):
+    """
+    Download the document at the given URL and extract its text, using the
+    store at the given root to avoid converting the same PDF twice.  Returns
+    a ``(url, text)`` pair, where the text is ``None`` if the document could
+    not be downloaded.
+    """
+    while True:
+        try:
+            pdf_data = get_session().urlopen(url).read()
+            break
+
+        # Protect against removed PDFs, which have no text.
+        except urllib2.HTTPError, err:
+            if err.code == 404:
+                return url, u''
+            log.warning('Received HTTPError %r for url %r' % (err, url))
+            return url, None
+
+        except urllib2.URLError, err:
+            tries -= 1
+            if not tries:
+                log.warning('Ran out of tries for url %r' % (url,))
+                return url, None
+
+    digest = hashlib.sha256(pdf_data).hexdigest()
+    store = PdfTextStore(store_root)
+
+    text = store.get(digest)
+    if text is None:
+        text = pdf_data_to_text(pdf_data)
+        store.put(digest, text)
+
+    return url, text
+
+
+def _extract_url_text(args):
+    # Pool workers need a single, top-level callable.
+    return extract_url_text(*args)
+
+
+class AttachmentTextExtractor (object):
+    """
+    Downloads attachment and minutes documents and extracts their text in a
+    pool of processes, off of the scraping thread.  Queue each URL with
+    ``queue``, and collect the text as it becomes available with
+    ``completed``.  Call ``finish`` to wait for everything that's left.
+    """
+
+    def __init__(self, store_root, processes=2, known_text=None):
+        self.store_root = store_root
+        self.known_text = known_text or {}
+        self.pool = Pool(processes)
+        self.pending = {}
+        self.seen = set()
+
+    def queue(self, url):
+        if url in self.seen:
+            return
+        self.seen.add(url)
+
+        self.pending[url] = self.pool.apply_async(
+            _extract_url_text, [(url, self.store_root)])
+
+    def queue_missing_text(self, records):
+        """
+        Queue the URLs of any attachment or minutes records that don't
+        already have text, either in the record or in the extractor's
+        ``known_text`` mapping from URLs to text.
+        """
+        for record in records:
+            url = record.get('url')
+            if url and not record.get('fulltext') and not self.known_text.get(url):
+                self.queue(url)
+
+    def completed(self, wait=False):
+        """
+        Generate ``(url, text)`` pairs for the documents that have been
+        extracted so far.  If ``wait`` is True, wait for all of them.
+        """
+        for url, result in self.pending.items():
+            if not wait and not result.ready():
+                continue
+
+            del self.pending[url]
+            try:
+                url, text = result.get()
+            except Exception, e:
+                log.warning('Failed to extract text from %r: %s' % (url, e))
+                continue
+
+            if text is not None:
+                yield url, text
+
+    def finish(self):
+        """
+        Wait for all the queued documents, and generate their ``(url, text)``
+        pairs.
+        """
+        self.pool.close()
+        for url, text in self.completed(wait=True):
+            yield url, text
+        self.pool.join()
@@ -0,0 +1,256 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import urllib2
+import requests
+from StringIO import StringIO
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+
+class HttpValidatorCache (object):
+    """
+    An on-disk cache of the last response body for each URL, along with the
+    ``ETag`` and ``Last-Modified`` validators the server sent with it.  Files
+    are named by the SHA-1 digest of the URL.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def get_path(self, url):
+        digest = hashlib.sha1(url).hexdigest()
+        return os.path.join(self.root, digest[:2], digest)
+
+    def get(self, url):
+        """
+        Get a ``(validators, body)`` pair for the given URL, or ``(None, None)``
+        if nothing is cached for it.
+        """
+        path = self.get_path(url)
+        try:
+            with open(path + '.json') as meta_file:
+                validators = json.load(meta_file)
+            with open(path + '.body', 'rb') as body_file:
+                body = body_file.read()
+        except (IOError, ValueError):
+            return None, None
+
+        return validators, body
+
+    def put(self, url, validators, body):
+        path = self.get_path(url)
+        dirname = os.path.dirname(path)
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            pass
+
+        # Write the body before the validators, each to a temporary file
+        # first, so that a reader never finds validators without a body.
+        for suffix, data in [('.body', body),
+                             ('.json', json.dumps(validators))]:
+            fd, tmp_path = tempfile.mkstemp(dir=dirname)
+            with os.fdopen(fd, 'wb') as out_file:
+                out_file.write(data)
+            os.rename(tmp_path, path + suffix)
+
+
+class HttpSession (object):
+    """
+    A shared HTTP client for the scraper sources.  Connections are kept alive
+    and reused, with at most ``max_connections`` open to any one host (extra
+    requests wait for a free connection).  When a ``cache_root`` is given,
+    responses that carry an ``ETag`` or ``Last-Modified`` header are cached
+    there, and later requests for the same URL are made conditional, so that
+    unchanged pages come back as an empty ``304 Not Modified``.  Responses
+    bigger than ``max_cached_size`` bytes (e.g., PDFs and database dumps) are
+    not cached.
+
+    The session keeps count of the requests it makes in ``request_count``.
+    """
+
+    def __init__(self, cache_root=None, max_connections=4, timeout=60,
+                 max_cached_size=1024 * 1024):
+        self.options = dict(cache_root=cache_root,
+                            max_connections=max_connections, timeout=timeout,
+                            max_cached_size=max_cached_size)
+        self.cache = HttpValidatorCache(cache_root) if cache_root else None
+        self.max_cached_size = max_cached_size
+        self.timeout = timeout
+
+        self.request_count = 0
+        self.count_lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max_connections, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url):
+        """
+        Get the body of the document at the given URL.  Raises
+        ``urllib2.HTTPError`` for error responses and ``urllib2.URLError`` if
+        the server could not be reached, just like ``urllib2.urlopen``.
+        """
+        validators, cached_body = (None, None)
+        if self.cache is not None:
+            validators, cached_body = self.cache.get(url)
+
+        headers = {}
+        if validators:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+        with self.count_lock:
+            self.request_count += 1
+
+        try:
+            response = self.session.get(url, headers=headers,
+                                        timeout=self.timeout)
+        except requests.RequestException, e:
+            raise urllib2.URLError(e)
+
+        if response.status_code == 304 and cached_body is not None:
+            log.debug('Not modified: %s' % (url,))
+            return cached_body
+
+        if response.status_code >= 400:
+            raise urllib2.HTTPError(url, response.status_code, response.reason,
+                                    response.headers, StringIO(response.content))
+
+        body = response.content
+        if self.cache is not None and len(body) <= self.max_cached_size:
+            new_validators = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+            if any(new_validators.values()):
+                self.cache.put(url, new_validators, body)
+
+        return body
+
+    def urlopen(self, url):
+        """
+        A stand-in for ``urllib2.urlopen``; returns a file-like object for
+        the document at the given URL.  URLs other than http(s) are handed
+        off to urllib2.
+        """
+        if not url.startswith(('http://', 'https://')):
+            return urllib2.urlopen(url)
+        return StringIO(self.get(url))
+
+    def reopen(self):
+        """
+        Get a session like this one for use in a new process.
+        """
+        return type(self)(**self.options)
+
+
+class HttpFixtureStore (HttpValidatorCache):
+    """
+    A directory of recorded HTTP responses.  Each is stored like a cached
+    response, with the URL and status code in place of the validators.
+    """
+
+
+class RecordingSession (HttpSession):
+    """
+    An HTTP session that saves every response it gets, including error
+    responses, into a fixture directory that a ``ReplaySession`` can serve
+    from later.  Nothing is cached, so everything is recorded in full.
+    """
+
+    def __init__(self, fixture_root, max_connections=4, timeout=60):
+        super(RecordingSession, self).__init__(
+            max_connections=max_connections, timeout=timeout)
+        self.options = dict(fixture_root=fixture_root,
+                            max_connections=max_connections, timeout=timeout)
+        self.fixtures = HttpFixtureStore(fixture_root)
+
+    def get(self, url):
+        try:
+            body = super(RecordingSession, self).get(url)
+        except urllib2.HTTPError, e:
+            self.fixtures.put(url, {'url': url, 'status': e.code}, e.read())
+            raise
+
+        self.fixtures.put(url, {'url': url, 'status': 200}, body)
+        return body
+
+
+class ReplaySession (HttpSession):
+    """
+    An HTTP session that never touches the network, and serves responses from
+    a fixture directory recorded by a ``RecordingSession`` instead.  URLs that
+    weren't recorded get a 404.
+    """
+
+    def __init__(self, fixture_root):
+        self.options = dict(fixture_root=fixture_root)
+        self.fixtures = HttpFixtureStore(fixture_root)
+
+        self.request_count = 0
+        self.count_lock = threading.Lock()
+
+    def get(self, url):
+        with self.count_lock:
+            self.request_count += 1
+
+        recorded, body = self.fixtures.get(url)
+        if recorded is None:
+            log.warning('No recorded response for %s' % (url,))
+            raise urllib2.HTTPError(url, 404, 'Not recorded', {}, StringIO(''))
+
+        if recorded['status'] >= 400:
+            raise urllib2.HTTPError(url, recorded['status'], 'Recorded error',
+                                    {}, StringIO(body))
+        return body
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """
+    Get the HTTP session shared by all the sources in this process.  It is
+    configured by the ``HTTP_CACHE_DIR``, ``HTTP_CACHE_MAX_SIZE`` and
+    ``HTTP_MAX_CONNECTIONS`` legislation settings; responses are only cached
+    if ``HTTP_CACHE_DIR`` is set.
+    """
+    global _session, _session_pid
+
+    with _session_lock:
+        if _session is None:
+            _session = HttpSession(
+                cache_root=settings.LEGISLATION.get('HTTP_CACHE_DIR'),
+                max_connections=settings.LEGISLATION.get('HTTP_MAX_CONNECTIONS', 4),
+                max_cached_size=settings.LEGISLATION.get('HTTP_CACHE_MAX_SIZE', 1024 * 1024))
+            _session_pid = os.getpid()
+
+        # Forked processes (e.g., text extraction workers) shouldn't share
+        # their parent's sockets.
+        elif _session_pid != os.getpid():
+            _session = _session.reopen()
+            _session_pid = os.getpid()
+
+        return _session
+
+def use_session(session):
+    """
+    Make the given session the one shared by all the sources in this process
+    (e.g., to record or replay responses).
+    """
+    global _session, _session_pid
+
+    with _session_lock:
+        _session = session
+        _session_pid = os.getpid()
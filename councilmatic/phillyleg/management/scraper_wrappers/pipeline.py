@@ -0,0 +1,220 @@
+import itertools
+import logging
+import sys
+import threading
+from Queue import Queue
+from django.db import connection
+from utils.stats import timed
+
+log = logging.getLogger(__name__)
+
+
+def chunked(iterable, size):
+    """
+    Group the items from the given iterable into lists of (at most) the given
+    size.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def scrape_serially(source, start_key):
+    """
+    Walk the source from the given key, yielding a ``(key, scraped)`` pair for
+    each legislative file found, where ``scraped`` is the tuple returned by the
+    source's ``scrape_legis_file``.
+    """
+    curr_key = start_key
+    while True:
+        with timed('find'):
+            curr_key, source_obj = source.check_for_new_content(curr_key)
+
+        if source_obj is None:
+            break
+
+        with timed('scrape'):
+            scraped = source.scrape_legis_file(curr_key, source_obj)
+        yield curr_key, scraped
+
+
+def fetch_serially(source, keys):
+    """
+    Fetch the legislative files with the given keys from the source, in order,
+    yielding a ``(key, scraped)`` pair for each, where ``scraped`` is the
+    tuple returned by the source's ``fetch_legis_file`` (None if the file
+    couldn't be found).
+    """
+    for key in keys:
+        with timed('scrape'):
+            scraped = source.fetch_legis_file(key)
+        yield key, scraped
+
+
+class ScrapePipeline (object):
+    """
+    Scrapes legislative files from a source with a pool of worker threads.
+
+    A single producer thread hands out the keys after the start key, and the
+    workers fetch, parse and scrape each one with ``fetch_legis_file``.  The
+    walk stops after ``max_key_gap`` keys in a row turn out to have no file,
+    as ``check_for_new_content`` would.  (A source without a ``max_key_gap``
+    is walked by the producer with ``check_for_new_content``, and the
+    workers call ``scrape_legis_file``.  With ``fetch``, the producer hands
+    out the given keys.)  The scraped files are yielded
+    back to the caller (the single database writer) in the same order that the
+    keys were found, so that continuation keys can be saved as the files are
+    written.
+
+    No more than ``max_pending`` files are ever in flight -- waiting to be
+    scraped, being scraped, or waiting to be written -- so memory stays flat
+    no matter how far the scrapers get ahead of the writer.
+
+    A source may read from the database as it scrapes (e.g., to look up text
+    already extracted from a PDF).  Each thread has its own connection, so
+    the threads close theirs as soon as they're done with a file, rather than
+    leaving it idle in a transaction.
+    """
+
+    _STOP = object()
+
+    def __init__(self, source, workers=4, max_pending=None):
+        self.source = source
+        self.workers = workers
+        self.max_pending = max_pending or workers * 2
+
+    def scrape(self, start_key):
+        """
+        Walk the source from the given key, yielding a ``(key, scraped)``
+        pair for each legislative file found, like ``scrape_serially``.
+        """
+        max_key_gap = getattr(self.source, 'max_key_gap', None)
+        if max_key_gap is not None:
+            return self._walk_keys(start_key, max_key_gap)
+
+        def find():
+            curr_key = start_key
+            while True:
+                with timed('find'):
+                    curr_key, source_obj = self.source.check_for_new_content(curr_key)
+                if source_obj is None:
+                    break
+                yield curr_key, source_obj
+
+        return self._run(find(), self.source.scrape_legis_file)
+
+    def fetch(self, keys):
+        """
+        Fetch the legislative files with the given keys, yielding a
+        ``(key, scraped)`` pair for each, like ``fetch_serially``.  The keys
+        are only drawn from the iterable as there's room for them.
+        """
+        return self._run(((key, None) for key in keys),
+                         lambda key, _: self.source.fetch_legis_file(key))
+
+    def _walk_keys(self, start_key, max_key_gap):
+        # The files come back in key order, so the keys without files can be
+        # counted off just as check_for_new_content would.
+        fetched = self.fetch(itertools.count(start_key + 1))
+        try:
+            missing = 0
+            for key, scraped in fetched:
+                if scraped is None:
+                    missing += 1
+                    if missing >= max_key_gap:
+                        break
+                else:
+                    missing = 0
+                    yield key, scraped
+        finally:
+            fetched.close()
+
+    def _run(self, found, scrape):
+        tasks = Queue()
+        results = Queue()
+        slots = threading.Semaphore(self.max_pending)
+        stopped = threading.Event()
+        found = iter(found)
+
+        def produce():
+            seq = 0
+            try:
+                while not stopped.is_set():
+                    slots.acquire()
+                    if stopped.is_set():
+                        break
+
+                    try:
+                        key, source_obj = next(found)
+                    except StopIteration:
+                        break
+
+                    tasks.put((seq, key, source_obj))
+                    seq += 1
+            except Exception:
+                results.put((seq, None, None, sys.exc_info()))
+                seq += 1
+            finally:
+                connection.close()
+                results.put((seq, self._STOP, None, None))
+                for _ in xrange(self.workers):
+                    tasks.put(self._STOP)
+
+        def work():
+            while True:
+                task = tasks.get()
+                if task is self._STOP:
+                    break
+
+                seq, key, source_obj = task
+                if stopped.is_set():
+                    continue
+
+                try:
+                    with timed('scrape'):
+                        scraped = scrape(key, source_obj)
+                    result = (seq, key, scraped, None)
+                except Exception:
+                    result = (seq, key, None, sys.exc_info())
+
+                connection.close()
+                results.put(result)
+
+        threads = [threading.Thread(target=produce)]
+        threads += [threading.Thread(target=work) for _ in xrange(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        # Results may come back out of order; hold on to the early ones until
+        # the files before them have been handed off.
+        waiting = {}
+        next_seq = 0
+        try:
+            while True:
+                while next_seq not in waiting:
+                    seq, key, scraped, exc_info = results.get()
+                    waiting[seq] = (key, scraped, exc_info)
+
+                key, scraped, exc_info = waiting.pop(next_seq)
+                next_seq += 1
+
+                if key is self._STOP:
+                    break
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                yield key, scraped
+                slots.release()
+
+        finally:
+            # Let the producer and workers wind down, whether we've reached
+            # the end of the source or the writer has bailed out early.
+            stopped.set()
+            slots.release()
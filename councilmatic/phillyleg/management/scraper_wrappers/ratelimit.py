@@ -0,0 +1,98 @@
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket (object):
+    """
+    Allows ``rate`` operations per second on average, with bursts of up to
+    ``capacity`` operations.  ``acquire`` blocks until an operation is
+    allowed.  Safe to share between threads.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = capacity or max(1, self.rate)
+        self.clock = clock
+        self.sleep = sleep
+
+        self.lock = threading.Lock()
+        self.tokens = self.capacity
+        self.updated = clock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            # Sleep outside of the lock, so that other threads can see how
+            # long they have to wait too.
+            self.sleep(wait)
+
+
+class RateLimiter (object):
+    """
+    Keeps a separate token bucket for each host, so that requests to one host
+    don't hold up requests to another.
+    """
+
+    def __init__(self, rate, capacity=None, **bucket_kwargs):
+        self.rate = rate
+        self.capacity = capacity
+        self.bucket_kwargs = bucket_kwargs
+
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def acquire(self, host):
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.capacity, **self.bucket_kwargs)
+                self.buckets[host] = bucket
+
+        bucket.acquire()
+
+
+def backoff_delays(base_delay=1.0, max_delay=360.0):
+    """
+    Generate the delays to wait between successive retries: exponentially
+    increasing up to ``max_delay``, with full jitter so that many clients
+    retrying at once don't all come back at the same time.
+    """
+    attempt = 0
+    while True:
+        yield random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+        attempt += 1
+
+
+def call_with_backoff(func, args=(), retry_on=(Exception,), tries=5,
+                      base_delay=1.0, max_delay=360.0, sleep=time.sleep):
+    """
+    Call the function with the given arguments, retrying with exponential
+    backoff if it raises one of the ``retry_on`` exceptions.  The last
+    exception is re-raised after ``tries`` attempts.
+    """
+    delays = backoff_delays(base_delay, max_delay)
+    for attempt in xrange(tries):
+        try:
+            return func(*args)
+        except retry_on, e:
+            if attempt == tries - 1:
+                raise
+
+            delay = delays.next()
+            log.warning('%s; retrying in %.1f seconds' % (e, delay))
+            sleep(delay)
@@ -0,0 +1,126 @@
+import datetime
+import heapq
+import logging
+import time
+from phillyleg.management.scraper_wrappers.http_session import get_session
+
+log = logging.getLogger(__name__)
+
+
+class RefreshScheduler (object):
+    """
+    Decides which stored legislative files are most worth re-scraping.
+
+    Each file gets a score that estimates how much is likely to have changed
+    since it was last scraped: the time since it was last scraped, weighted by
+    how lively the file is.  Files that have reached a final status change
+    rarely, and files that haven't had an action in a long time are less
+    likely to have one soon than files that are moving this week.
+    """
+
+    settled_statuses = set(['Adopted', 'Approved', 'Passed', 'Failed to Pass',
+                            'Vetoed', 'Withdrawn'])
+    """Statuses of files that are unlikely to change any further."""
+
+    settled_weight = 0.05
+    """How lively a settled file is, relative to one that's still moving."""
+
+    activity_scale_days = 30.0
+    """The number of idle days after which a file is half as lively."""
+
+    never_scraped_days = 3650
+    """The age to give files with no record of when they were scraped."""
+
+    def __init__(self, now=None):
+        self.now = now or datetime.datetime.now()
+
+    def score(self, status, last_activity, last_scraped):
+        """
+        Score a file by its status, the date of its last action (or its
+        introduction), and the time it was last scraped.  Higher scores
+        should be refreshed first.
+        """
+        weight = self.settled_weight if status in self.settled_statuses else 1.0
+
+        if last_activity:
+            idle_days = max((self.now.date() - last_activity).days, 0)
+            weight *= self.activity_scale_days / (self.activity_scale_days + idle_days)
+        else:
+            weight *= self.settled_weight
+
+        if last_scraped:
+            age = self.now - last_scraped
+            age_days = age.days + age.seconds / 86400.0
+        else:
+            age_days = self.never_scraped_days
+
+        return weight * max(age_days, 0)
+
+    def rank(self, candidates, limit=None):
+        """
+        Order the keys of the given candidate files from most to least in
+        need of a refresh, keeping at most ``limit`` of them.  Each candidate
+        is a ``(key, status, intro_date, last_action_date, last_scraped)``
+        tuple, like those from ``CouncilmaticDataStoreWrapper.get_refresh_candidates``.
+        """
+        scored = ((self.score(status, last_action_date or intro_date, last_scraped), key)
+                  for key, status, intro_date, last_action_date, last_scraped
+                  in candidates)
+
+        if limit is None:
+            ranked = sorted(scored, reverse=True)
+        else:
+            ranked = heapq.nlargest(limit, scored)
+
+        return [key for score, key in ranked]
+
+    def within_budget(self, keys, time_budget=None, request_budget=None,
+                      clock=time.time):
+        """
+        Generate the given keys, in order, until either the keys or the budget
+        run out.  The time budget is in seconds, and the request budget counts
+        HTTP requests made through the shared session, from when the first key
+        is asked for.  The budget is checked as each key is asked for, so keys
+        can be handed to a pool of scrapers as there's room for them.
+        """
+        session = get_session()
+        start_time = clock()
+        start_requests = session.request_count
+
+        for count, key in enumerate(keys):
+            if time_budget is not None and clock() - start_time >= time_budget:
+                log.info('Ran out of time after %s files' % (count,))
+                return
+            if request_budget is not None and \
+               session.request_count - start_requests >= request_budget:
+                log.info('Ran out of requests after %s files' % (count,))
+                return
+
+            yield key
+
+
+class PollInterval (object):
+    """
+    Decides how long to wait before looking for new files again.  Whenever a
+    poll turns something up, the next one comes after the ``shortest``
+    interval, since more is likely on the way (e.g., on a council session
+    day).  Each poll that finds nothing backs off by ``backoff`` times, up to
+    the ``longest`` interval.  Intervals are in seconds.
+    """
+
+    def __init__(self, shortest=60, longest=3600, backoff=2.0):
+        self.shortest = shortest
+        self.longest = longest
+        self.backoff = backoff
+        self.current = shortest
+
+    def next(self, found):
+        """
+        Get the interval to wait after a poll that found the given number of
+        new or changed files.
+        """
+        if found:
+            self.current = self.shortest
+        else:
+            self.current = min(self.longest, self.current * self.backoff)
+        return self.current
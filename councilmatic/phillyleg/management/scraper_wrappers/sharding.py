@@ -0,0 +1,103 @@
+import datetime
+import logging
+import os
+import socket
+from phillyleg.management.scraper_wrappers.pipeline import chunked
+from utils.stats import incr, timed
+
+log = logging.getLogger(__name__)
+
+
+def default_owner():
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+class KeyRangeWorker (object):
+    """
+    Scrapes the key ranges leased out by ``plan_key_leases``, one lease at a
+    time, until there are none left.  Any number of workers, in any number of
+    processes or on any number of machines, may share the leases through the
+    database.
+
+    Progress is recorded on the lease after every batch of keys, which also
+    extends the lease.  If a worker dies, its lease expires after
+    ``lease_seconds`` and the next worker to claim it picks up from the last
+    recorded key.  The same goes for a lease with a file that fails to save:
+    its progress is held at that file, and the worker moves on to another
+    lease, leaving this one to be tried again once it expires.  The source
+    must be able to fetch a file by its key.
+    """
+
+    def __init__(self, source, ds, owner=None, lease_seconds=1800,
+                 batch_size=1, extractor=None):
+        self.source = source
+        self.ds = ds
+        self.owner = owner or default_owner()
+        self.lease_duration = datetime.timedelta(seconds=lease_seconds)
+        self.batch_size = batch_size
+        self.extractor = extractor
+
+    def run(self):
+        """
+        Claim and scrape leases until they're all done.  Returns the number
+        of leases completed by this worker.
+        """
+        completed = 0
+        while True:
+            lease = self.ds.claim_key_lease(self.owner, self.lease_duration)
+            if lease is None:
+                return completed
+
+            log.info('%s claimed keys %s to %s, starting at %s' % (
+                self.owner, lease.start_key, lease.end_key, lease.next_key))
+
+            try:
+                finished = self.scrape_lease(lease)
+            except:
+                self.ds.release_key_lease(lease, self.owner)
+                raise
+
+            if finished:
+                self.ds.complete_key_lease(lease, self.owner)
+                completed += 1
+
+    def scrape_lease(self, lease):
+        """
+        Scrape and save the files in the rest of the lease's key range.
+        Returns False if the lease was lost to another worker part way, or if
+        a file failed to save.
+        """
+        for keys in chunked(xrange(lease.next_key, lease.end_key), self.batch_size):
+            scraped_files = []
+            for key in keys:
+                with timed('scrape'):
+                    scraped = self.source.fetch_legis_file(key)
+                if scraped is not None:
+                    incr('files_scraped')
+                    scraped_files.append((key, scraped))
+
+            failed_keys = []
+            if scraped_files:
+                failed_keys = self.ds.save_legis_batch(
+                    [scraped for _, scraped in scraped_files])
+
+            if self.extractor is not None:
+                for key, (record, attachments, actions, minutes) in scraped_files:
+                    if key not in failed_keys:
+                        self.extractor.queue_missing_text(attachments + minutes)
+
+            # Never record progress past a file that failed to save.
+            next_key = failed_keys[0] if failed_keys else keys[-1] + 1
+            if not self.ds.renew_key_lease(lease, self.owner, next_key,
+                                           self.lease_duration):
+                log.warning('%s lost its lease on keys %s to %s' % (
+                    self.owner, lease.start_key, lease.end_key))
+                return False
+
+            if failed_keys:
+                log.warning('%s is holding keys %s to %s at %s, which failed '
+                            'to save' % (self.owner, lease.start_key,
+                                         lease.end_key, next_key))
+                return False
+
+        return True
@@ -1,15 +1,24 @@
+import cookielib
 import datetime
+import hashlib
+import json
 import time
 import httplib
 import logging
 import re
+import threading
 import urllib2
 import utils
 import urlparse
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 from legistar.scraper import LegistarScraper
 from legistar.config import Config, DEFAULT_CONFIG
+from phillyleg.management.scraper_wrappers.ratelimit import RateLimiter
+from phillyleg.management.scraper_wrappers.ratelimit import backoff_delays
+from phillyleg.management.scraper_wrappers.ratelimit import call_with_backoff
+from utils.stats import incr
 
 log = logging.getLogger(__name__)
 
@@ -24,6 +33,24 @@ class HostedLegistarSiteWrapper (object):
     responsible for scraping data out of the site.  The main external point
     of interaction is scrape_legis_file.
 
+    History rows are expanded by a pool of ``history_workers`` threads, each
+    with its own scraper, and no more than ``requests_per_second`` requests
+    are made to the Legistar host across all of them.  The scrapers all share
+    one set of cookies, so the site sees one session.  Call ``close`` when
+    done with the wrapper to shut the pool down.
+
+    New files are found by searching for the legislation introduced since
+    the high-water mark (see ``set_high_water_mark``), less a few days'
+    overlap for files that show up late.  Without a mark, the legislation
+    created before ``created_before`` is swept; a full sweep (see
+    ``set_full_sweep``) looks through everything up to the present.  The newest intro date in the
+    summary rows that come up, whether or not their files needed scraping, is
+    kept in ``newest_date_seen`` for the next mark.
+
+    Summary rows that haven't changed since their file was last scraped (see
+    ``init_summary_fingerprints``) are skipped, unless the file hasn't been
+    scraped in ``summary_refresh_days``.
+
     requires: BeautifulSoup, mechanize
     """
 
@@ -39,8 +66,161 @@ class HostedLegistarSiteWrapper (object):
         self.controlling_body_label = options.pop('controlling_body_label', 'Current Controlling Legislative Body')
         self.version_label = options.pop('version_label', 'Version')
 
-        self.scraper = LegistarScraper(options)
-        self.legislation_summaries =  self.scraper.searchLegislation('', created_before='2012-10-5')
+        self.history_workers = options.pop('history_workers', 4)
+        self.rate_limiter = RateLimiter(options.pop('requests_per_second', 2),
+                                        options.pop('request_burst', None))
+        self.hostname = options.get('hostname')
+
+        # The scrapers keep browser state, so each thread gets its own, but
+        # they share the session cookies.
+        self.scraper_options = options
+        self.scraper_local = threading.local()
+        self.cookie_jar = cookielib.CookieJar()
+        self.history_pool = None
+
+        self.high_water_overlap_days = options.pop('high_water_overlap_days', 7)
+        self.high_water_mark = None
+        self.full_sweep = False
+        self.created_before = options.pop('created_before', '2012-10-5')
+        self.newest_date_seen = None
+        self.newest_date_lock = threading.Lock()
+
+        self.summary_refresh_days = options.pop('summary_refresh_days', 14)
+        self.summary_fingerprints = {}
+
+        self.scraper = self.make_scraper()
+        self._legislation_summaries = None
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        '''Shut down the threads that expand history rows.'''
+        history_pool = getattr(self, 'history_pool', None)
+        if history_pool is not None:
+            self.history_pool = None
+            history_pool.close()
+            history_pool.join()
+
+    def set_high_water_mark(self, date):
+        '''Only look for files introduced since (around) the given date.'''
+        self.high_water_mark = date
+        self._legislation_summaries = None
+
+    def set_full_sweep(self):
+        '''Look for files among all of the legislation on the site, up to
+           the present, whatever the high-water mark.'''
+        self.full_sweep = True
+        self._legislation_summaries = None
+
+    @property
+    def legislation_summaries(self):
+        '''The search results to look for new files in, fetched lazily.'''
+        if self._legislation_summaries is None:
+            if self.full_sweep:
+                # Bound the search by tomorrow, so that the files created
+                # today are in it.
+                window_end = datetime.date.today() + datetime.timedelta(days=1)
+                log.info('Searching all legislation created before %s' % (window_end,))
+                self._legislation_summaries = self.scraper.searchLegislation(
+                    '', created_before=window_end.strftime('%Y-%m-%d'))
+            elif self.high_water_mark:
+                window_start = self.high_water_mark - datetime.timedelta(days=self.high_water_overlap_days)
+                log.info('Searching for legislation created since %s' % (window_start,))
+                self._legislation_summaries = self.scraper.searchLegislation(
+                    '', created_after=window_start.strftime('%Y-%m-%d'))
+            else:
+                log.info('Searching legislation created before %s' % (self.created_before,))
+                self._legislation_summaries = self.scraper.searchLegislation(
+                    '', created_before=self.created_before)
+        return self._legislation_summaries
+
+    def note_summary_date(self, summary):
+        '''Move ``newest_date_seen`` up to the summary row's intro date.'''
+        try:
+            intro_date = self.convert_date(summary.get(self.intro_date_label))
+        except ValueError:
+            return
+
+        with self.newest_date_lock:
+            if intro_date and (self.newest_date_seen is None or
+                               intro_date > self.newest_date_seen):
+                self.newest_date_seen = intro_date
+
+    def init_summary_fingerprints(self, summary_fingerprints):
+        '''Seed the fingerprints of the summary rows of the stored files,
+           as a mapping from key to ``(fingerprint, last_scraped)``.'''
+        self.summary_fingerprints = summary_fingerprints
+
+    def get_summary_key(self, summary):
+        parsed_url = urlparse.urlparse(summary['URL'])
+        return urlparse.parse_qs(parsed_url.query)['ID'][0]
+
+    def fingerprint_summary(self, summary):
+        payload = json.dumps(summary, sort_keys=True, default=unicode)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def is_summary_unchanged(self, summary):
+        '''Check whether the summary row is the same as it was when its file
+           was last scraped, and the file isn't due to be scraped anyway.'''
+        try:
+            key = int(self.get_summary_key(summary))
+        except (KeyError, TypeError, ValueError):
+            return False
+
+        fingerprint, last_scraped = self.summary_fingerprints.get(key, (None, None))
+        if fingerprint != self.fingerprint_summary(summary) or last_scraped is None:
+            return False
+
+        age = datetime.datetime.now() - last_scraped
+        return age < datetime.timedelta(days=self.summary_refresh_days)
+
+    def make_scraper(self):
+        """
+        Make a LegistarScraper whose browser keeps its cookies in the shared
+        cookie jar.
+        """
+        scraper = LegistarScraper(self.scraper_options)
+        browser = getattr(scraper, 'br', None)
+        if browser is not None:
+            browser.set_cookiejar(self.cookie_jar)
+        return scraper
+
+    def get_scraper(self):
+        """
+        Get a LegistarScraper for use by the current thread.
+        """
+        scraper = getattr(self.scraper_local, 'scraper', None)
+        if scraper is None:
+            scraper = self.scraper_local.scraper = self.make_scraper()
+        return scraper
+
+    def expand_history_row(self, act):
+        """
+        Get the details and votes for a history row, or None if they can't be
+        read.  Called from the history pool's threads.
+        """
+        def expand():
+            self.rate_limiter.acquire(self.hostname)
+            return self.get_scraper().expandHistorySummary(act)
+
+        try:
+            return call_with_backoff(expand, retry_on=(urllib2.URLError, httplib.HTTPException))
+        except (KeyError, AttributeError) as e:
+            log.warning('Failed to expand history row %r: %s' % (act, e))
+            return None
+
+    def expand_history(self, legislation_history):
+        """
+        Expand all of the given history rows concurrently.  The expanded rows
+        come back in the same order, paired with the rows themselves.
+        """
+        if self.history_pool is None:
+            self.history_pool = ThreadPool(self.history_workers)
+
+        legislation_history = list(legislation_history)
+        expanded = self.history_pool.map(self.expand_history_row, legislation_history)
+        return zip(legislation_history, expanded)
 
     def scrape_legis_file(self, key, summary):
         '''Extract a record from the given document (soup). The key is for the
@@ -48,6 +228,10 @@ class HostedLegistarSiteWrapper (object):
 
         while True :
             try:
+                # Fingerprint the row as it came from the listing, so that it
+                # matches what is_summary_unchanged will see next time.
+                summary_fingerprint = self.fingerprint_summary(summary)
+                self.rate_limiter.acquire(self.hostname)
                 legislation_attrs, legislation_history = self.scraper.expandLegislationSummary(summary)
                 break
             except urllib2.URLError as e:
@@ -56,20 +240,22 @@ class HostedLegistarSiteWrapper (object):
             except AttributeError as e :
                 log.warning(e)
                 log.warning('skipping to next leg record')
+            delays = backoff_delays(max_delay=360)
             while True :
                 try:
                     summary = self.legislation_summaries.next()
+                    self.note_summary_date(summary)
                     break
                 except urllib2.URLError as e:
+                    delay = delays.next()
                     log.warning(e)
-                    log.warning('sleeping for five minutes')
-                    time.sleep('360')
+                    log.warning('sleeping for %.0f seconds' % delay)
+                    time.sleep(delay)
 
 
 
             
-        parsed_url = urlparse.urlparse(summary['URL'])
-        key = urlparse.parse_qs(parsed_url.query)['ID'][0]
+        key = self.get_summary_key(summary)
         
         # re-order the sponsor name by '[First] [Last]' instead of '[Last], [First]'
         sponsors = legislation_attrs['Sponsors']
@@ -97,12 +283,13 @@ class HostedLegistarSiteWrapper (object):
                 'topics': topics,
                 'controlling_body' : legislation_attrs[self.controlling_body_label],
                 'intro_date' : self.convert_date(summary[self.intro_date_label]),
-                'final_date' : self.convert_date(summary.setdefault(self.final_date_label, '')),
-                'version' : summary.setdefault(self.version_label, ''),
+                'final_date' : self.convert_date(summary.get(self.final_date_label, '')),
+                'version' : summary.get(self.version_label, ''),
                 #'contact' : None,
                 'sponsors' : first_name_first_sponsors,
                 # probably remove this from the model as well
-                'minutes_url'  : None
+                'minutes_url'  : None,
+                'summary_fingerprint' : summary_fingerprint
             }
         except KeyError, e:
             raise ScrapeError('Failed to find key %s in either summary keys '
@@ -120,13 +307,11 @@ class HostedLegistarSiteWrapper (object):
             attachments = []
 
         actions = []
-        for act in legislation_history :
-            try:
-                act_details, act_votes = self.scraper.expandHistorySummary(act)
-            except (KeyError, AttributeError) as e:
-                print e
-                print summary
+        for act, expanded in self.expand_history(legislation_history) :
+            if expanded is None:
                 continue
+
+            act_details, act_votes = expanded
             try:
                 acting_body = act['Action By']
                 if not isinstance(acting_body, basestring):
@@ -172,15 +357,22 @@ class HostedLegistarSiteWrapper (object):
 
     def check_for_new_content(self, last_key):
         '''Grab the next legislation summary row. Doesn't use the last_key
-           parameter; just starts at the beginning for each instance of the
-           scraper.
+           parameter; just starts at the beginning of the search window for
+           each instance of the scraper.
         '''
-        try:
-            print 'next leg record'
-            next_summary = self.legislation_summaries.next()
+        while True:
+            try:
+                print 'next leg record'
+                next_summary = self.legislation_summaries.next()
+            except StopIteration:
+                return None, None
+
+            self.note_summary_date(next_summary)
+            if self.is_summary_unchanged(next_summary):
+                incr('summaries_unchanged')
+                continue
+
             return 0, next_summary
-        except StopIteration:
-            return None, None
 
     def init_pdf_cache(self, pdf_mapping) :
         pass
@@ -5,6 +5,8 @@ import re
 import urllib2
 import utils
 from bs4 import BeautifulSoup
+from utils.stats import timed
+from phillyleg.management.scraper_wrappers.http_session import get_session
 
 log = logging.getLogger(__name__)
 
@@ -17,14 +19,26 @@ class PhillyLegistarSiteWrapper (object):
     of interaction is scrape_legis_file.
     """
 
+    allows_concurrent_scraping = True
+    """Files can be scraped from separate threads at the same time."""
+
+    max_key_gap = 100
+    """The most keys in a row that can be missing before the last file.  100
+       is arbitrary, but I feel like it's large enough to be safe.  I tried
+       10, but 12544 through 12568 are missing for Philly :("""
+
+    defer_pdf_text = False
+    """If True, text is not extracted from PDFs that haven't been seen before;
+       it is left to be filled in later."""
+
     def __init__(self, root_url):
         self.root_url = root_url
 
     def get_legfile_url(self, key):
         return self.root_url + 'detailreport/?key=' + str(key)
 
-    def urlopen(self, *args, **kwargs):
-        return urllib2.urlopen(*args, **kwargs)
+    def urlopen(self, url):
+        return get_session().urlopen(url)
 
     def scrape_legis_file(self, key, soup):
         '''Extract a record from the given document (soup). The key is for the
@@ -222,13 +236,17 @@ class PhillyLegistarSiteWrapper (object):
             if pdf_content not in [None, 'None']:
                 return pdf_content
 
+        if self.defer_pdf_text and pdf_key.startswith(('http://', 'https://')):
+            return ''
+
         if pdf_key.startswith('file://'):
             path = pdf_key[7:]
             pdf_data = open(path).read()
         elif pdf_key.startswith('http://') or pdf_key.startswith('https://'):
             url = pdf_key
             try:
-                pdf_data = self.urlopen(url).read()
+                with timed('pdf_fetch'):
+                    pdf_data = self.urlopen(url).read()
 
             # Protect against removed PDFs (ones that result in 404 HTTP
             # response code).  I don't know why they've removed some PDFs
@@ -246,9 +264,9 @@ class PhillyLegistarSiteWrapper (object):
                 if tries_left:
                     return self.extract_pdf_text(pdf_key, tries_left-1)
 
-        xml_data = utils.pdftoxml(pdf_data)
-
-        self.__pdf_cache[pdf_key] = self.extract_xml_text(xml_data, 'pdf2xml')
+        with timed('pdf_text'):
+            xml_data = utils.pdftoxml(pdf_data)
+            self.__pdf_cache[pdf_key] = self.extract_xml_text(xml_data, 'pdf2xml')
         return self.__pdf_cache[pdf_key]
 
     def extract_xml_text(self, xml_data, root_node_name):
@@ -277,43 +295,59 @@ class PhillyLegistarSiteWrapper (object):
         else: return True
 
     def check_for_new_content(self, last_key):
-        '''Look through the next 100 keys to see if there are any more files.
-           100 is arbitrary, but I feel like it's large enough to be safe.  I
-           tried 10, but 12544 through 12568 are missing for Philly :('''
+        '''Look through the next ``max_key_gap`` keys to see if there are any
+           more files.'''
 
         curr_key = last_key
-        for _ in xrange(100):
+        for _ in xrange(self.max_key_gap):
             curr_key = curr_key + 1
-
-            url = self.get_legfile_url(curr_key)
-            more_tries = 10
-            while True:
-                try:
-                    html = self.urlopen(url)
-                    break
-
-                # Sometimes the server will respond with a status line that httplib
-                # does not understand (an empty status line, in particular).  When
-                # this happens, keep trying to access the page.  Give up after 10
-                # tries.
-                except httplib.BadStatusLine, ex:
-                    more_tries -= 1;
-                    log.warning('Received BadStatusLine exception %r for url %r' % (ex, url))
-                    if not more_tries:
-                        log.error('Ran out of tries for new content')
-                        raise
-
-                # Sometimes the server will do things like just take too long to
-                # respond.  When it does, try again 10 times.
-                except urllib2.URLError, ex:
-                    more_tries -= 1;
-                    log.warning('Received URLError exception %r for url %r' % (ex, url))
-                    if not more_tries:
-                        log.error('Ran out of tries for new content')
-                        raise
-            soup = BeautifulSoup(html)
+            soup = self.get_legfile_soup(curr_key)
 
             if not self.is_error_page(soup):
                 return curr_key, soup
 
         return curr_key, None
+
+    def get_legfile_soup(self, key):
+        '''Download the detail report for the given key.'''
+
+        url = self.get_legfile_url(key)
+        more_tries = 10
+        while True:
+            try:
+                with timed('fetch'):
+                    html = self.urlopen(url)
+                break
+
+            # Sometimes the server will respond with a status line that httplib
+            # does not understand (an empty status line, in particular).  When
+            # this happens, keep trying to access the page.  Give up after 10
+            # tries.
+            except httplib.BadStatusLine, ex:
+                more_tries -= 1;
+                log.warning('Received BadStatusLine exception %r for url %r' % (ex, url))
+                if not more_tries:
+                    log.error('Ran out of tries for new content')
+                    raise
+
+            # Sometimes the server will do things like just take too long to
+            # respond.  When it does, try again 10 times.
+            except urllib2.URLError, ex:
+                more_tries -= 1;
+                log.warning('Received URLError exception %r for url %r' % (ex, url))
+                if not more_tries:
+                    log.error('Ran out of tries for new content')
+                    raise
+
+        with timed('parse'):
+            return BeautifulSoup(html)
+
+    def fetch_legis_file(self, key):
+        '''Scrape the file with the given key again.  Returns the same tuple as
+           scrape_legis_file, or None if there is no such file.'''
+
+        soup = self.get_legfile_soup(key)
+        if self.is_error_page(soup):
+            return None
+
+        return self.scrape_legis_file(key, soup)
@@ -1,6 +1,7 @@
 #import datetime
 #import os
 #import urllib2
+from phillyleg.management.scraper_wrappers.http_session import get_session
 
 
 class LegistarApiWrapper (object):
@@ -16,9 +17,9 @@ class LegistarApiWrapper (object):
     wsdl_url = 'http://betasdk.legistar.com/main.asmx?WSDL'
     """The URL of the original WSDL file"""
 
-    def urlopen(self, *args, **kwargs):
+    def urlopen(self, url):
         """A facade over urlopen; mainly used for stubbing in tests"""
-        return urllib2.urlopen(*args, **kwargs)
+        return get_session().urlopen(url)
 
     def scrape_legis_file(self, key, cursor):
         """Extract a record from the given document (soup). The key is for the
@@ -1,7 +1,9 @@
 import datetime
+import itertools
 import os
 import sqlite3
 import urllib2
+from phillyleg.management.scraper_wrappers.http_session import get_session
 
 class ScraperWikiSourceWrapper (object):
     """
@@ -17,9 +19,9 @@ class ScraperWikiSourceWrapper (object):
     db_file_name = 'swdata.sqlite3'
     """The local file name of the datastore."""
 
-    def urlopen(self, *args, **kwargs):
+    def urlopen(self, url):
         """A facade over urlopen; mainly used for stubbing in tests"""
-        return urllib2.urlopen(*args, **kwargs)
+        return get_session().urlopen(url)
 
     def scrape_legis_file(self, key, cursor):
         """Extract a record from the given document (soup). The key is for the
@@ -31,10 +33,20 @@ class ScraperWikiSourceWrapper (object):
 
         row = cursor.fetchone()
         print row
+        record = self.make_legis_record(key, row)
+
+        attachments = self.scrape_legis_attachments(key, cursor)
+        actions = self.scrape_legis_actions(key, cursor)
+        minutes = self.collect_minutes(actions, cursor)
+
+        print record, attachments, actions, minutes
+        return record, attachments, actions, minutes
+
+    def make_legis_record(self, key, row):
         lid, ltype, lurl, lstatus, ltitle, lbody, lintro, lfinal, \
         lversion, lcontact, lsponsors = row
 
-        record = {
+        return {
             'key' : key,
             'id' : lid,
             'url' : lurl,
@@ -49,34 +61,25 @@ class ScraperWikiSourceWrapper (object):
             'sponsors' : lsponsors
         }
 
-        attachments = self.scrape_legis_attachments(key, cursor)
-        actions = self.scrape_legis_actions(key, cursor)
-        minutes = self.collect_minutes(actions, cursor)
-
-        print record, attachments, actions, minutes
-        return record, attachments, actions, minutes
-
     def collect_minutes(self, actions, cursor):
 
         action_keys = tuple([action['key'] for action in actions])
         placeholders = ['?']*len(action_keys)
 
-        cursor.execute('''select minutes.url,minutes.fulltext,minutes.date_taken
+        cursor.execute('''select distinct
+            minutes.url,minutes.fulltext,minutes.date_taken
             from minutes inner join actions
-            where minutes.url = actions.minutes_url
-              and actions.key in (%s)''' % ','.join(placeholders), action_keys)
+              on minutes.url = actions.minutes_url
+            where actions.key in (%s)''' % ','.join(placeholders), action_keys)
 
-        minuteses = []
+        return [self.make_minutes(row) for row in cursor]
 
-        for row in cursor:
-            minutes = {
-                'url' : row[0],
-                'fulltext' : row[1],
-                'date_taken' : self.make_datetime(row[2][:10]).date(),
-            }
-            minuteses.append(minutes)
-
-        return minuteses
+    def make_minutes(self, row):
+        return {
+            'url' : row[0],
+            'fulltext' : row[1],
+            'date_taken' : self.make_datetime(row[2][:10]).date(),
+        }
 
     def make_datetime(self, dt_str):
         if '-' in dt_str:
@@ -92,17 +95,14 @@ class ScraperWikiSourceWrapper (object):
         cursor.execute('''select description,url
             from attachments where key=?''', (key,))
 
-        attachments = []
-
-        for row in cursor:
-            attachment = {
-                'key' : key,
-                'description' : row[0],
-                'url' : row[1],
-            }
-            attachments.append(attachment)
+        return [self.make_attachment(key, row) for row in cursor]
 
-        return attachments
+    def make_attachment(self, key, row):
+        return {
+            'key' : key,
+            'description' : row[0],
+            'url' : row[1],
+        }
 
     def scrape_legis_actions(self, key, cursor):
 
@@ -110,21 +110,49 @@ class ScraperWikiSourceWrapper (object):
             date_taken,acting_body,description,motion,minutes_url,notes
             from actions where key=?''', (key,))
 
-        actions = []
+        return [self.make_action(key, row) for row in cursor]
+
+    def make_action(self, key, action_row):
+        return {
+            'key' : key,
+            'date_taken' : self.make_datetime(action_row[0]),
+            'acting_body' : action_row[1],
+            'description' : action_row[2],
+            'motion' : action_row[3],
+            'minutes_url' : action_row[4],
+            'notes' : action_row[5],
+        }
 
-        for action_row in cursor:
-            action = {
-                'key' : key,
-                'date_taken' : self.make_datetime(action_row[0]),
-                'acting_body' : action_row[1],
-                'description' : action_row[2],
-                'motion' : action_row[3],
-                'minutes_url' : action_row[4],
-                'notes' : action_row[5],
-            }
-            actions.append(action)
+    def iter_legis_files(self, last_key, force_download=False):
+        """Generate a (record, attachments, actions, minutes) tuple for each file
+           after the given key, in key order.  Rather than querying for each
+           file separately, this reads through each table once, in key order,
+           alongside the files."""
 
-        return actions
+        conn = self.__get_cursor(force_download).connection
+
+        files = conn.execute('''select key,
+            id,type,url,status,title,controlling_body,intro_date,final_date,
+            version,contact,sponsors
+            from swdata where key > ? order by key''', (last_key,))
+        attachments = _RowsByKey(conn.execute('''select key,
+            description,url
+            from attachments where key > ? order by key, rowid''', (last_key,)))
+        actions = _RowsByKey(conn.execute('''select key,
+            date_taken,acting_body,description,motion,minutes_url,notes
+            from actions where key > ? order by key, rowid''', (last_key,)))
+        minutes = _RowsByKey(conn.execute('''select distinct actions.key,
+            minutes.url,minutes.fulltext,minutes.date_taken
+            from minutes inner join actions
+              on minutes.url = actions.minutes_url
+            where actions.key > ? order by actions.key''', (last_key,)))
+
+        for row in files:
+            key = int(row[0])
+            yield (self.make_legis_record(key, row[1:]),
+                   [self.make_attachment(key, r) for r in attachments.take(key)],
+                   [self.make_action(key, r) for r in actions.take(key)],
+                   [self.make_minutes(r) for r in minutes.take(key)])
 
     def __download_db(self):
         print "Downloading the database (~40M -- this may take a while)..."
@@ -146,16 +174,30 @@ class ScraperWikiSourceWrapper (object):
         conn = sqlite3.connect(self.db_file_name)
         self.__cursor = conn.cursor()
 
-    def check_for_new_content(self, last_key, force_download=False):
-        """Look through the next 10 keys to see if there are any more files.
-           10 is arbitrary, but I feel like it's large enough to be safe."""
-
+    def __get_cursor(self, force_download=False):
         if not self.__cursor:
             if force_download or not self.__check_db_exists():
                 self.__download_db()
             self.__connect_to_db()
 
-        cursor = self.__cursor
+        return self.__cursor
+
+    def fetch_legis_file(self, key):
+        """Scrape the file with the given key again.  Returns the same tuple as
+           scrape_legis_file, or None if there is no such file."""
+
+        cursor = self.__get_cursor()
+        cursor.execute('select key from swdata where key=?', (key,))
+        if cursor.fetchone() is None:
+            return None
+
+        return self.scrape_legis_file(key, cursor)
+
+    def check_for_new_content(self, last_key, force_download=False):
+        """Look through the next 10 keys to see if there are any more files.
+           10 is arbitrary, but I feel like it's large enough to be safe."""
+
+        cursor = self.__get_cursor(force_download)
 
         cursor.execute('''select key
             from swdata
@@ -167,3 +209,34 @@ class ScraperWikiSourceWrapper (object):
             return int(row[0]), cursor
 
         return last_key, None
+
+
+class _RowsByKey (object):
+    """
+    Hands out the rows from a cursor that is ordered by key (the first
+    column), a key at a time.
+    """
+
+    def __init__(self, rows):
+        self.groups = itertools.groupby(rows, lambda row: int(row[0]))
+        self.next_group = None
+
+    def take(self, key):
+        """
+        Get the rows (without the key) for the given key, skipping any for
+        keys before it.  Keys must be taken in increasing order.
+        """
+        while True:
+            if self.next_group is None:
+                try:
+                    self.next_group = self.groups.next()
+                except StopIteration:
+                    return []
+
+            group_key, rows = self.next_group
+            if group_key > key:
+                return []
+
+            self.next_group = None
+            if group_key == key:
+                return [row[1:] for row in rows]
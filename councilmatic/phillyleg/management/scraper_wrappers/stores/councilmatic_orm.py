@@ -1,9 +1,21 @@
+import copy
 import datetime
+import hashlib
+import json
+import logging
 import phillyleg
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import transaction
-from django.db.utils import IntegrityError
+from django.db.models import Max, Q
+from django.db.utils import DatabaseError, IntegrityError
 
+from phillyleg.aliases import CouncilMemberAliasResolver
 from phillyleg.models import *
+from utils.lru import LRUCache
+from utils.stats import incr, timed
+
+log = logging.getLogger(__name__)
 
 identity = lambda x: x
 
@@ -17,6 +29,57 @@ def unique(iterable, key=None):
             yield elem
 
 
+class PdfTextLookup (object):
+    """
+    A mapping from attachment and minutes URLs to the text that has already
+    been extracted from them.  The database is only consulted when a URL is
+    actually looked up, and the most recently used texts are kept in memory.
+    """
+
+    def __init__(self, cache_size=100):
+        self.cache = LRUCache(cache_size)
+
+    def __contains__(self, url):
+        return self._lookup(url) is not None
+
+    def __getitem__(self, url):
+        text = self._lookup(url)
+        if text is None:
+            raise KeyError(url)
+        return text
+
+    def __setitem__(self, url, text):
+        self.cache[url] = text
+
+    def get(self, url, default=None):
+        text = self._lookup(url)
+        return default if text is None else text
+
+    def clear(self):
+        self.cache.clear()
+
+    def _lookup(self, url):
+        text = self.cache.get(url)
+        if text is None:
+            text = self._query(url)
+            if text is not None:
+                self.cache[url] = text
+        return text
+
+    def _query(self, url):
+        # The sources will also look up raw PDF data; only URLs could be in
+        # the database.
+        if not url.startswith(('http://', 'https://')):
+            return None
+
+        for Model in (LegFileAttachment, LegMinutes):
+            texts = Model.objects.filter(url=url).values_list('fulltext', flat=True)[:1]
+            if texts:
+                return texts[0]
+
+        return None
+
+
 class CouncilmaticDataStoreWrapper (object):
     """
     This is the interface over an arbitrary database where the information is
@@ -28,6 +91,31 @@ class CouncilmaticDataStoreWrapper (object):
     """
     STARTING_KEY = 72
 
+    def __init__(self):
+        self.aliases = CouncilMemberAliasResolver()
+
+        # Legislative files and minutes that records refer to, by key and URL.
+        cache_size = settings.LEGISLATION.get('ORM_CACHE_SIZE', 1000)
+        self.legfile_cache = LRUCache(cache_size)
+        self.legminutes_cache = LRUCache(cache_size)
+
+    def reset_caches(self):
+        """
+        Forget the cached files and minutes, which other processes may have
+        changed since they were cached.
+        """
+        self.legfile_cache.clear()
+        self.legminutes_cache.clear()
+
+    def cache_stats(self):
+        """
+        Get the hit, miss, and eviction counts for each of the caches.
+        """
+        return {
+            'legfile_cache': self.legfile_cache.stats(),
+            'legminutes_cache': self.legminutes_cache.stats(),
+        }
+
     def get_latest_key(self):
         '''Check the datastore for the key of the most recent filing.'''
 
@@ -53,6 +141,86 @@ class CouncilmaticDataStoreWrapper (object):
         keys.continuation_key = key
         keys.save()
 
+    def get_high_water_mark(self):
+        '''Get the latest intro date seen by a completed scrape, if any.'''
+        records = LegKeys.objects.all()
+        try:
+            return records[0].high_water_date
+        except IndexError:
+            return None
+
+    def save_high_water_mark(self, date):
+        try:
+            keys = LegKeys.objects.get(pk=1)
+        except LegKeys.DoesNotExist:
+            keys = LegKeys(pk=1, continuation_key=self.STARTING_KEY)
+
+        keys.high_water_date = date
+        keys.save()
+
+    @transaction.commit_on_success
+    def plan_key_leases(self, start_key, end_key, range_size):
+        """
+        Split the keys from ``start_key`` up to ``end_key`` into leases of
+        ``range_size`` keys each, for workers to claim.  If the leases from a
+        previous plan haven't all been completed, they are left to be finished
+        instead.  Returns the number of leases created.
+        """
+        if LegKeyLease.objects.filter(completed=False).exists():
+            return 0
+
+        LegKeyLease.objects.all().delete()
+        leases = [LegKeyLease(start_key=key, next_key=key,
+                              end_key=min(key + range_size, end_key))
+                  for key in xrange(start_key, end_key, range_size)]
+        LegKeyLease.objects.bulk_create(leases)
+        return len(leases)
+
+    def claim_key_lease(self, owner, duration):
+        """
+        Claim an unowned or expired lease for the given owner, for the given
+        ``timedelta``.  Returns the lease, or None if there's none left.
+
+        Each claim is a single conditional UPDATE, so if two workers go for
+        the same lease, only one of them will get it.
+        """
+        while True:
+            now = datetime.datetime.now()
+            available = Q(completed=False) & (Q(expires__isnull=True) | Q(expires__lt=now))
+            candidates = list(LegKeyLease.objects.filter(available)
+                              .values_list('pk', flat=True)[:10])
+            if not candidates:
+                return None
+
+            for pk in candidates:
+                claimed = LegKeyLease.objects.filter(available, pk=pk)\
+                    .update(owner=owner, expires=now + duration)
+                if claimed:
+                    return LegKeyLease.objects.get(pk=pk)
+
+    def renew_key_lease(self, lease, owner, next_key, duration):
+        """
+        Record the progress made on a lease, and extend it.  Returns False if
+        the lease has been lost to another worker.
+        """
+        renewed = LegKeyLease.objects.filter(pk=lease.pk, owner=owner, completed=False)\
+            .update(next_key=next_key,
+                    expires=datetime.datetime.now() + duration)
+        lease.next_key = next_key
+        return bool(renewed)
+
+    def complete_key_lease(self, lease, owner):
+        LegKeyLease.objects.filter(pk=lease.pk, owner=owner)\
+            .update(next_key=lease.end_key, completed=True, expires=None)
+
+    def release_key_lease(self, lease, owner):
+        """
+        Give up a lease, so that another worker can pick it up where this one
+        left off.
+        """
+        LegKeyLease.objects.filter(pk=lease.pk, owner=owner, completed=False)\
+            .update(owner='', expires=None)
+
     def has_text_changed(self, key, new_legfile):
         """
         Check if the legfile text has changed to determine whether the metadata
@@ -68,13 +236,308 @@ class CouncilmaticDataStoreWrapper (object):
         except LegFile.DoesNotExist:
             return True
 
-    @transaction.commit_on_success
+    def fingerprint_legis_file(self, file_record, attachment_records,
+                               action_records):
+        """
+        Calculate a digest of the scraped content of a legislative file -- its
+        record (including sponsors), attachments, and actions -- that will
+        change only when the content does.
+        """
+        sponsors = file_record.get('sponsors') or []
+        if isinstance(sponsors, basestring):
+            sponsors = [name.strip() for name in sponsors.split(',')]
+
+        record = dict(file_record, sponsors=sponsors)
+        record.pop('fingerprint', None)
+
+        # Attachment text is derived from the attachment URL, and may be
+        # filled in after the fact, so leave it out of the digest.
+        attachments = sorted(
+            (attachment.get('url'), attachment.get('description'))
+            for attachment in attachment_records)
+
+        actions = []
+        for action in action_records:
+            action = dict(action)
+            action['votes'] = sorted(
+                (vote['voter'], vote['value'])
+                for vote in action.get('votes', []))
+            actions.append(action)
+
+        payload = json.dumps([record, attachments, actions], sort_keys=True,
+                             default=unicode)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get_fingerprints(self, keys):
+        """
+        Get a mapping from each given key to the fingerprint of the stored
+        legislative file.  Keys of files that aren't stored are left out.
+        """
+        keys = [int(key) for key in keys]
+        return dict(LegFile.objects.filter(key__in=keys)
+                    .values_list('key', 'fingerprint'))
+
+    def get_summary_fingerprints(self):
+        """
+        Get a mapping from the key of each stored legislative file that has a
+        summary fingerprint to a ``(summary_fingerprint, last_scraped)`` pair.
+        """
+        return dict(
+            (key, (summary_fingerprint, last_scraped))
+            for key, summary_fingerprint, last_scraped
+            in LegFile.objects.order_by().exclude(summary_fingerprint='')
+                .values_list('key', 'summary_fingerprint', 'last_scraped'))
+
+    def mark_scraped(self, keys):
+        """
+        Note that the files with the given keys have just been scraped, even
+        if nothing about them has changed.
+        """
+        if keys:
+            LegFile.objects.filter(key__in=keys)\
+                .update(last_scraped=datetime.datetime.now())
+
+    def get_refresh_candidates(self):
+        """
+        Get a ``(key, status, intro_date, last_action_date, last_scraped)``
+        tuple for each stored legislative file, for deciding which files to
+        scrape again.
+        """
+        return LegFile.objects.order_by()\
+            .annotate(last_action_date=Max('actions__date_taken'))\
+            .values_list('key', 'status', 'intro_date', 'last_action_date',
+                         'last_scraped')
+
     def save_legis_file(self, file_record, attachment_records,
                         action_records, minutes_records):
         """
         Take a legislative file record and do whatever needs to be
         done to get it into the database.
         """
+        with timed('save'):
+            try:
+                self._save_legis_file(file_record, attachment_records,
+                                      action_records, minutes_records)
+            except:
+                # Any council members created along the way are gone.
+                self.aliases.reset()
+                raise
+
+    @transaction.commit_on_success
+    def _save_legis_file(self, file_record, attachment_records,
+                         action_records, minutes_records):
+        self.aliases.check()
+
+        # If nothing has changed since the last time we saw this file, there's
+        # no need to touch it at all.
+        fingerprint = self.fingerprint_legis_file(
+            file_record, attachment_records, action_records)
+        key = int(file_record['key'])
+        if self.get_fingerprints([key]).get(key) == fingerprint:
+            log.debug('Legfile with key %r is unchanged' % (key,))
+            self.mark_scraped([key])
+            incr('files_unchanged')
+            return
+
+        file_record['fingerprint'] = fingerprint
+        legfile = self._save_legis_file_record(file_record)
+        incr('files_saved')
+
+        # Create notes attached to the record
+        for attachment_record in attachment_records:
+            attachment_record = self.__replace_key_with_legfile(attachment_record)
+            self._save_or_ignore(LegFileAttachment, attachment_record)
+
+        # Create minutes
+        for minutes_record in minutes_records:
+            self._save_or_ignore(LegMinutes, minutes_record)
+
+        # Create actions attached to the record.  Only actions that aren't
+        # already stored (by date, description and notes) are new.
+        seen = self._get_action_signatures([legfile.pk])
+        for action_record in action_records:
+            action_record = self.__replace_key_with_legfile(action_record)
+            action_record = self.__replace_url_with_minutes(action_record)
+            votes = action_record.pop('votes', [])
+
+            signature = self._action_signature(
+                legfile.pk, action_record.get('date_taken'),
+                action_record.get('description'), action_record.get('notes'))
+            if signature in seen:
+                continue
+            seen.add(signature)
+
+            action = self._save_or_ignore(LegAction, action_record)
+            if action is None:
+                continue
+
+            for vote_record in votes:
+                vote_record['action'] = action
+                vote_record['voter'] = self.aliases.resolve(vote_record['voter'])
+                vote = self._save_or_ignore(LegVote, vote_record)
+
+        self.aliases.flush()
+
+    def save_legis_files(self, scraped_files, batch_size=50):
+        """
+        Save many legislative files, grouping ``batch_size`` of them into each
+        transaction.  Each scraped file is a tuple of the file record and the
+        attachment, action, and minutes records, as would be passed to
+        ``save_legis_file``.  Returns the keys of the files that couldn't be
+        saved.
+
+        Attachments, actions and votes for a batch are inserted in bulk.  If
+        any file in a batch fails to save, the batch is split in half and each
+        half is retried, so that one bad file only costs us that file.
+        """
+        failed_keys = []
+        batch = []
+        for scraped_file in scraped_files:
+            batch.append(scraped_file)
+            if len(batch) >= batch_size:
+                failed_keys.extend(self.save_legis_batch(batch))
+                batch = []
+
+        if batch:
+            failed_keys.extend(self.save_legis_batch(batch))
+
+        return failed_keys
+
+    def save_legis_batch(self, batch):
+        """
+        Save a batch of scraped files in one transaction, like
+        ``save_legis_files``.  Returns the keys of the files that couldn't be
+        saved, in the order they were given.
+        """
+        try:
+            # The records get picked apart as they are saved, so work on a
+            # copy in case we have to try again.
+            with timed('save_batch'):
+                with transaction.commit_on_success():
+                    self._bulk_save_legis_files(copy.deepcopy(batch))
+            return []
+
+        except (DatabaseError, ValidationError, ValueError), e:
+            # Anything cached during the failed transaction may refer to rows
+            # that no longer exist.
+            self.reset_caches()
+            self.aliases.reset()
+
+            if len(batch) == 1:
+                file_record = batch[0][0]
+                log.error('Failed to save legislative file with key %r: %s' %
+                          (file_record.get('key'), e))
+                return [int(file_record['key'])]
+
+            half = len(batch) // 2
+            return self.save_legis_batch(batch[:half]) + \
+                   self.save_legis_batch(batch[half:])
+
+    def _bulk_save_legis_files(self, batch):
+        self.aliases.check()
+
+        attachment_records = []
+        action_records = []
+
+        fingerprints = self.get_fingerprints(
+            [file_record['key'] for file_record, _, _, _ in batch])
+        changed_batch = []
+        unchanged_keys = []
+
+        for file_record, attachments, actions, minuteses in batch:
+            fingerprint = self.fingerprint_legis_file(
+                file_record, attachments, actions)
+            if fingerprints.get(int(file_record['key'])) == fingerprint:
+                unchanged_keys.append(int(file_record['key']))
+                continue
+            changed_batch.append((file_record, attachments, actions, minuteses))
+
+            file_record['fingerprint'] = fingerprint
+            self._save_legis_file_record(file_record)
+
+            for minutes_record in minuteses:
+                self._save_or_ignore(LegMinutes, minutes_record)
+
+            attachment_records.extend(
+                self.__replace_key_with_legfile(attachment_record)
+                for attachment_record in attachments)
+            action_records.extend(
+                self.__replace_url_with_minutes(
+                    self.__replace_key_with_legfile(action_record))
+                for action_record in actions)
+
+        self.mark_scraped(unchanged_keys)
+        incr('files_unchanged', len(unchanged_keys))
+        incr('files_saved', len(changed_batch))
+
+        legfile_keys = set(record['key'] for record, _, _, _ in changed_batch)
+        self._bulk_create_attachments(legfile_keys, attachment_records)
+        self._bulk_create_actions(legfile_keys, action_records)
+        self.aliases.flush()
+
+    def _bulk_create_attachments(self, legfile_keys, attachment_records):
+        seen = set(LegFileAttachment.objects.filter(file__in=legfile_keys)
+                   .values_list('file', 'url'))
+
+        attachments = []
+        for attachment_record in attachment_records:
+            signature = (attachment_record['file'].pk, attachment_record['url'])
+            if signature not in seen:
+                seen.add(signature)
+                attachments.append(LegFileAttachment(**attachment_record))
+
+        LegFileAttachment.objects.bulk_create(attachments)
+
+    def _bulk_create_actions(self, legfile_keys, action_records):
+        existing_actions = LegAction.objects.filter(file__in=legfile_keys)
+        seen = self._get_action_signatures(legfile_keys)
+
+        actions = []
+        votes_by_signature = {}
+        for action_record in action_records:
+            votes = action_record.pop('votes', [])
+            signature = self._action_signature(
+                action_record['file'].pk, action_record.get('date_taken'),
+                action_record.get('description'), action_record.get('notes'))
+
+            if signature not in seen:
+                seen.add(signature)
+                actions.append(LegAction(**action_record))
+                votes_by_signature[signature] = votes
+
+        LegAction.objects.bulk_create(actions)
+
+        # Bulk inserts don't give us back the ids of the new actions, so look
+        # them up in order to attach the votes.
+        votes = []
+        for values in existing_actions.values_list('id', 'file', 'date_taken', 'description', 'notes'):
+            signature = self._action_signature(*values[1:])
+            for vote_record in votes_by_signature.get(signature, []):
+                votes.append(LegVote(action_id=values[0],
+                                     voter=self.aliases.resolve(vote_record['voter']),
+                                     value=vote_record['value']))
+
+        LegVote.objects.bulk_create(votes)
+
+    def _get_action_signatures(self, legfile_keys):
+        """
+        Get the set of signatures of the actions already stored for the files
+        with the given keys, in a single query.
+        """
+        existing_actions = LegAction.objects.filter(file__in=legfile_keys)
+        return set(self._action_signature(*values) for values in
+                   existing_actions.values_list('file', 'date_taken', 'description', 'notes'))
+
+    def _action_signature(self, file_key, date_taken, description, notes):
+        if isinstance(date_taken, datetime.datetime):
+            date_taken = date_taken.date()
+        return (file_key, date_taken, description or '', notes or '')
+
+    def _save_legis_file_record(self, file_record):
+        """
+        Save the file record along with its sponsors and topics, and return
+        the ``LegFile``.
+        """
         file_record = self.__convert_or_delete_date(file_record, 'intro_date')
         file_record = self.__convert_or_delete_date(file_record, 'final_date')
 
@@ -94,6 +557,7 @@ class CouncilmaticDataStoreWrapper (object):
             legfile = LegFile(key=file_record['key'])
 
         legfile.update(file_record, commit=False)
+        legfile.last_scraped = datetime.datetime.now()
 
         # Changing the text in a legfile is an expensive operation.  Not only
         # do we save the file, but also a record for each unique word in the
@@ -113,11 +577,7 @@ class CouncilmaticDataStoreWrapper (object):
             if sponsor_name is None or len(sponsor_name) == 0:
                 continue
 
-            try:
-                sponsor = CouncilMember.objects.get(aliases__name=sponsor_name)
-            except CouncilMember.DoesNotExist:
-                sponsor = CouncilMember.objects.create(real_name=sponsor_name)
-                alias = CouncilMemberAlias.objects.create(member=sponsor, name=sponsor_name)
+            sponsor = self.aliases.resolve(sponsor_name)
 
             # Add the legislation to the sponsor and save, instead of the other
             # way around, because saving legislation can be expensive.
@@ -137,65 +597,37 @@ class CouncilmaticDataStoreWrapper (object):
             if topic not in existing_topics:
                 legfile.metadata.topics.add(topic)
 
-        # Create notes attached to the record
-        for attachment_record in attachment_records:
-            attachment_record = self.__replace_key_with_legfile(attachment_record)
-            self._save_or_ignore(LegFileAttachment, attachment_record)
-
-        # Create minutes
-        for minutes_record in minutes_records:
-            self._save_or_ignore(LegMinutes, minutes_record)
-
-        # Create actions attached to the record
-        for action_record in action_records:
-            action_record = self.__replace_key_with_legfile(action_record)
-            action_record = self.__replace_url_with_minutes(action_record)
-            votes = action_record.pop('votes', [])
-            action = None
-            if not self.is_duplicate_action(action_record):
-                action = self._save_or_ignore(LegAction, action_record)
-
-            if action is None:
-                continue
+        return legfile
 
-            for vote_record in votes:
-                vote_record['action'] = action
-                voter_name = vote_record['voter']
-                voter, created = CouncilMember.objects.get_or_create(name=voter_name)
-                vote_record['voter'] = voter
-                vote = self._save_or_ignore(LegVote, vote_record)
-                
-    def is_duplicate_action(self, action_record):
+    @transaction.commit_on_success
+    def save_pdf_text(self, url, text):
         """
-        Check whether the given action_record data already exists in the
-        database.
+        Fill in the text of the attachments and minutes with the given URL,
+        and update any metadata that is derived from that text.
         """
-        date_taken = action_record.get('date_taken')
-        legfile = action_record.get('file')
-        actions = LegAction.objects.filter(date_taken=date_taken, file=legfile)
+        for attachment in LegFileAttachment.objects.filter(url=url).select_related('file'):
+            if attachment.fulltext != text:
+                attachment.fulltext = text
+                attachment.save()
 
-        for action in actions:
-            if action.description == action_record.get('description') and \
-               action.notes == action_record.get('notes'):
-                return True
+                # Locations are the only legfile metadata that are drawn from
+                # the attachment text.
+                attachment.file.save(update_words=False, update_mentions=False,
+                                     update_topics=False)
 
-        return False
+        for minutes in LegMinutes.objects.filter(url=url):
+            if minutes.fulltext != text:
+                minutes.fulltext = text
+                minutes.save()
 
     @property
     def pdf_mapping(self):
         """
-        Build a mapping of the URLs and PDF test that already exist in the
-        database.
+        Get a mapping of the URLs and PDF text that already exist in the
+        database.  The text is only loaded as each URL is looked up.
         """
-        mapping = {}
-
-        for attachment in LegFileAttachment.objects.all():
-            mapping[attachment.url] = attachment.fulltext
-
-        for minutes in LegMinutes.objects.all():
-            mapping[minutes.url] = minutes.fulltext
-
-        return mapping
+        cache_size = settings.LEGISLATION.get('PDF_CACHE_SIZE', 100)
+        return PdfTextLookup(cache_size)
 
     def __convert_or_delete_date(self, file_record, date_key):
         if file_record[date_key]:
@@ -207,37 +639,34 @@ class CouncilmaticDataStoreWrapper (object):
 
         return file_record
 
-    __legfile_cache = {}
     def __replace_key_with_legfile(self, record):
         key = record['key']
 
-        if key not in self.__legfile_cache:
+        legfile = self.legfile_cache.get(key)
+        if legfile is None:
             legfile = LegFile.objects.get(key=key)
-            self.__legfile_cache[key] = legfile
-        else:
-            legfile = self.__legfile_cache[key]
+            self.legfile_cache[key] = legfile
 
         del record['key']
-        record['file'] = self.__legfile_cache[key]
+        record['file'] = legfile
 
         return record
 
-    __legminutes_cache = {}
+    __NOT_CACHED = object()
     def __replace_url_with_minutes(self, record):
         # minutes is empty for hosted legistar
         minutes_url = record.pop('minutes_url', '')
 
-        if minutes_url not in self.__legminutes_cache:
+        minutes = self.legminutes_cache.get(minutes_url, self.__NOT_CACHED)
+        if minutes is self.__NOT_CACHED:
             if minutes_url == '':
                 minutes = None
             else:
                 try:
-                    minutes = LegMinutes.objects.get(url=record['minutes_url'])
+                    minutes = LegMinutes.objects.get(url=minutes_url)
                 except phillyleg.models.LegMinutes.DoesNotExist:
                     minutes = None
-            self.__legminutes_cache[minutes_url] = minutes
-        else:
-            minutes = self.__legminutes_cache[minutes_url]
+            self.legminutes_cache[minutes_url] = minutes
 
         record['minutes'] = minutes
 
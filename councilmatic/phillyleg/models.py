@@ -1,18 +1,18 @@
 import datetime
 import ebdata.nlp.addresses
 import re
-import utils
 import logging
 from django.conf import settings
 from django.db import transaction
+from django.db.utils import IntegrityError
 from django.contrib.gis.db import models
 from django.contrib.gis import geos
 #from django.db import models
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext as _
-from phillyleg.management.scraper_wrappers import PhillyLegistarSiteWrapper
 from utils.models import TimestampedModelMixin
+from utils.stats import timed
 
 log = logging.getLogger(__name__)
 
@@ -22,6 +22,25 @@ log = logging.getLogger(__name__)
 
 class LegKeys(models.Model):
     continuation_key = models.IntegerField()
+    high_water_date = models.DateField(null=True, blank=True)
+
+
+class LegKeyLease(models.Model):
+    """
+    A range of legislative file keys, from ``start_key`` up to (but not
+    including) ``end_key``, to be scraped by whichever worker holds the lease.
+    ``next_key`` is the first key that hasn't been scraped yet.  Leases that
+    have expired may be claimed by another worker.
+    """
+    start_key = models.IntegerField()
+    end_key = models.IntegerField()
+    next_key = models.IntegerField()
+    owner = models.CharField(max_length=100, default='', blank=True)
+    expires = models.DateTimeField(null=True, blank=True)
+    completed = models.BooleanField(default=False)
+
+    class Meta:
+        ordering = ['start_key']
 
 
 #
@@ -122,12 +141,14 @@ class CouncilDistrict(TimestampedModelMixin, models.Model):
 
 
 class LegFile(TimestampedModelMixin, models.Model):
+    METADATA_KINDS = ('words', 'mentions', 'locations', 'topics')
+
     key = models.IntegerField(primary_key=True)
     id = models.CharField(max_length=100, null=True)
     contact = models.CharField(max_length=1000, default="No contact")
     controlling_body = models.CharField(max_length=1000)
     date_scraped = models.DateTimeField(auto_now_add=True, null=True, blank=True)
-    last_scraped = models.DateTimeField(auto_now=True)
+    last_scraped = models.DateTimeField(null=True, blank=True)
     final_date = models.DateField(null=True)
     intro_date = models.DateField(default=datetime.datetime.now)
     sponsors = models.ManyToManyField(CouncilMember, related_name='legislation')
@@ -137,6 +158,10 @@ class LegFile(TimestampedModelMixin, models.Model):
     url = models.URLField()
     version = models.CharField(max_length=100)
     is_routine = models.BooleanField(default=True, blank=True)
+    fingerprint = models.CharField(max_length=64, default='', blank=True,
+        help_text=_('A digest of the scraped file content, used to tell whether the file has changed since it was last scraped'))
+    summary_fingerprint = models.CharField(max_length=64, default='', blank=True,
+        help_text=_('A digest of the file\'s row in the source\'s legislation listing, used to tell whether the file needs to be scraped again'))
 
     class Meta:
         ordering = ['-key']
@@ -256,7 +281,9 @@ class LegFile(TimestampedModelMixin, models.Model):
     def save(self, update_words=True, update_mentions=True, update_locations=True, update_topics=True, *args, **kwargs):
         """
         Calls the default ``Models.save()`` method, and creates or updates
-        metadata for the legislative file as well.
+        metadata for the legislative file as well.  If the ``DEFER_METADATA``
+        legislation setting is on, the metadata is only queued up to be
+        updated by ``process_metadata``.
 
         """
         try:
@@ -266,52 +293,54 @@ class LegFile(TimestampedModelMixin, models.Model):
 
             super(LegFile, self).save(*args, **kwargs)
 
-            metadata = LegFileMetaData.objects.get_or_create(legfile=self)[0]
-
-            if update_words:
-                # Add the unique words to the metadata
-                metadata.words.clear()
-                unique_words = self.unique_words()
-                for word in unique_words:
-                    md_word = MetaData_Word.objects.get_or_create(value=word)[0]
-                    metadata.words.add(md_word)
-
-            if update_locations:
-                # Add the unique locations to the metadata
-                metadata.locations.clear()
-                locations = self.addresses()
-                for location in locations:
-                    try:
-                        md_location = MetaData_Location.objects.get_or_create(
-                            matched_text=location[0]
-                        )[0]
-                    except MetaData_Location.CouldNotBeGeocoded:
-                        continue
-
-                    metadata.locations.add(md_location)
-
-            if update_mentions:
-                # Add the mentioned files to the metadata
-                metadata.mentioned_legfiles.clear()
-                for mentioned_legfile in self.mentioned_legfiles():
-                    metadata.mentioned_legfiles.add(mentioned_legfile)
-
-            if update_topics:
-                # Add topics to the metadata
-                metadata.topics.clear()
-                for topic in self.topics():
-                    t = MetaData_Topic.objects.get_or_create(topic=topic)[0]
-                    metadata.topics.add(t)
-
-            metadata.save()
+            if settings.LEGISLATION.get('DEFER_METADATA', False):
+                MetadataJob.objects.enqueue(self, update_words, update_mentions,
+                                            update_locations, update_topics)
+            else:
+                with timed('metadata'):
+                    self.update_metadata(update_words, update_mentions,
+                                         update_locations, update_topics)
 
             transaction.savepoint_commit(sid)
         except:
             transaction.savepoint_rollback(sid)
             raise
 
+    def update_metadata(self, update_words=True, update_mentions=True, update_locations=True, update_topics=True):
+        """
+        Creates or updates the metadata that is derived from the legislative
+        file's content.
+
+        """
+        metadata = LegFileMetaData.objects.get_or_create(legfile=self)[0]
+
+        if update_words:
+            # Link the unique words to the metadata
+            metadata.set_words(self.unique_words())
+
+        if update_locations:
+            # Link the unique locations to the metadata
+            metadata.set_locations(self.addresses())
+
+        if update_mentions:
+            # Link the mentioned files to the metadata
+            metadata.set_links('mentioned_legfiles',
+                               [legfile.pk for legfile in self.mentioned_legfiles()])
+
+        if update_topics:
+            # Link the topics to the metadata
+            metadata.set_links('topics', MetaData_Topic.objects.get_ids(self.topics()))
+
+        metadata.save()
+
     def get_data_source(self):
-        return PhillyLegistarSiteWrapper()
+        # The scraper wrappers depend on the models, so import them late.
+        from phillyleg.management.scraper_wrappers import load_scraper
+        return load_scraper()
+
+    def get_data_store(self):
+        from phillyleg.management.scraper_wrappers import CouncilmaticDataStoreWrapper
+        return CouncilmaticDataStoreWrapper()
 
     def refresh(self, stale_time=datetime.timedelta(days=1), force=False):
         """
@@ -319,14 +348,32 @@ class LegFile(TimestampedModelMixin, models.Model):
         dictated the `stale_time` parameter, a `timedelta`.  If `force` is True,
         then the refresh will happen immediately, regardless of the time it was
         last updated.
+
+        Returns True if the file was scraped again.
         """
-        pass
+        last_scraped = self.last_scraped or self.updated_datetime
+        if not force and last_scraped and \
+           datetime.datetime.now() - last_scraped < stale_time:
+            return False
+
+        scraped = self.get_data_source().fetch_legis_file(self.key)
+        if scraped is None:
+            return False
+
+        record, attachments, actions, minutes = scraped
+        self.get_data_store().save_legis_file(record, attachments, actions, minutes)
+
+        # Pick up whatever changed.
+        refreshed = LegFile.objects.get(key=self.key)
+        for field in self._meta.fields:
+            setattr(self, field.attname, getattr(refreshed, field.attname))
+        return True
 
 
 class LegFileAttachment(TimestampedModelMixin, models.Model):
     file = models.ForeignKey(LegFile, related_name='attachments')
     description = models.CharField(max_length=1000)
-    url = models.URLField()
+    url = models.URLField(db_index=True)
     fulltext = models.TextField()
 
     class Meta:
@@ -372,6 +419,8 @@ class LegVote(models.Model):
 
 
 class LegMinutes(TimestampedModelMixin, models.Model):
+    METADATA_KINDS = ('words', 'locations')
+
     url = models.URLField(unique=True)
     fulltext = models.TextField()
     date_taken = models.DateField(null=True)
@@ -406,30 +455,37 @@ class LegMinutes(TimestampedModelMixin, models.Model):
     def save(self, update_words=True, update_locations=True, *args, **kwargs):
         """
         Calls the default ``Models.save()`` method, and creates or updates
-        metadata for the minutes as well.
+        metadata for the minutes as well.  If the ``DEFER_METADATA``
+        legislation setting is on, the metadata is only queued up to be
+        updated by ``process_metadata``.
 
         """
         super(LegMinutes, self).save(*args, **kwargs)
 
+        if settings.LEGISLATION.get('DEFER_METADATA', False):
+            MetadataJob.objects.enqueue(self, update_words=update_words,
+                                        update_mentions=False,
+                                        update_locations=update_locations,
+                                        update_topics=False)
+        else:
+            with timed('metadata'):
+                self.update_metadata(update_words, update_locations)
+
+    def update_metadata(self, update_words=True, update_locations=True):
+        """
+        Creates or updates the metadata that is derived from the minutes'
+        text.
+
+        """
         metadata = LegMinutesMetaData.objects.get_or_create(legminutes=self)[0]
 
         if update_words:
-            # Add the unique words to the metadata
-            metadata.words.clear()
-            unique_words = self.unique_words()
-            for word in unique_words:
-                md_word = MetaData_Word.objects.get_or_create(value=word)[0]
-                metadata.words.add(md_word)
+            # Link the unique words to the metadata
+            metadata.set_words(self.unique_words())
 
         if update_locations:
-            # Add the unique locations to the metadata
-            metadata.locations.clear()
-            locations = self.addresses()
-            for location in locations:
-                md_location = MetaData_Location.objects.get_or_create(
-                    matched_text=location['address']
-                )[0]
-                metadata.locations.add(md_location)
+            # Link the unique locations to the metadata
+            metadata.set_locations(self.addresses())
 
         metadata.save()
 
@@ -438,7 +494,78 @@ class LegMinutes(TimestampedModelMixin, models.Model):
 # Meta-data
 #
 
-class LegFileMetaData (TimestampedModelMixin, models.Model):
+class LinkedMetaDataMixin (object):
+    """
+    For metadata models with many-to-many fields to the things derived from
+    the text, like a ``words`` field to ``MetaData_Word``.
+    """
+
+    def set_links(self, field_name, ids):
+        """
+        Make the objects with the given ids the only ones linked to this
+        metadata through the named many-to-many field.  Only the links that
+        change are written, in bulk.
+        """
+        m2m_field = getattr(type(self), field_name).field
+        Link = m2m_field.rel.through
+        metadata_name = m2m_field.m2m_field_name()
+        other_name = m2m_field.m2m_reverse_field_name()
+
+        ids = set(ids)
+        links = Link.objects.filter(**{metadata_name: self.pk})
+        linked_ids = set(links.values_list(other_name, flat=True))
+
+        stale_ids = list(linked_ids - ids)
+        for start in xrange(0, len(stale_ids), 500):
+            links.filter(**{other_name + '__in': stale_ids[start:start + 500]}).delete()
+
+        metadata_attname = Link._meta.get_field(metadata_name).attname
+        other_attname = Link._meta.get_field(other_name).attname
+        Link.objects.bulk_create([
+            Link(**{metadata_attname: self.pk, other_attname: other_id})
+            for other_id in ids - linked_ids])
+
+    def set_words(self, words):
+        """
+        Make the given words the only ones linked to this metadata.
+        """
+        self.set_links('words', MetaData_Word.objects.get_ids(words))
+
+    def set_locations(self, addresses):
+        """
+        Make the locations of the given (address, city) pairs the only ones
+        linked to this metadata.  Addresses that aren't stored as locations
+        yet are geocoded together; those that can't be are left out.
+        """
+        texts = list(set(address[0] for address in addresses))
+        location_ids = {}
+        for start in xrange(0, len(texts), 500):
+            location_ids.update(MetaData_Location.objects
+                                .filter(matched_text__in=texts[start:start + 500])
+                                .values_list('matched_text', 'id'))
+
+        missing = [text for text in texts if text not in location_ids]
+        if missing and settings.LEGISLATION.get('GEOCODE', True):
+            # The geocoder depends on the models, so import it late.
+            from phillyleg.geocoding import get_geocoder
+            results = get_geocoder().geocode_many(missing)
+
+            for text in missing:
+                location = MetaData_Location(matched_text=text)
+                try:
+                    location.set_geocode_result(results[text])
+                except MetaData_Location.CouldNotBeGeocoded:
+                    continue
+
+                location_ids[text] = MetaData_Location.objects.get_or_create(
+                    matched_text=text,
+                    defaults={'address': location.address, 'geom': location.geom}
+                )[0].pk
+
+        self.set_links('locations', location_ids.values())
+
+
+class LegFileMetaData (TimestampedModelMixin, LinkedMetaDataMixin, models.Model):
     legfile = models.OneToOneField('LegFile', related_name='metadata')
     words = models.ManyToManyField('MetaData_Word', related_name='references_in_legislation')
     locations = models.ManyToManyField('MetaData_Location', related_name='references_in_legislation')
@@ -453,7 +580,7 @@ class LegFileMetaData (TimestampedModelMixin, models.Model):
             (self.legfile.pk, len(self.mentioned_legfiles.all()), len(self.legfile.references_in_legislation.all())))
 
 
-class LegMinutesMetaData (TimestampedModelMixin, models.Model):
+class LegMinutesMetaData (TimestampedModelMixin, LinkedMetaDataMixin, models.Model):
     legminutes = models.OneToOneField('LegMinutes', related_name='metadata')
     words = models.ManyToManyField('MetaData_Word', related_name='references_in_minutes')
     locations = models.ManyToManyField('MetaData_Location', related_name='references_in_minutes')
@@ -462,9 +589,61 @@ class LegMinutesMetaData (TimestampedModelMixin, models.Model):
         return u'metadata for %s' % self.legminutes
 
 
+class UniqueValueManager (models.Manager):
+    """
+    A manager for a model that is just a unique value (e.g., a word or a
+    topic) for metadata to link to, stored in the ``value_field`` field.
+    """
+    value_field = None
+
+    def get_ids(self, values):
+        """
+        Get the set of ids of the given values, creating any that aren't
+        stored yet.  Values too long to store are left out.
+
+        The ids are looked up afresh each time rather than kept around, so
+        that values created in a transaction that is later rolled back are
+        never linked to.
+        """
+        max_length = self.model._meta.get_field(self.value_field).max_length
+        values = list(set(value for value in values if len(value) <= max_length))
+
+        ids = self._load_ids(values)
+        new_values = [value for value in values if value not in ids]
+        if new_values:
+            self._create(new_values)
+            ids.update(self._load_ids(new_values))
+
+        return set(ids.itervalues())
+
+    def _load_ids(self, values):
+        ids = {}
+        for start in xrange(0, len(values), 500):
+            ids.update(self.filter(**{self.value_field + '__in': values[start:start + 500]})
+                       .values_list(self.value_field, 'id'))
+        return ids
+
+    def _create(self, values):
+        sid = transaction.savepoint()
+        try:
+            self.bulk_create([self.model(**{self.value_field: value}) for value in values])
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Someone else stored some of the same values in the meantime.
+            transaction.savepoint_rollback(sid)
+            for value in values:
+                self.get_or_create(**{self.value_field: value})
+
+
+class MetaData_WordManager (UniqueValueManager):
+    value_field = 'value'
+
+
 class MetaData_Word (models.Model):
     value = models.CharField(max_length=64, unique=True)
 
+    objects = MetaData_WordManager()
+
     def __unicode__(self):
         return '%r (used in %s files)' % (self.value, len(self.references.all()))
 
@@ -490,20 +669,112 @@ class MetaData_Location (TimestampedModelMixin, models.Model):
         pass
 
     def geocode(self):
-        gc = utils.geocode(self.matched_text, settings.LEGISLATION['ADDRESS_BOUNDS'])
+        if not settings.LEGISLATION.get('GEOCODE', True):
+            raise self.CouldNotBeGeocoded(self.matched_text)
 
-        if gc and gc['status'] == 'OK' and settings.LEGISLATION['ADDRESS_SUFFIX'] in gc['results'][0]['formatted_address']:
-            self.address = gc['results'][0]['formatted_address']
-            x = float(gc['results'][0]['geometry']['location']['lng'])
-            y = float(gc['results'][0]['geometry']['location']['lat'])
-            self.geom = geos.Point(x, y)
+        # The geocoder depends on the models, so import it late.
+        from phillyleg.geocoding import get_geocoder
+        self.set_geocode_result(get_geocoder().geocode(self.matched_text))
+
+    def set_geocode_result(self, result):
+        """
+        Take the address and point from a geocoder result, as long as it is
+        somewhere in the city.
+        """
+        if result and settings.LEGISLATION['ADDRESS_SUFFIX'] in result.address:
+            self.address = result.address
+            self.geom = result.point
         else:
             log.debug('Could not geocode the address "%s"' % self.matched_text)
             raise self.CouldNotBeGeocoded(self.matched_text)
 
+
+class GeocodeCacheEntryManager (models.GeoManager):
+
+    def lookup(self, keys, now=None):
+        """
+        Get the unexpired entries for the given normalized addresses, in a
+        dictionary by normalized address.
+        """
+        now = now or datetime.datetime.now()
+        keys = list(keys)
+        entries = {}
+        for start in xrange(0, len(keys), 500):
+            for entry in self.filter(models.Q(expires__isnull=True) | models.Q(expires__gt=now),
+                                     normalized__in=keys[start:start + 500]):
+                entries[entry.normalized] = entry
+        return entries
+
+    def store(self, results, backend='', found_ttl=None, missing_ttl=None, now=None):
+        """
+        Store what the geocoder said about each of the given normalized
+        addresses: a result with ``address`` and ``point``, or None if the
+        address wasn't found.  Entries live for ``found_ttl`` or
+        ``missing_ttl`` (``timedelta``s), or forever if those are None.
+        """
+        now = now or datetime.datetime.now()
+        keys = list(results)
+        existing = set()
+        for start in xrange(0, len(keys), 500):
+            existing.update(self.filter(normalized__in=keys[start:start + 500])
+                            .values_list('normalized', flat=True))
+
+        fields = {}
+        for key, result in results.iteritems():
+            ttl = found_ttl if result is not None else missing_ttl
+            fields[key] = {
+                'found': result is not None,
+                'address': result.address if result is not None else '',
+                'geom': result.point if result is not None else None,
+                'backend': backend,
+                'expires': now + ttl if ttl is not None else None,
+            }
+
+        for key in existing:
+            self.filter(normalized=key).update(updated_datetime=now, **fields[key])
+
+        new_keys = [key for key in keys if key not in existing]
+        sid = transaction.savepoint()
+        try:
+            self.bulk_create([self.model(normalized=key, **fields[key])
+                              for key in new_keys])
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Someone else stored some of the same addresses in the meantime.
+            transaction.savepoint_rollback(sid)
+            for key in new_keys:
+                if not self.filter(normalized=key).update(updated_datetime=now, **fields[key]):
+                    self.create(normalized=key, **fields[key])
+
+
+class GeocodeCacheEntry (TimestampedModelMixin, models.Model):
+    """
+    What the geocoder said about an address, whether it found it or not,
+    keyed by the normalized form of the address (see
+    ``phillyleg.geocoding.normalize_address``).  Entries that have expired are
+    looked up again.
+    """
+    normalized = models.CharField(max_length=2048, unique=True)
+    found = models.BooleanField(default=False)
+    address = models.CharField(max_length=2048, default='', blank=True)
+    geom = models.PointField(null=True)
+    backend = models.CharField(max_length=100, default='', blank=True)
+    expires = models.DateTimeField(null=True, blank=True)
+
+    objects = GeocodeCacheEntryManager()
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.normalized, self.address if self.found else 'not found')
+
+class MetaData_TopicManager (UniqueValueManager):
+    value_field = 'topic'
+
+
 class MetaData_Topic (models.Model):
     topic = models.CharField(max_length=128, unique=True)
 
+    objects = MetaData_TopicManager()
+
     def get_label(self):
         if self.topic == 'Non-Routine' :
             return 'label-info'
@@ -512,3 +783,135 @@ class MetaData_Topic (models.Model):
     
     def __unicode__(self):
         return self.topic
+
+
+#
+# Work queues
+#
+
+class MetadataJobManager (models.Manager):
+
+    def enqueue(self, target, update_words=True, update_mentions=True, update_locations=True, update_topics=True):
+        """
+        Queue up the given kinds of metadata to be updated for the target (a
+        legislative file or minutes).  A kind that is already queued is just
+        marked as requested again.
+        """
+        self.enqueue_all(type(target), [target.pk], update_words,
+                         update_mentions, update_locations, update_topics)
+
+    def enqueue_all(self, model, pks, update_words=True, update_mentions=True, update_locations=True, update_topics=True):
+        """
+        Queue up the given kinds of metadata to be updated for each of the
+        legislative files or minutes (according to the model) with the given
+        primary keys, in bulk.
+        """
+        kinds = [kind for kind, requested in zip(MetadataJob.KINDS, [
+                    update_words, update_mentions, update_locations, update_topics])
+                 if requested and kind in model.METADATA_KINDS]
+        if not kinds or not pks:
+            return
+
+        target_field = 'legfile' if issubclass(model, LegFile) else 'legminutes'
+        now = datetime.datetime.now()
+        jobs = self.filter(kind__in=kinds, **{target_field + '__in': pks})
+        queued = set(jobs.values_list(target_field, 'kind'))
+        jobs.update(requested=now)
+
+        new_jobs = [(pk, kind) for pk in pks for kind in kinds
+                    if (pk, kind) not in queued]
+        sid = transaction.savepoint()
+        try:
+            self.bulk_create([MetadataJob(kind=kind, requested=now, **{target_field + '_id': pk})
+                              for pk, kind in new_jobs])
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Someone else queued some of the same jobs in the meantime.
+            transaction.savepoint_rollback(sid)
+            for pk, kind in new_jobs:
+                job, created = self.get_or_create(
+                    kind=kind, defaults={'requested': now},
+                    **{target_field + '_id': pk})
+                if not created:
+                    self.filter(pk=job.pk).update(requested=now)
+
+    def available(self, now=None):
+        """
+        Get the jobs that nobody is working on, and that haven't failed too
+        many times.
+        """
+        now = now or datetime.datetime.now()
+        return self.filter(models.Q(expires__isnull=True) | models.Q(expires__lt=now),
+                           attempts__lt=MetadataJob.MAX_ATTEMPTS)
+
+    def claim(self, owner, limit, duration):
+        """
+        Claim up to ``limit`` available jobs for the given owner, for the
+        given ``timedelta``.  Each job is claimed by a conditional UPDATE, so
+        no two workers get the same job.  Returns the claimed jobs.
+        """
+        now = datetime.datetime.now()
+        candidates = list(self.available(now).order_by('requested')
+                          .values_list('pk', flat=True)[:limit])
+        if not candidates:
+            return []
+
+        self.available(now).filter(pk__in=candidates)\
+            .update(owner=owner, expires=now + duration)
+        return list(self.filter(pk__in=candidates, owner=owner))
+
+    def finish(self, jobs, owner, claimed_at):
+        """
+        Remove the given jobs from the queue, unless they were requested again
+        after they were claimed; those are put back to be done again.
+        """
+        pks = [job.pk for job in jobs]
+        self.filter(pk__in=pks, owner=owner, requested__lte=claimed_at).delete()
+        self.release(jobs, owner)
+
+    def release(self, jobs, owner):
+        """
+        Put the given jobs back in the queue, untouched.
+        """
+        self.filter(pk__in=[job.pk for job in jobs], owner=owner)\
+            .update(owner='', expires=None)
+
+    def fail(self, jobs, owner, error):
+        """
+        Put the given jobs back in the queue, noting the error.
+        """
+        self.filter(pk__in=[job.pk for job in jobs], owner=owner)\
+            .update(owner='', expires=None, last_error=error,
+                    attempts=models.F('attempts') + 1)
+
+
+class MetadataJob (models.Model):
+    """
+    A kind of metadata that needs to be updated for a legislative file or
+    for minutes.
+    """
+    KINDS = ('words', 'mentions', 'locations', 'topics')
+    MAX_ATTEMPTS = 5
+
+    legfile = models.ForeignKey(LegFile, related_name='metadata_jobs', null=True, blank=True)
+    legminutes = models.ForeignKey(LegMinutes, related_name='metadata_jobs', null=True, blank=True)
+    kind = models.CharField(max_length=16, choices=[(kind, kind) for kind in KINDS])
+    requested = models.DateTimeField(default=datetime.datetime.now)
+    owner = models.CharField(max_length=100, default='', blank=True)
+    expires = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    objects = MetadataJobManager()
+
+    class Meta:
+        unique_together = [('legfile', 'kind'), ('legminutes', 'kind')]
+
+    def __unicode__(self):
+        if self.legfile_id is not None:
+            return u'%s metadata for legfile %s' % (self.kind, self.legfile_id)
+        return u'%s metadata for minutes %s' % (self.kind, self.legminutes_id)
+
+    @property
+    def target(self):
+        return self.legfile if self.legfile_id is not None else self.legminutes
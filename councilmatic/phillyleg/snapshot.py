@@ -0,0 +1,242 @@
+"""
+Snapshots of all of the legislation data -- files, council members,
+districts, and all of the derived metadata, including geocoded locations --
+for standing up a new instance without scraping and deriving it all again.
+
+A snapshot is a gzipped file of JSON lines.  The first line is a header with
+the snapshot format version and the phillyleg migration the data was dumped
+at.  Each line after that is a chunk of rows from one table.  Geometries are
+stored as EWKT, and dates and times in ISO 8601 format.
+"""
+
+import datetime
+import decimal
+import gzip
+import json
+from django.contrib.gis.db.models import GeometryField
+from django.contrib.gis.geos import GEOSGeometry
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import get_app, get_models
+
+from phillyleg.models import LegKeyLease, MetadataJob
+
+SNAPSHOT_FORMAT = 'councilmatic-snapshot'
+SNAPSHOT_VERSION = 1
+
+# Work in progress on one instance means nothing to another.
+EXCLUDED_MODELS = (LegKeyLease, MetadataJob)
+
+
+class SnapshotError (Exception):
+    pass
+
+
+def get_snapshot_models():
+    """
+    Get the models whose tables go into a snapshot, including the tables
+    behind many-to-many fields.
+    """
+    snapshot_models = []
+    for model in get_models(get_app('phillyleg')):
+        if model in EXCLUDED_MODELS:
+            continue
+
+        snapshot_models.append(model)
+        for field in model._meta.local_many_to_many:
+            through = field.rel.through
+            if through._meta.auto_created and through not in snapshot_models:
+                snapshot_models.append(through)
+
+    return snapshot_models
+
+
+def get_schema_version():
+    """
+    Get the name of the latest phillyleg migration applied to the database.
+    """
+    from south.models import MigrationHistory
+    migrations = MigrationHistory.objects.filter(app_name='phillyleg')\
+        .order_by('-migration').values_list('migration', flat=True)[:1]
+    return migrations[0] if migrations else None
+
+
+def dump_value(field, value):
+    if value is None:
+        return None
+    if isinstance(field, GeometryField):
+        if not isinstance(value, GEOSGeometry):
+            value = GEOSGeometry(value)
+        return value.ewkt
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    return value
+
+
+def load_value(field, value):
+    if value is None:
+        return None
+    if isinstance(field, GeometryField):
+        return GEOSGeometry(value)
+    return field.to_python(value)
+
+
+@transaction.commit_on_success
+def dump_snapshot(path, chunk_size=1000):
+    """
+    Write all of the snapshot tables to the file at the given path, all read
+    from the same moment in one read-only transaction.  Returns the number of
+    rows written from each table.
+    """
+    _start_consistent_read()
+
+    counts = {}
+    snapshot = gzip.open(path, 'wb')
+    try:
+        header = {'format': SNAPSHOT_FORMAT, 'version': SNAPSHOT_VERSION,
+                  'schema': get_schema_version(),
+                  'created': datetime.datetime.now().isoformat()}
+        snapshot.write(json.dumps(header) + '\n')
+
+        for model in get_snapshot_models():
+            counts[model._meta.db_table] = _dump_table(snapshot, model, chunk_size)
+    finally:
+        snapshot.close()
+
+    return counts
+
+
+def _start_consistent_read():
+    # Each table is read a page at a time, in a query per page.  Under the
+    # default READ COMMITTED, each of those queries would see whatever had
+    # been committed when it ran, so a scrape running during the dump could
+    # leave files in the snapshot pointing at sponsors or metadata that
+    # aren't.
+    if connection.vendor == 'postgresql':
+        # SET TRANSACTION has to be the first statement in the transaction,
+        # so finish off anything that the connection already has open.
+        transaction.commit()
+        connection.cursor().execute(
+            'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+
+
+def _dump_table(snapshot, model, chunk_size):
+    fields = model._meta.local_fields
+    pk_name = model._meta.pk.attname
+    rows = model._default_manager.order_by(pk_name)\
+        .values_list(*[field.attname for field in fields])
+
+    # Page by primary key, so that no more than a chunk is ever in memory.
+    pk_index = [field.attname for field in fields].index(pk_name)
+    count = 0
+    last_pk = None
+    while True:
+        page = rows if last_pk is None else rows.filter(**{pk_name + '__gt': last_pk})
+        chunk = list(page[:chunk_size])
+        if not chunk:
+            return count
+
+        snapshot.write(json.dumps({
+            'table': model._meta.db_table,
+            'columns': [field.column for field in fields],
+            'rows': [[dump_value(field, value) for field, value in zip(fields, row)]
+                     for row in chunk],
+        }) + '\n')
+
+        count += len(chunk)
+        last_pk = chunk[-1][pk_index]
+
+
+def has_data():
+    return any(model._base_manager.exists() for model in get_snapshot_models())
+
+
+@transaction.commit_on_success
+def load_snapshot(path, replace=False, check_schema=True):
+    """
+    Load a snapshot into the database, in one transaction.  The rows are
+    inserted in bulk, as they are, with foreign key checks deferred until
+    they're all in.  Unless ``replace`` is True, the tables must be empty;
+    if it is, whatever is queued up for the replaced rows is cleared too.
+    Returns the number of rows loaded into each table.
+    """
+    snapshot_models = get_snapshot_models()
+    models_by_table = dict((model._meta.db_table, model) for model in snapshot_models)
+
+    snapshot = gzip.open(path, 'rb')
+    try:
+        header = json.loads(snapshot.readline() or 'null')
+        if not header or header.get('format') != SNAPSHOT_FORMAT:
+            raise SnapshotError('%s is not a snapshot' % (path,))
+        if header.get('version') != SNAPSHOT_VERSION:
+            raise SnapshotError('Snapshot version %s is not supported (expected %s)' %
+                                (header.get('version'), SNAPSHOT_VERSION))
+        if check_schema and header.get('schema') != get_schema_version():
+            raise SnapshotError('The snapshot was dumped at migration %s, but the '
+                                'database is at %s' %
+                                (header.get('schema'), get_schema_version()))
+
+        counts = dict((table, 0) for table in models_by_table)
+        with connection.constraint_checks_disabled():
+            if replace:
+                _clear_tables(snapshot_models)
+            elif has_data():
+                raise SnapshotError('The database already has legislation data in it')
+
+            for line in snapshot:
+                chunk = json.loads(line)
+                model = models_by_table.get(chunk['table'])
+                if model is None:
+                    raise SnapshotError('Unknown table %s' % (chunk['table'],))
+
+                counts[chunk['table']] += _load_chunk(model, chunk)
+    finally:
+        snapshot.close()
+
+    # The constraints weren't checked as the rows went in, so check now.
+    connection.check_constraints(table_names=list(models_by_table))
+
+    cursor = connection.cursor()
+    for sql in connection.ops.sequence_reset_sql(no_style(), snapshot_models):
+        cursor.execute(sql)
+
+    return counts
+
+
+def _clear_tables(snapshot_models):
+    # Work in progress on the rows being replaced (e.g., queued metadata
+    # jobs) would be left pointing at rows that may not come back.
+    dependent_models = [model for model in EXCLUDED_MODELS
+                        if any(field.rel and field.rel.to in snapshot_models
+                               for field in model._meta.local_fields)]
+
+    cursor = connection.cursor()
+    qn = connection.ops.quote_name
+    for model in dependent_models + list(reversed(snapshot_models)):
+        cursor.execute('DELETE FROM %s' % (qn(model._meta.db_table),))
+
+
+def _load_chunk(model, chunk):
+    fields_by_column = dict((field.column, field) for field in model._meta.local_fields)
+    try:
+        fields = [fields_by_column[column] for column in chunk['columns']]
+    except KeyError, e:
+        raise SnapshotError('Unknown column %s in table %s' % (e, chunk['table']))
+
+    objs = []
+    for row in chunk['rows']:
+        obj = model()
+        for field, value in zip(fields, row):
+            setattr(obj, field.attname, load_value(field, value))
+        objs.append(obj)
+
+    # Insert the rows raw, so that timestamps aren't touched, in batches that
+    # the backend can take.
+    batch_size = max(connection.ops.bulk_batch_size(fields, objs), 1)
+    for start in xrange(0, len(objs), batch_size):
+        model._base_manager._insert(objs[start:start + batch_size],
+                                    fields=fields, raw=True)
+
+    return len(objs)
@@ -3,11 +3,38 @@ import os
 import bs4 as bs
 import datetime as dt
 import mock
+import urllib2
 from StringIO import StringIO
+from django.conf import settings
 
 from phillyleg.management.scraper_wrappers import PhillyLegistarSiteWrapper
 from phillyleg.management.scraper_wrappers import LegistarApiWrapper
+from phillyleg.management.scraper_wrappers import ScraperWikiSourceWrapper
 from phillyleg.management.scraper_wrappers import CouncilmaticDataStoreWrapper
+from phillyleg.management.scraper_wrappers.http_session import HttpSession
+from phillyleg.management.scraper_wrappers.http_session import RecordingSession
+from phillyleg.management.scraper_wrappers.http_session import ReplaySession
+from phillyleg.management.scraper_wrappers.pipeline import ScrapePipeline
+from phillyleg.management.scraper_wrappers.ratelimit import TokenBucket, call_with_backoff
+from phillyleg.management.scraper_wrappers.scheduler import PollInterval, RefreshScheduler
+from phillyleg.management.scraper_wrappers.sharding import KeyRangeWorker
+from utils.stats import StageStats
+
+def scraped_file(key=1, descriptions=(), date_taken=dt.date(2011, 8, 11)):
+    """
+    Build a scraped (record, attachments, actions, minutes) tuple for a bill,
+    with one action taken on ``date_taken`` for each of ``descriptions``.
+    """
+    record = {'key': key, 'id': str(key), 'url': 'http://example.com/',
+              'type': 'Bill', 'status': 'Introduced', 'title': 'testing',
+              'controlling_body': 'Council', 'version': '0',
+              'intro_date': dt.date(2011, 8, 11), 'final_date': '',
+              'sponsors': []}
+    actions = [{'key': key, 'date_taken': date_taken,
+                'acting_body': 'Council', 'description': description,
+                'motion': '', 'minutes_url': '', 'notes': ''}
+               for description in descriptions]
+    return record, [], actions, []
 
 class LegistarTests (TestCase):
 
@@ -150,3 +177,937 @@ class OrmStoreTests (TestCase):
             self.fail('Shouldn\'t have raised a DatabaseError')
         else:
             pass
+
+    def test_SavesRestOfBatchWhenOneFileFails(self):
+        from phillyleg.models import LegFile, LegAction
+
+        LegFile.objects.all().delete()
+
+        ds = CouncilmaticDataStoreWrapper()
+        failed_keys = ds.save_legis_files(
+            [scraped_file(1, ['Introduced'], dt.date(2011, 8, 11)),
+             scraped_file(2, ['Introduced'], 'not a date'),
+             scraped_file(3, ['Introduced'], dt.date(2011, 8, 12))],
+            batch_size=3)
+
+        self.assertEqual(failed_keys, [2])
+
+        self.assertEqual(set(LegFile.objects.values_list('key', flat=True)),
+                         set([1, 3]))
+        self.assertEqual(LegAction.objects.count(), 2)
+
+
+    def test_SkipsUnchangedFiles(self):
+        from phillyleg.models import LegFile
+
+        LegFile.objects.all().delete()
+
+        ds = CouncilmaticDataStoreWrapper()
+        ds.save_legis_file(*scraped_file())
+        legfile = LegFile.objects.get(key=1)
+
+        # The file is only marked as scraped; it isn't saved again.
+        ds.save_legis_file(*scraped_file())
+        refreshed = LegFile.objects.get(key=1)
+        self.assertEqual(refreshed.updated_datetime, legfile.updated_datetime)
+        self.assertGreaterEqual(refreshed.last_scraped, legfile.last_scraped)
+
+        # Saving it any other way doesn't count as scraping it.
+        refreshed.save()
+        self.assertEqual(LegFile.objects.get(key=1).last_scraped, refreshed.last_scraped)
+
+    def test_OnlyWritesNewActions(self):
+        from phillyleg.models import LegFile, LegAction
+
+        LegFile.objects.all().delete()
+
+        ds = CouncilmaticDataStoreWrapper()
+        ds.save_legis_file(*scraped_file(1, ['Introduced', 'Referred']))
+        first_ids = set(LegAction.objects.values_list('id', flat=True))
+
+        ds.save_legis_file(*scraped_file(1, ['Introduced', 'Referred', 'Reported']))
+        self.assertEqual(LegAction.objects.count(), 3)
+        self.assertTrue(first_ids <= set(LegAction.objects.values_list('id', flat=True)))
+
+    def test_SavesHighWaterMark(self):
+        from phillyleg.models import LegKeys
+
+        LegKeys.objects.all().delete()
+
+        ds = CouncilmaticDataStoreWrapper()
+        self.assertIsNone(ds.get_high_water_mark())
+
+        ds.save_high_water_mark(dt.date(2012, 10, 5))
+        self.assertEqual(ds.get_high_water_mark(), dt.date(2012, 10, 5))
+        self.assertEqual(ds.get_continuation_key(), ds.STARTING_KEY)
+
+    def test_GetsSummaryFingerprintsOfStoredFiles(self):
+        from phillyleg.models import LegFile
+
+        LegFile.objects.all().delete()
+        LegFile.objects.create(title='testing', key=123, summary_fingerprint='abc')
+        LegFile.objects.create(title='testing', key=124)
+
+        ds = CouncilmaticDataStoreWrapper()
+        fingerprints = ds.get_summary_fingerprints()
+
+        self.assertEqual(fingerprints.keys(), [123])
+        self.assertEqual(fingerprints[123][0], 'abc')
+        self.assertIsNotNone(fingerprints[123][1])
+
+    def test_KeyLeasesAreClaimedOnce(self):
+        from phillyleg.models import LegKeyLease
+
+        LegKeyLease.objects.all().delete()
+        ds = CouncilmaticDataStoreWrapper()
+        hour = dt.timedelta(hours=1)
+
+        self.assertEqual(ds.plan_key_leases(0, 25, 10), 3)
+        self.assertEqual(ds.plan_key_leases(0, 25, 10), 0)
+
+        first = ds.claim_key_lease('worker-1', hour)
+        second = ds.claim_key_lease('worker-2', hour)
+        self.assertNotEqual(first.pk, second.pk)
+
+        # Once a lease expires, another worker can take it over, and the
+        # first worker can no longer renew it.
+        LegKeyLease.objects.filter(pk=first.pk).update(
+            expires=dt.datetime.now() - hour)
+        ds.claim_key_lease('worker-3', hour)
+        third = ds.claim_key_lease('worker-3', hour)
+        self.assertEqual(third.pk, first.pk)
+        self.assertFalse(ds.renew_key_lease(first, 'worker-1', 5, hour))
+        self.assertIsNone(ds.claim_key_lease('worker-4', hour))
+
+    def test_PdfMappingLoadsTextLazily(self):
+        from phillyleg.models import LegFile, LegFileAttachment
+
+        LegFile.objects.all().delete()
+        legfile = LegFile.objects.create(title='testing', key=123)
+        LegFileAttachment.objects.create(file=legfile, description='doc',
+            url='http://example.com/doc.pdf', fulltext='This is the text')
+
+        ds = CouncilmaticDataStoreWrapper()
+        mapping = ds.pdf_mapping
+
+        self.assertEqual(len(mapping.cache), 0)
+        self.assertEqual(mapping['http://example.com/doc.pdf'], 'This is the text')
+        self.assertNotIn('http://example.com/other.pdf', mapping)
+        self.assertEqual(len(mapping.cache), 1)
+
+class CsvImportTests (TestCase):
+    def test_LoadsFilesAndSponsorsInBulk(self):
+        from phillyleg.management.commands.csvimport import LegFileLoader
+        from phillyleg.models import LegFile
+
+        LegFile.objects.all().delete()
+        LegFile.objects.create(title='old title', key=2)
+
+        def row(key, title, sponsors):
+            return {'key': str(key), 'title': title, 'status': 'Introduced',
+                    'url': 'http://example.com/', 'controlling_body': 'Council',
+                    'contact': '', 'version': '0', 'type': 'Bill',
+                    'intro_date': '08/11/2011', 'final_date': '',
+                    'sponsors': sponsors}
+
+        loader = LegFileLoader(batch_size=2)
+        keys = loader.load([row(1, 'first', 'Jones, Smith'),
+                            row(2, 'second', ['Smith']),
+                            row(3, 'third', '')])
+
+        self.assertEqual(keys, [1, 2, 3])
+        self.assertEqual((loader.created, loader.updated), (2, 1))
+        self.assertEqual(LegFile.objects.get(key=2).title, 'second')
+        self.assertEqual(LegFile.objects.get(key=1).intro_date, dt.date(2011, 8, 11))
+        self.assertEqual(sorted(LegFile.objects.get(key=1).sponsors
+                                .values_list('real_name', flat=True)),
+                         ['Jones', 'Smith'])
+        self.assertEqual(LegFile.objects.get(key=2).sponsors.get().real_name, 'Smith')
+
+    def test_UpdatesStoredFilesAndQueuesTheirMetadata(self):
+        from phillyleg.management.commands.csvimport import LegFileLoader
+        from phillyleg.models import LegFile, MetadataJob
+
+        LegFile.objects.all().delete()
+        for key in (1, 2, 3):
+            LegFile.objects.create(title='old title', key=key,
+                                   final_date=dt.date(2011, 1, 1))
+
+        loader = LegFileLoader()
+        keys = loader.load([{'key': '1', 'title': 'first', 'final_date': ''},
+                            {'key': '2', 'title': 'second', 'final_date': '08/11/2011'},
+                            {'key': '3', 'title': 'third', 'final_date': '',
+                             'intro_date': '08/11/2011'}])
+        with mock.patch.dict(settings.LEGISLATION, {'DEFER_METADATA': True}):
+            loader.update_metadata(keys)
+
+        self.assertEqual(loader.updated, 3)
+        self.assertEqual(list(LegFile.objects.order_by('key')
+                              .values_list('title', 'final_date')),
+                         [('first', None), ('second', dt.date(2011, 8, 11)),
+                          ('third', None)])
+        self.assertEqual(LegFile.objects.get(key=3).intro_date, dt.date(2011, 8, 11))
+        self.assertEqual(MetadataJob.objects.filter(legfile__in=keys).count(),
+                         3 * len(LegFile.METADATA_KINDS))
+
+class SnapshotTests (TestCase):
+    def test_RestoresRowsAsTheyWere(self):
+        import tempfile
+        from phillyleg.models import CouncilMember, LegFile
+        from phillyleg.snapshot import dump_snapshot, load_snapshot
+
+        LegFile.objects.all().delete()
+        legfile = LegFile.objects.create(title='testing', key=123,
+                                         intro_date=dt.date(2011, 8, 11))
+        member = CouncilMember.objects.create(real_name='Jones')
+        legfile.sponsors.add(member)
+
+        fd, path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(fd)
+        try:
+            dump_snapshot(path, chunk_size=1)
+            counts = load_snapshot(path, replace=True)
+        finally:
+            os.remove(path)
+
+        self.assertEqual(counts['phillyleg_legfile'], 1)
+        restored = LegFile.objects.get(key=123)
+        self.assertEqual(restored.updated_datetime, legfile.updated_datetime)
+        self.assertEqual(restored.intro_date, dt.date(2011, 8, 11))
+        self.assertEqual(list(restored.sponsors.all()), [member])
+
+    def test_ClearsQueuedJobsWhenReplacing(self):
+        import tempfile
+        from phillyleg.models import LegFile, MetadataJob
+        from phillyleg.snapshot import dump_snapshot, load_snapshot
+
+        LegFile.objects.all().delete()
+        legfile = LegFile.objects.create(title='testing', key=123)
+        MetadataJob.objects.enqueue(legfile)
+
+        fd, path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(fd)
+        try:
+            dump_snapshot(path)
+            load_snapshot(path, replace=True)
+        finally:
+            os.remove(path)
+
+        self.assertFalse(MetadataJob.objects.exists())
+
+    def test_DumpsFromOneReadOnlyTransaction(self):
+        import tempfile
+        from django.db import connection
+        from phillyleg.snapshot import dump_snapshot
+
+        if connection.vendor != 'postgresql':
+            return
+
+        fd, path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(fd)
+        saved = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            query_count = len(connection.queries)
+            dump_snapshot(path)
+            statements = [query['sql'] for query in connection.queries[query_count:]]
+        finally:
+            connection.use_debug_cursor = saved
+            os.remove(path)
+
+        self.assertEqual(statements[0],
+                         'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+
+class RebuildMetadataTests (TestCase):
+    def test_ResumesFromTheChunksLeftToDo(self):
+        import tempfile
+        from phillyleg.management.commands import rebuild_metadata
+        from phillyleg.models import LegFile, LegMinutes
+
+        LegFile.objects.all().delete()
+        LegMinutes.objects.all().delete()
+        for key in (1, 2, 3):
+            LegFile(key=key, title='file %s' % key).save(update_words=False,
+                update_mentions=False, update_locations=False, update_topics=False)
+
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        progress = rebuild_metadata.RebuildProgress(path, ['words'], 2)
+        progress.mark_done(('legfile', 1, 3))
+        try:
+            rebuild_metadata.Command().execute(kinds='words', workers=1,
+                chunk_size=2, progress_file=path, restart=False)
+            self.assertFalse(os.path.exists(path))
+        finally:
+            progress.clear()
+
+        self.assertEqual(set(LegFile.objects.get(key=3).metadata.words
+                             .values_list('value', flat=True)),
+                         set(['file', '3']))
+        for key in (1, 2):
+            self.assertFalse(LegFile.objects.get(key=key).metadata.words.exists())
+
+class ProcessMetadataTests (TestCase):
+    def test_KeepsGoingAfterAFailedJob(self):
+        from phillyleg.management.commands.process_metadata import process_jobs
+        from phillyleg.models import LegFile, LegMinutes, MetadataJob
+
+        LegFile.objects.all().delete()
+        LegMinutes.objects.all().delete()
+        with mock.patch.dict(settings.LEGISLATION, {'DEFER_METADATA': True}):
+            LegFile(key=1, title='alpha beta').save(update_locations=False)
+            LegFile(key=2, title='alpha gamma').save(update_locations=False)
+            minutes = LegMinutes(url='http://example.com/minutes.pdf', fulltext='beta')
+            minutes.save(update_locations=False)
+
+        # The first file's words are created, but then it fails, and they're
+        # rolled back.
+        def mentioned_legfiles(legfile):
+            if legfile.key == 1:
+                raise ValueError('Failing on purpose')
+            return []
+
+        with mock.patch.object(LegFile, 'mentioned_legfiles', mentioned_legfiles):
+            process_jobs(batch_size=2)
+
+        self.assertEqual(set(MetadataJob.objects.values_list('legfile', 'attempts')),
+                         set([(1, 1)]))
+        self.assertEqual(set(LegFile.objects.get(key=2).metadata.words
+                             .values_list('value', flat=True)),
+                         set(['alpha', 'gamma']))
+        self.assertEqual(list(LegMinutes.objects.get(pk=minutes.pk).metadata.words
+                              .values_list('value', flat=True)),
+                         ['beta'])
+
+
+class HostedLegistarTests (TestCase):
+    def make_wrapper(self, **options):
+        from phillyleg.management.scraper_wrappers.sources import hosted_legistar_scraper
+
+        with mock.patch.object(hosted_legistar_scraper, 'LegistarScraper'):
+            return hosted_legistar_scraper.HostedLegistarSiteWrapper(
+                hostname='example.legistar.com', **options)
+
+    def make_summary(self, key, intro_date):
+        return {'URL': 'http://example.legistar.com/LegislationDetail.aspx?ID=%s' % key,
+                'Intro Date': intro_date}
+
+    def test_SweepsOldFilesWithoutHighWaterMark(self):
+        wrapper = self.make_wrapper()
+        wrapper.set_high_water_mark(None)
+        wrapper.scraper.searchLegislation.return_value = iter([])
+
+        self.assertEqual(wrapper.check_for_new_content(0), (None, None))
+        wrapper.scraper.searchLegislation.assert_called_once_with(
+            '', created_before='2012-10-5')
+
+    def test_FullSweepSearchesUpToToday(self):
+        from phillyleg.management.commands.updatelegfiles import prepare_new_file_search
+
+        wrapper = self.make_wrapper()
+        wrapper.scraper.searchLegislation.return_value = iter([])
+        ds = mock.Mock()
+        ds.get_high_water_mark.return_value = dt.date(2013, 3, 4)
+        ds.get_summary_fingerprints.return_value = {}
+
+        prepare_new_file_search(wrapper, ds, full_sweep=True)
+        wrapper.check_for_new_content(0)
+
+        tomorrow = dt.date.today() + dt.timedelta(days=1)
+        wrapper.scraper.searchLegislation.assert_called_once_with(
+            '', created_before=tomorrow.strftime('%Y-%m-%d'))
+
+    def test_SeesNewestDateOfUnchangedSummaries(self):
+        wrapper = self.make_wrapper()
+        changed = self.make_summary(1, '01/02/2013')
+        unchanged = self.make_summary(2, '03/04/2013')
+        wrapper.init_summary_fingerprints(
+            {2: (wrapper.fingerprint_summary(unchanged), dt.datetime.now())})
+        wrapper.scraper.searchLegislation.return_value = iter([changed, unchanged])
+
+        self.assertEqual(wrapper.check_for_new_content(0), (0, changed))
+        self.assertEqual(wrapper.check_for_new_content(0), (None, None))
+        self.assertEqual(wrapper.newest_date_seen, dt.date(2013, 3, 4))
+
+    def test_SavedFilesAreUnchangedWhenListedAgain(self):
+        from phillyleg.models import LegFile
+
+        LegFile.objects.all().delete()
+        wrapper = self.make_wrapper()
+        wrapper.scraper.expandLegislationSummary.return_value = (
+            {'Sponsors': [], 'Current Controlling Legislative Body': 'Council'}, [])
+
+        # The listing has no Final Date or Version columns.
+        def listing_row():
+            summary = self.make_summary(123, '01/02/2013')
+            summary.update({'Record #': '130001', 'Type': 'Bill',
+                            'Status': 'Introduced', 'Title': 'testing'})
+            return summary
+
+        record, attachments, actions, minutes = \
+            wrapper.scrape_legis_file(None, listing_row())
+        self.assertEqual(record['summary_fingerprint'],
+                         wrapper.fingerprint_summary(listing_row()))
+
+        ds = CouncilmaticDataStoreWrapper()
+        ds.save_legis_file(record, attachments, actions, minutes)
+        wrapper.init_summary_fingerprints(ds.get_summary_fingerprints())
+
+        self.assertTrue(wrapper.is_summary_unchanged(listing_row()))
+
+    def test_ExpandsHistoryRowsInOrder(self):
+        import random
+        import time
+
+        wrapper = self.make_wrapper(history_workers=4, requests_per_second=1000)
+        def expandHistorySummary(act):
+            time.sleep(random.random() / 100)
+            return {'row': act['Date']}, []
+        scraper = mock.Mock()
+        scraper.expandHistorySummary = mock.Mock(side_effect=expandHistorySummary)
+        wrapper.get_scraper = mock.Mock(return_value=scraper)
+
+        history = [{'Date': str(day)} for day in range(20)]
+        try:
+            expanded = wrapper.expand_history(history)
+        finally:
+            wrapper.close()
+
+        self.assertEqual(expanded, [(act, ({'row': act['Date']}, []))
+                                    for act in history])
+        self.assertIsNone(wrapper.history_pool)
+
+    def test_ThreadScrapersShareCookies(self):
+        from phillyleg.management.scraper_wrappers.sources import hosted_legistar_scraper
+
+        wrapper = self.make_wrapper()
+        with mock.patch.object(hosted_legistar_scraper, 'LegistarScraper'):
+            scraper = wrapper.get_scraper()
+
+        scraper.br.set_cookiejar.assert_called_once_with(wrapper.cookie_jar)
+        wrapper.scraper.br.set_cookiejar.assert_called_once_with(wrapper.cookie_jar)
+
+class ScrapePipelineTests (TestCase):
+    def make_source(self, last_key):
+        import random
+        import time
+
+        source = mock.Mock(max_key_gap=None)
+        source.check_for_new_content = mock.Mock(
+            side_effect=lambda key: (key + 1, key + 1) if key < last_key else (key, None))
+        def scrape_legis_file(key, source_obj):
+            time.sleep(random.random() / 100)
+            return ({'key': key}, [], [], [])
+        source.scrape_legis_file = mock.Mock(side_effect=scrape_legis_file)
+        return source
+
+    def test_YieldsFilesInKeyOrder(self):
+        source = self.make_source(last_key=50)
+        pipeline = ScrapePipeline(source, workers=4)
+
+        keys = [key for key, scraped in pipeline.scrape(0)]
+        self.assertEqual(keys, range(1, 51))
+
+    def test_RaisesScrapeErrorsInOrder(self):
+        source = self.make_source(last_key=50)
+        source.scrape_legis_file.side_effect = \
+            lambda key, obj: ({'key': key}, [], [], []) if key != 10 else 1/0
+        pipeline = ScrapePipeline(source, workers=4)
+
+        keys = []
+        try:
+            for key, scraped in pipeline.scrape(0):
+                keys.append(key)
+        except ZeroDivisionError:
+            pass
+        else:
+            self.fail('Should have raised the scraping error')
+        self.assertEqual(keys, range(1, 10))
+
+    def test_FetchesGivenKeysInOrder(self):
+        source = self.make_source(last_key=50)
+        source.fetch_legis_file = mock.Mock(
+            side_effect=lambda key: source.scrape_legis_file(key, None))
+        pipeline = ScrapePipeline(source, workers=4)
+
+        keys = [key for key, scraped in pipeline.fetch([7, 3, 42, 1, 9])]
+        self.assertEqual(keys, [7, 3, 42, 1, 9])
+        self.assertFalse(source.check_for_new_content.called)
+
+    def test_FetchesKeysInWorkersUntilTooManyAreMissing(self):
+        import random
+        import time
+
+        missing_keys = set(range(5, 8)) | set(range(11, 50))
+        def fetch_legis_file(key):
+            time.sleep(random.random() / 100)
+            return None if key in missing_keys else ({'key': key}, [], [], [])
+        source = mock.Mock(max_key_gap=4)
+        source.fetch_legis_file = mock.Mock(side_effect=fetch_legis_file)
+        pipeline = ScrapePipeline(source, workers=4)
+
+        keys = [key for key, scraped in pipeline.scrape(0)]
+        self.assertEqual(keys, [1, 2, 3, 4, 8, 9, 10])
+        self.assertFalse(source.check_for_new_content.called)
+        self.assertFalse(source.scrape_legis_file.called)
+
+    def test_ClosesThreadConnectionsAfterEachFile(self):
+        source = self.make_source(last_key=20)
+        pipeline = ScrapePipeline(source, workers=4)
+
+        with mock.patch('phillyleg.management.scraper_wrappers.pipeline.connection') as connection:
+            keys = [key for key, scraped in pipeline.scrape(0)]
+
+        # Once for each file, and once for the producer.
+        self.assertEqual(len(keys), 20)
+        self.assertEqual(connection.close.call_count, 21)
+
+
+
+class AttachmentTextExtractionTests (TestCase):
+    def test_ConvertsIdenticalPdfsOnce(self):
+        import tempfile
+        from phillyleg.management.scraper_wrappers import extraction
+
+        store_root = tempfile.mkdtemp()
+        pdf_url = 'file://' + os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), 'pdfs', '11530.pdf')
+
+        with mock.patch.object(extraction, 'pdf_data_to_text',
+                               return_value=u'This is the text') as convert:
+            extraction.extract_url_text(pdf_url, store_root)
+            url, text = extraction.extract_url_text(pdf_url, store_root)
+
+        self.assertEqual(text, u'This is the text')
+        self.assertEqual(convert.call_count, 1)
+
+
+class HttpSessionTests (TestCase):
+    def setUp(self):
+        import BaseHTTPServer
+        import tempfile
+        import threading
+
+        requests_seen = self.requests_seen = []
+
+        class StubHandler (BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                requests_seen.append((self.client_address, dict(self.headers)))
+                if self.path == '/missing':
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                elif self.headers.get('If-None-Match') == '"v1"':
+                    self.send_response(304)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                else:
+                    body = 'Hello, world'
+                    self.send_response(200)
+                    self.send_header('ETag', '"v1"')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+        self.base_url = 'http://127.0.0.1:%s' % (self.server.server_address[1],)
+        self.cache_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_RefetchesUnchangedPagesConditionally(self):
+        session = HttpSession(cache_root=self.cache_root)
+
+        first = session.urlopen(self.base_url + '/page').read()
+        second = session.urlopen(self.base_url + '/page').read()
+
+        self.assertEqual(first, 'Hello, world')
+        self.assertEqual(second, 'Hello, world')
+        self.assertNotIn('if-none-match', self.requests_seen[0][1])
+        self.assertEqual(self.requests_seen[1][1]['if-none-match'], '"v1"')
+
+    def test_DoesNotCacheLargeResponses(self):
+        session = HttpSession(cache_root=self.cache_root, max_cached_size=5)
+
+        session.get(self.base_url + '/page')
+        session.get(self.base_url + '/page')
+
+        self.assertNotIn('if-none-match', self.requests_seen[1][1])
+        self.assertEqual(os.listdir(self.cache_root), [])
+
+    def test_ReusesConnections(self):
+        session = HttpSession()
+
+        session.get(self.base_url + '/page')
+        session.get(self.base_url + '/page')
+
+        self.assertEqual(self.requests_seen[0][0], self.requests_seen[1][0])
+
+    def test_RaisesHttpErrorLikeUrllib2(self):
+        session = HttpSession()
+
+        try:
+            session.urlopen(self.base_url + '/missing')
+        except urllib2.HTTPError, err:
+            self.assertEqual(err.code, 404)
+        else:
+            self.fail('Expected an HTTPError')
+
+    def test_ReplaysRecordedResponses(self):
+        recorder = RecordingSession(self.cache_root)
+        recorder.get(self.base_url + '/page')
+        self.assertRaises(urllib2.HTTPError, recorder.get, self.base_url + '/missing')
+
+        replayer = ReplaySession(self.cache_root)
+        self.assertEqual(replayer.get(self.base_url + '/page'), 'Hello, world')
+        self.assertRaises(urllib2.HTTPError, replayer.get, self.base_url + '/missing')
+        self.assertRaises(urllib2.HTTPError, replayer.get, self.base_url + '/other')
+        self.assertEqual(len(self.requests_seen), 2)
+
+
+class RefreshSchedulerTests (TestCase):
+    def test_RanksLivelyFilesFirst(self):
+        now = dt.datetime(2012, 6, 1, 12)
+        scheduler = RefreshScheduler(now=now)
+        week_ago = now - dt.timedelta(days=7)
+
+        candidates = [
+            # key, status, intro_date, last_action_date, last_scraped
+            (1, 'Adopted', dt.date(2009, 1, 5), dt.date(2009, 2, 1), week_ago),
+            (2, 'In Committee', dt.date(2012, 5, 1), dt.date(2012, 5, 30), week_ago),
+            (3, 'In Committee', dt.date(2010, 3, 1), None, week_ago),
+            (4, 'In Committee', dt.date(2012, 5, 1), dt.date(2012, 5, 30), now),
+        ]
+
+        self.assertEqual(scheduler.rank(candidates), [2, 3, 1, 4])
+        self.assertEqual(scheduler.rank(candidates, limit=2), [2, 3])
+
+    def test_StopsRefreshingWhenOutOfTime(self):
+        scheduler = RefreshScheduler()
+        clock = mock.Mock(side_effect=[0, 0, 5, 10, 15])
+
+        keys = scheduler.within_budget([5, 4, 3, 2, 1], time_budget=10, clock=clock)
+        self.assertEqual(list(keys), [5, 4])
+
+    def test_RefreshesRankedFilesInBatches(self):
+        from phillyleg.management.commands.updatelegfiles import refresh_leg_files
+
+        source = mock.Mock(allows_concurrent_scraping=True)
+        source.fetch_legis_file.side_effect = \
+            lambda key: ({'key': key}, [], [], []) if key != 3 else None
+        ds = mock.Mock()
+        ds.save_legis_batch.return_value = []
+
+        refreshed = refresh_leg_files([5, 4, 3, 2, 1], source, ds,
+                                      workers=3, batch_size=2)
+
+        self.assertEqual(refreshed, 4)
+        self.assertEqual([[record['key'] for record, _, _, _ in args[0][0]]
+                          for args in ds.save_legis_batch.call_args_list],
+                         [[5, 4], [2, 1]])
+        self.assertFalse(ds.save_legis_file.called)
+        ds.reset_caches.assert_called_once_with()
+
+    def test_HoldsContinuationKeyBeforeFailedFiles(self):
+        from phillyleg.management.commands.updatelegfiles import import_leg_files
+
+        source = mock.Mock()
+        source.check_for_new_content.side_effect = \
+            lambda key: (key + 1, key + 1) if key < 8 else (key, None)
+        source.scrape_legis_file.side_effect = \
+            lambda key, obj: ({'key': key}, [], [], [])
+        ds = mock.Mock()
+        ds.save_legis_batch.side_effect = [[], [4], [], []]
+
+        import_leg_files(0, source, ds, save_key=True, batch_size=2)
+
+        self.assertEqual(ds.save_legis_batch.call_count, 4)
+        self.assertEqual([args[0][0] for args in ds.save_continuation_key.call_args_list],
+                         [2, 3])
+
+
+class PollIntervalTests (TestCase):
+    def test_BacksOffWhileQuiet(self):
+        interval = PollInterval(shortest=60, longest=300)
+
+        self.assertEqual([interval.next(0) for _ in range(4)], [120, 240, 300, 300])
+        self.assertEqual(interval.next(3), 60)
+        self.assertEqual(interval.next(0), 120)
+
+
+class KeyRangeWorkerTests (TestCase):
+    def test_ResumesFromRecordedProgress(self):
+        lease = mock.Mock(start_key=10, next_key=14, end_key=20)
+        ds = mock.Mock()
+        ds.claim_key_lease.side_effect = [lease, None]
+        ds.save_legis_batch.return_value = []
+        source = mock.Mock()
+        source.fetch_legis_file.side_effect = \
+            lambda key: ({'key': key}, [], [], []) if key % 2 else None
+
+        worker = KeyRangeWorker(source, ds, owner='worker', batch_size=3)
+        self.assertEqual(worker.run(), 1)
+
+        self.assertEqual([args[0][0] for args in source.fetch_legis_file.call_args_list],
+                         range(14, 20))
+        self.assertEqual([args[0][2] for args in ds.renew_key_lease.call_args_list],
+                         [17, 20])
+        ds.complete_key_lease.assert_called_once_with(lease, 'worker')
+
+    def test_HoldsProgressAtFailedFile(self):
+        lease = mock.Mock(start_key=10, next_key=10, end_key=20)
+        ds = mock.Mock()
+        ds.claim_key_lease.side_effect = [lease, None]
+        ds.save_legis_batch.side_effect = [[], [15]]
+        source = mock.Mock()
+        source.fetch_legis_file.side_effect = \
+            lambda key: ({'key': key}, ['attachment %s' % key], [], [])
+        extractor = mock.Mock()
+
+        worker = KeyRangeWorker(source, ds, owner='worker', batch_size=3,
+                                extractor=extractor)
+        self.assertEqual(worker.run(), 0)
+
+        self.assertEqual([args[0][2] for args in ds.renew_key_lease.call_args_list],
+                         [13, 15])
+        self.assertFalse(ds.complete_key_lease.called)
+        self.assertFalse(ds.release_key_lease.called)
+        self.assertEqual([args[0][0] for args in extractor.queue_missing_text.call_args_list],
+                         [['attachment %s' % key] for key in (10, 11, 12, 13, 14)])
+
+    def test_ReleasesLeaseOnError(self):
+        lease = mock.Mock(start_key=10, next_key=10, end_key=20)
+        ds = mock.Mock()
+        ds.claim_key_lease.return_value = lease
+        source = mock.Mock()
+        source.fetch_legis_file.side_effect = urllib2.URLError('timed out')
+
+        worker = KeyRangeWorker(source, ds, owner='worker')
+        self.assertRaises(urllib2.URLError, worker.run)
+        ds.release_key_lease.assert_called_once_with(lease, 'worker')
+
+
+class StageStatsTests (TestCase):
+    def test_SummarizesStageTimings(self):
+        clock = mock.Mock(side_effect=[0] + range(0, 20, 2) + [40])
+        stats = StageStats(clock=clock)
+
+        for _ in range(5):
+            with stats.timer('fetch'):
+                pass
+        stats.incr('files_scraped', 5)
+        stats.finish()
+
+        summary = stats.summary()
+        self.assertEqual(summary['elapsed'], 40)
+        self.assertEqual(summary['records_per_second'], 0.125)
+        self.assertEqual(summary['stages']['fetch']['count'], 5)
+        self.assertEqual(summary['stages']['fetch']['p50'], 2)
+        self.assertEqual(summary['stages']['fetch']['total'], 10)
+
+    def test_OnlyLogsQueriesWithinStages(self):
+        from django.db import connection
+
+        stats = StageStats()
+        saved = connection.use_debug_cursor
+        connection.use_debug_cursor = False
+        try:
+            with stats.timer('save'):
+                with stats.timer('metadata'):
+                    self.assertTrue(connection.use_debug_cursor)
+                self.assertTrue(connection.use_debug_cursor)
+
+            self.assertFalse(connection.use_debug_cursor)
+            self.assertEqual(connection.queries, [])
+        finally:
+            connection.use_debug_cursor = saved
+
+    def test_IncludesCacheStats(self):
+        from utils.lru import LRUCache
+        cache = LRUCache(1)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.get('a')
+
+        stats = StageStats()
+        stats.set_cache_stats('files', cache.stats())
+
+        self.assertEqual(stats.summary()['caches']['files'],
+                         {'size': 1, 'maxsize': 1, 'hits': 0, 'misses': 1,
+                          'evictions': 1})
+        self.assertIn('evictions=1', stats.format_summary())
+
+        # Clearing the cache between runs doesn't lose the counts.
+        cache.clear()
+        self.assertEqual(cache.stats()['size'], 0)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+class LRUCacheTests (TestCase):
+    def test_KeepsNothingWhenSizeIsZero(self):
+        from utils.lru import LRUCache
+        cache = LRUCache(0)
+        cache['a'] = 1
+
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['misses'], 1)
+
+
+class ScraperWikiSourceTests (TestCase):
+    def setUp(self):
+        import sqlite3
+        import tempfile
+
+        fd, self.db_file_name = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        conn = sqlite3.connect(self.db_file_name)
+        conn.executescript('''
+            create table swdata (key integer, id text, type text, url text,
+                status text, title text, controlling_body text,
+                intro_date text, final_date text, version text,
+                contact text, sponsors text);
+            create table attachments (key integer, description text, url text);
+            create table actions (key integer, date_taken text,
+                acting_body text, description text, motion text,
+                minutes_url text, notes text);
+            create table minutes (url text, fulltext text, date_taken text);
+
+            insert into swdata values (73, '000001', 'Bill', 'http://f/73',
+                'Passed', 'A bill', 'Council', '01/05/2012', '02/05/2012',
+                '1', 'Clerk', 'Alice, Bob');
+            insert into swdata values (75, '000002', 'Resolution', 'http://f/75',
+                'Adopted', 'A resolution', 'Council', '01/06/2012', '',
+                '1', 'Clerk', 'Bob');
+            insert into attachments values (75, 'Text', 'http://a/75.pdf');
+            insert into attachments values (74, 'Orphan', 'http://a/74.pdf');
+            insert into actions values (73, '2012-01-05', 'Council',
+                'Introduced', '', 'http://m/1', '');
+            insert into actions values (73, '2012-02-05', 'Council',
+                'Passed', '', 'http://m/1', '');
+            insert into actions values (75, '2012-01-06', 'Council',
+                'Adopted', '', 'http://m/2', '');
+            insert into minutes values ('http://m/1', 'Minutes 1', '2012-01-05T00:00:00');
+            insert into minutes values ('http://m/2', 'Minutes 2', '2012-01-06T00:00:00');
+        ''')
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        os.remove(self.db_file_name)
+
+    def test_StreamsSameFilesAsPerKeyScrape(self):
+        source = ScraperWikiSourceWrapper()
+        source.db_file_name = self.db_file_name
+
+        streamed = list(source.iter_legis_files(72))
+
+        scraped = []
+        curr_key = 72
+        while True:
+            curr_key, cursor = source.check_for_new_content(curr_key)
+            if cursor is None:
+                break
+            scraped.append(source.scrape_legis_file(curr_key, cursor))
+
+        self.assertEqual(len(streamed), 2)
+        self.assertEqual(streamed, scraped)
+        self.assertEqual(len(streamed[0][3]), 1)
+
+
+class CouncilMemberAliasResolverTests (TestCase):
+    def test_ResolvesNamesWithoutQueryingAgain(self):
+        from django.db import connection
+        from phillyleg.aliases import CouncilMemberAliasResolver
+        from phillyleg.models import CouncilMember, CouncilMemberAlias
+
+        CouncilMember.objects.all().delete()
+        member = CouncilMember.objects.create(real_name='Alice Smith')
+        CouncilMemberAlias.objects.create(member=member, name='Smith')
+
+        resolver = CouncilMemberAliasResolver()
+        resolver.load()
+
+        saved = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            query_count = len(connection.queries)
+            for _ in range(10):
+                self.assertEqual(resolver.resolve('Smith'), member)
+            self.assertEqual(len(connection.queries), query_count)
+        finally:
+            connection.use_debug_cursor = saved
+
+    def test_FlushesNewAliasesTogether(self):
+        from phillyleg.aliases import CouncilMemberAliasResolver
+        from phillyleg.models import CouncilMember, CouncilMemberAlias
+
+        CouncilMember.objects.all().delete()
+        resolver = CouncilMemberAliasResolver()
+
+        jones = resolver.resolve('Jones')
+        self.assertEqual(resolver.resolve('Jones'), jones)
+        resolver.resolve('Brown')
+        self.assertEqual(CouncilMemberAlias.objects.count(), 0)
+
+        resolver.flush()
+        self.assertEqual(
+            set(CouncilMemberAlias.objects.values_list('name', flat=True)),
+            set(['Jones', 'Brown']))
+
+    def test_ReloadsAfterInvalidation(self):
+        from phillyleg.aliases import CouncilMemberAliasResolver
+
+        resolver = CouncilMemberAliasResolver()
+        resolver.load()
+        self.assertFalse(resolver.is_stale())
+
+        CouncilMemberAliasResolver.invalidate()
+        self.assertTrue(resolver.is_stale())
+
+
+class RateLimitTests (TestCase):
+    def test_TokenBucketWaitsForTokens(self):
+        now = [0.0]
+        def sleep(seconds):
+            now[0] += seconds
+        bucket = TokenBucket(2, capacity=2, clock=lambda: now[0], sleep=sleep)
+
+        for _ in range(6):
+            bucket.acquire()
+
+        # Two requests go right away, and the rest at two per second.
+        self.assertAlmostEqual(now[0], 2.0)
+
+    def test_RetriesWithBackoff(self):
+        func = mock.Mock(side_effect=[urllib2.URLError('timed out'),
+                                      urllib2.URLError('timed out'),
+                                      'ok'])
+        sleep = mock.Mock()
+
+        result = call_with_backoff(func, ('arg',), retry_on=(urllib2.URLError,),
+                                   base_delay=1, sleep=sleep)
+
+        self.assertEqual(result, 'ok')
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertTrue(0 <= sleep.call_args_list[1][0][0] <= 2)
+
+    def test_GivesUpAfterTooManyTries(self):
+        func = mock.Mock(side_effect=urllib2.URLError('timed out'))
+
+        self.assertRaises(urllib2.URLError, call_with_backoff, func,
+                          retry_on=(urllib2.URLError,), tries=3,
+                          sleep=mock.Mock())
+        self.assertEqual(func.call_count, 3)
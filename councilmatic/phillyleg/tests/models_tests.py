@@ -5,6 +5,7 @@ import os
 import datetime as dt
 import mock
 from StringIO import StringIO
+from django.conf import settings
 
 from phillyleg.management.scraper_wrappers import PhillyLegistarSiteWrapper
 from phillyleg.models import *
@@ -20,6 +21,168 @@ class Test_LegFile_uniqueWords:
         assert_equal(words, set(['word1', 'word2', 'word3', 'hyphen-word1', 'hyphen-word2']))
 
 
+class Test__LegFileMetaData_setWords:
+
+    def setup(self):
+        LegFile.objects.all().delete()
+
+    @istest
+    def OnlyChangesLinksForChangedWords(self):
+        legfile = LegFile(key=1, title='alpha beta')
+        legfile.save(update_mentions=False, update_locations=False, update_topics=False)
+
+        Link = LegFileMetaData.words.through
+        alpha_link = Link.objects.get(legfilemetadata=legfile.metadata,
+                                      metadata_word__value='alpha')
+
+        legfile.title = 'alpha gamma'
+        legfile.save(update_mentions=False, update_locations=False, update_topics=False)
+
+        words = set(legfile.metadata.words.values_list('value', flat=True))
+        assert_equal(words, set(['alpha', 'gamma']))
+        assert_equal(Link.objects.get(legfilemetadata=legfile.metadata,
+                                      metadata_word__value='alpha').pk,
+                     alpha_link.pk)
+
+    @istest
+    def DoesNotLinkWordsFromRolledBackSaves(self):
+        from django.db import transaction
+
+        sid = transaction.savepoint()
+        MetaData_Word.objects.get_ids(['omega'])
+        transaction.savepoint_rollback(sid)
+
+        legfile = LegFile(key=1, title='alpha omega')
+        legfile.save(update_mentions=False, update_locations=False, update_topics=False)
+
+        assert_equal(set(legfile.metadata.words.values_list('value', flat=True)),
+                     set(['alpha', 'omega']))
+
+
+class Test__LegFile_updateTopics:
+
+    def setup(self):
+        LegFile.objects.all().delete()
+
+    @istest
+    def LinksNewAndStoredTopics(self):
+        MetaData_Topic.objects.get_or_create(topic='Zoning')
+
+        legfile = LegFile(key=1, title='Zoning and Parks')
+        with mock.patch.object(settings, 'TOPIC_CLASSIFIER',
+                               lambda title: title.split(' and ') + ['Zoning']):
+            legfile.save(update_words=False, update_mentions=False,
+                         update_locations=False)
+
+        assert_equal(set(legfile.metadata.topics.values_list('topic', flat=True)),
+                     set(['Zoning', 'Parks']))
+        assert_equal(MetaData_Topic.objects.filter(topic='Zoning').count(), 1)
+
+
+class Test__LegFileMetaData_setLocations:
+
+    def setup(self):
+        LegFile.objects.all().delete()
+        MetaData_Location.objects.all().delete()
+        GeocodeCacheEntry.objects.all().delete()
+
+    @istest
+    def GeocodesEachNormalizedAddressOnce(self):
+        from phillyleg.geocoding import CachedGeocoder, StubGeocoderBackend, use_geocoder
+
+        backend = StubGeocoderBackend({
+            '1500 Market Street': ('1500 Market St, Philadelphia, PA', (-75.166, 39.952))})
+        legfile = LegFile(key=1, title='testing')
+        legfile.save(update_words=False, update_mentions=False,
+                     update_locations=False, update_topics=False)
+
+        use_geocoder(CachedGeocoder(backend))
+        try:
+            with mock.patch.dict(settings.LEGISLATION, {'GEOCODE': True,
+                    'ADDRESS_SUFFIX': ', Philadelphia, PA'}):
+                legfile.metadata.set_locations([('1500 Market St.', ''),
+                                                ('1500 MARKET STREET', ''),
+                                                ('Nowhere Ave', '')])
+                legfile.metadata.set_locations([('1500 market st', ''),
+                                                ('Nowhere Avenue', '')])
+        finally:
+            use_geocoder(None)
+
+        assert_equal(len(backend.lookups), 2)
+        assert_equal(list(legfile.metadata.locations.values_list('matched_text', flat=True)),
+                     ['1500 market st'])
+        assert_equal(GeocodeCacheEntry.objects.get(found=False).normalized, 'nowhere ave')
+
+
+class Test__MetadataJob_queue:
+
+    def setup(self):
+        LegFile.objects.all().delete()
+
+    @istest
+    def QueuesEachKindOnceAndClaimsJobsOnce(self):
+        legfile = LegFile(key=1, title='alpha beta')
+        with mock.patch.dict(settings.LEGISLATION, {'DEFER_METADATA': True}):
+            legfile.save(update_locations=False)
+            legfile.save(update_locations=False)
+
+        kinds = set(legfile.metadata_jobs.values_list('kind', flat=True))
+        assert_equal(kinds, set(['words', 'mentions', 'topics']))
+
+        duration = dt.timedelta(minutes=10)
+        claimed_at = dt.datetime.now()
+        jobs = MetadataJob.objects.claim('worker-1', 10, duration)
+        assert_equal(len(jobs), 3)
+        assert_equal(MetadataJob.objects.claim('worker-2', 10, duration), [])
+
+        # A job that is requested again while it's being worked on stays in
+        # the queue.
+        MetadataJob.objects.enqueue(legfile, update_words=True, update_mentions=False,
+                                    update_locations=False, update_topics=False)
+        MetadataJob.objects.finish(jobs, 'worker-1', claimed_at)
+        assert_equal(list(MetadataJob.objects.available().values_list('kind', flat=True)),
+                     ['words'])
+
+    @istest
+    def RequeuesJobsQueuedInTheMeantime(self):
+        legfile = LegFile(key=1, title='alpha beta')
+        legfile.save(update_words=False, update_mentions=False,
+                     update_locations=False, update_topics=False)
+        MetadataJob.objects.enqueue(legfile, update_words=True, update_mentions=False,
+                                    update_locations=False, update_topics=False)
+        queued_at = legfile.metadata_jobs.get(kind='words').requested
+
+        # Another process queues the job between the read and the insert.
+        real_filter = MetadataJob.objects.filter
+        calls = []
+        def stale_filter(*args, **kwargs):
+            calls.append(kwargs)
+            if len(calls) == 1:
+                return MetadataJob.objects.none()
+            return real_filter(*args, **kwargs)
+
+        with mock.patch.object(MetadataJob.objects, 'filter', stale_filter):
+            MetadataJob.objects.enqueue(legfile, update_words=True, update_mentions=False,
+                                        update_locations=False, update_topics=False)
+
+        jobs = legfile.metadata_jobs.filter(kind='words')
+        assert_equal(jobs.count(), 1)
+        assert_true(jobs.get().requested >= queued_at)
+
+    @istest
+    def QueuesMinutesMetadata(self):
+        LegMinutes.objects.all().delete()
+
+        minutes = LegMinutes(url='http://example.com/minutes.pdf',
+                             fulltext='alpha beta at 1500 Market St.')
+        with mock.patch.dict(settings.LEGISLATION, {'DEFER_METADATA': True}):
+            minutes.save()
+
+        assert_equal(set(minutes.metadata_jobs.values_list('kind', flat=True)),
+                     set(['words', 'locations']))
+        assert_false(LegMinutesMetaData.objects.filter(legminutes=minutes).exists())
+
+
 class Test__LegFile_mentionedLegfiles:
 
     def setup(self):
@@ -127,17 +290,17 @@ class Test__LegFile_refresh:
         last_update_time = dt.datetime.now() - dt.timedelta(days=1, hours=1)
         legfile = LegFile(id='123456', key=73, updated_datetime=last_update_time, title='abcde')
 
-        legfile.get_data_source = lambda: self.PhillyLegistarFileWrapper()
+        legfile.get_data_source = lambda: self.PhillyLegistarFileWrapper(root_url='')
 
         legfile.refresh()
         assert_equal(legfile.title, '''Providing for the approval by the Council of the City of Philadelphia of a Revised Five Year Financial Plan for the City of Philadelphia covering Fiscal Years 2001 through 2005, and incorporating proposed changes with respect to Fiscal Year 2000, which is to be submitted by the Mayor to the Pennsylvania Intergovernmental Cooperation Authority (the "Authority") pursuant to the Intergovernmental Cooperation Agreement, authorized by an ordinance of this Council approved by the Mayor on January 3, 1992 (Bill No. 1563-A), by and between the City and the Authority.''')
 
     @istest
-    def updates_file_if_data_is_stale(self):
+    def doesnt_update_file_if_data_is_fresh(self):
         last_update_time = dt.datetime.now() - dt.timedelta(hours=23)
         legfile = LegFile(id='123456', key=73, updated_datetime=last_update_time, title='abcde')
 
-        legfile.get_data_source = lambda: self.PhillyLegistarFileWrapper()
+        legfile.get_data_source = lambda: self.PhillyLegistarFileWrapper(root_url='')
 
         legfile.refresh()
         assert_equal(legfile.title, '''abcde''')
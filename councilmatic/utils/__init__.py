@@ -3,10 +3,17 @@ import json
 import os
 import tempfile
 import requests
+import subprocess
 import urllib
 
 # Adapted from Scraperwiki utils
 
+def _run_quietly(cmd):
+    """runs a command without a shell, throwing away its output"""
+    # can't turn off output, so throw away even stderr yeuch
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(cmd, stdout=devnull, stderr=devnull)
+
 def pdftoxml(pdfdata):
     """converts pdf file to xml file"""
     pdffout = tempfile.NamedTemporaryFile(suffix='.pdf')
@@ -15,9 +22,8 @@ def pdftoxml(pdfdata):
 
     xmlin = tempfile.NamedTemporaryFile(mode='r', suffix='.xml')
     tmpxml = xmlin.name # "temph.xml"
-    cmd = '/usr/bin/pdftohtml -xml -nodrm -zoom 1.5 -enc UTF-8 -noframes "%s" "%s"' % (pdffout.name, os.path.splitext(tmpxml)[0])
-    cmd = cmd + " >/dev/null 2>&1" # can't turn off output, so throw away even stderr yeuch
-    os.system(cmd)
+    cmd = ['/usr/bin/pdftohtml', '-xml', '-nodrm', '-zoom', '1.5', '-enc', 'UTF-8', '-noframes', pdffout.name, os.path.splitext(tmpxml)[0]]
+    _run_quietly(cmd)
 
     pdffout.close()
     #xmlfin = open(tmpxml)
@@ -33,9 +39,8 @@ def pdftotxt(pdfdata):
 
     txtin = tempfile.NamedTemporaryFile(mode='r', suffix='.txt')
     tmptxt = txtin.name # "temph.xml"
-    cmd = '/usr/bin/pdftotext -enc UTF-8 -layout "%s" "%s"' % (pdffout.name, txtin.name)
-    cmd = cmd + " >/dev/null 2>&1" # can't turn off output, so throw away even stderr yeuch
-    os.system(cmd)
+    cmd = ['/usr/bin/pdftotext', '-enc', 'UTF-8', '-layout', pdffout.name, txtin.name]
+    _run_quietly(cmd)
 
     pdffout.close()
     txtdata = txtin.read()
@@ -53,24 +58,25 @@ def geocode(address, bounds, retries=5):
     global _geocode_day
     global _geocode_count
 
-    today = datetime.date.today()
-    if _geocode_day != today:
-        _geocode_count = 0
-        _geocode_day = today
+    for attempt in xrange(retries + 1):
+        today = datetime.date.today()
+        if _geocode_day != today:
+            _geocode_count = 0
+            _geocode_day = today
 
-    if _geocode_count > 2000:
-        raise TooManyGeocodeRequests("You're making a lot of geocoding requests.  You should consider slowing down, maybe?")
+        if _geocode_count > 2000:
+            raise TooManyGeocodeRequests("You're making a lot of geocoding requests.  You should consider slowing down, maybe?")
 
-    # Here's the default geocode request. Uses a reasonable bounding box.
-    response = requests.get(
-        'http://maps.googleapis.com/maps/api/geocode/json',
-        params={'address': address, 'sensor': 'false', 'bounds':'{0},{1}|{2},{3}'.format(*bounds)})
+        # Here's the default geocode request. Uses a reasonable bounding box.
+        response = requests.get(
+            'http://maps.googleapis.com/maps/api/geocode/json',
+            params={'address': address, 'sensor': 'false', 'bounds':'{0},{1}|{2},{3}'.format(*bounds)})
 
-    _geocode_count += 1
+        _geocode_count += 1
 
-    if response.status_code != 200 and retries > 0:
-        return geocode(address, bounds, retries-1)
-    if response.status_code != 200:
+        if response.status_code == 200:
+            break
+    else:
         return None
 
     response.encoding = 'UTF8'
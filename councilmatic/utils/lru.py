@@ -0,0 +1,105 @@
+import threading
+
+
+class LRUCache (object):
+    """
+    A dictionary-like cache that holds on to at most ``maxsize`` items,
+    discarding the least recently used item to make room for new ones.  A
+    ``maxsize`` of 0 turns the cache off; nothing is ever stored in it.
+
+    The cache keeps count of its hits, misses, and evictions over its whole
+    life (clearing it doesn't reset them), and is safe to share between
+    threads.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            # Each link is a list of [prev, next, key, value].  The root link
+            # is a sentinel; root[1] is the least recently used item, and
+            # root[0] is the most recently used.
+            self.root = root = []
+            root[:] = [root, root, None, None]
+            self.links = {}
+
+    def __len__(self):
+        return len(self.links)
+
+    def __contains__(self, key):
+        return key in self.links
+
+    def __getitem__(self, key):
+        with self.lock:
+            link = self.links.get(key)
+            if link is None:
+                self.misses += 1
+                raise KeyError(key)
+
+            self.hits += 1
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if self.maxsize <= 0:
+            return
+
+        with self.lock:
+            link = self.links.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[3] = value
+            else:
+                link = [None, None, key, value]
+                self.links[key] = link
+
+                if len(self.links) > self.maxsize:
+                    oldest = self.root[1]
+                    self._unlink(oldest)
+                    del self.links[oldest[2]]
+                    self.evictions += 1
+
+            self._append(link)
+
+    def __delitem__(self, key):
+        with self.lock:
+            link = self.links.pop(key)
+            self._unlink(link)
+
+    def stats(self):
+        """
+        Get the cache's counters as a dictionary.
+        """
+        return {
+            'size': len(self),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _unlink(self, link):
+        prev_link, next_link = link[0], link[1]
+        prev_link[1] = next_link
+        next_link[0] = prev_link
+
+    def _append(self, link):
+        root = self.root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = link
+        root[0] = link
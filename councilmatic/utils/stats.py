@@ -0,0 +1,180 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from django.db import connection, reset_queries
+
+
+def percentile(values, fraction):
+    """
+    Get the value at the given fraction (between 0 and 1) of the way through
+    the sorted values, by the nearest-rank method.
+    """
+    if not values:
+        return None
+
+    values = sorted(values)
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+class StageStats (object):
+    """
+    Collects timings and SQL query counts for the stages of an ingestion run
+    (fetching, parsing, saving, geocoding, ...), along with any other
+    counters, and summarizes them at the end.
+
+    Stages may be nested; a stage's time includes the time of any stages
+    within it.  Queries are counted for the thread that runs the stage.  The
+    collector is safe to share between threads.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        self.started = clock()
+        self.finished = None
+        self.timings = defaultdict(list)
+        self.queries = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.caches = {}
+        self.total_queries = 0
+
+    @contextmanager
+    def timer(self, stage):
+        depth = getattr(self.local, 'depth', 0)
+        self.local.depth = depth + 1
+        if depth == 0:
+            # Log queries only while in a stage, so that they can be counted.
+            self.local.use_debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+
+        start_time = self.clock()
+        start_queries = len(connection.queries)
+        try:
+            yield
+        finally:
+            seconds = self.clock() - start_time
+            queries = len(connection.queries) - start_queries
+
+            with self.lock:
+                self.timings[stage].append(seconds)
+                self.queries[stage] += queries
+
+            # Don't let the query log grow for the whole run; once we're out
+            # of the outermost stage, add it to the total, start over, and
+            # stop logging.
+            self.local.depth = depth
+            if depth == 0:
+                with self.lock:
+                    self.total_queries += len(connection.queries)
+                reset_queries()
+                connection.use_debug_cursor = self.local.use_debug_cursor
+
+    def incr(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def set_cache_stats(self, name, cache_stats):
+        """
+        Record the counters (e.g., hits, misses, and evictions) of the named
+        cache, as of the end of the run.
+        """
+        with self.lock:
+            self.caches[name] = dict(cache_stats)
+
+    def finish(self):
+        self.finished = self.clock()
+
+    def summary(self, records_counter='files_scraped'):
+        """
+        Summarize the run as a dictionary that can be dumped to JSON.  The
+        throughput is the value of the given counter per second.
+        """
+        with self.lock:
+            elapsed = (self.finished or self.clock()) - self.started
+            records = self.counters.get(records_counter, 0)
+
+            stages = {}
+            for stage, timings in self.timings.items():
+                stages[stage] = {
+                    'count': len(timings),
+                    'total': sum(timings),
+                    'p50': percentile(timings, 0.5),
+                    'p95': percentile(timings, 0.95),
+                    'max': max(timings),
+                    'queries': self.queries[stage],
+                }
+
+            return {
+                'elapsed': elapsed,
+                'records': records,
+                'records_per_second': float(records) / elapsed if elapsed else None,
+                'queries': self.total_queries,
+                'stages': stages,
+                'counters': dict(self.counters),
+                'caches': dict(self.caches),
+            }
+
+    def format_summary(self, **kwargs):
+        """
+        Summarize the run as a human-readable table.
+        """
+        summary = self.summary(**kwargs)
+
+        lines = [
+            'Processed %s records in %.1fs (%.2f records/sec), with %s queries' % (
+                summary['records'], summary['elapsed'],
+                summary['records_per_second'] or 0, summary['queries']),
+            '%-20s %8s %10s %10s %10s %10s' % (
+                'stage', 'count', 'total', 'p50', 'p95', 'queries'),
+        ]
+        for stage, stats in sorted(summary['stages'].items()):
+            lines.append('%-20s %8d %9.2fs %9.3fs %9.3fs %10d' % (
+                stage, stats['count'], stats['total'], stats['p50'],
+                stats['p95'], stats['queries']))
+        for counter, value in sorted(summary['counters'].items()):
+            lines.append('%-20s %8d' % (counter, value))
+        for name, cache_stats in sorted(summary['caches'].items()):
+            lines.append('%-20s %s' % (name, ', '.join(
+                '%s=%s' % item for item in sorted(cache_stats.items()))))
+
+        return '\n'.join(lines)
+
+    def write_json(self, path, **kwargs):
+        with open(path, 'w') as stats_file:
+            json.dump(self.summary(**kwargs), stats_file, indent=2, sort_keys=True)
+
+
+# The stats collector for the current run, if any.  Code deep in the models
+# (geocoding, metadata) reports to it through ``timed`` and ``incr``, which do
+# nothing when no run is being measured.
+_active_stats = None
+
+def activate(stats):
+    global _active_stats
+    _active_stats = stats
+
+def deactivate():
+    global _active_stats
+    _active_stats = None
+
+def get_active_stats():
+    return _active_stats
+
+@contextmanager
+def timed(stage):
+    stats = _active_stats
+    if stats is None:
+        yield
+    else:
+        with stats.timer(stage):
+            yield
+
+def incr(counter, amount=1):
+    stats = _active_stats
+    if stats is not None:
+        stats.incr(counter, amount)